@@ -0,0 +1,290 @@
+from tempfile import SpooledTemporaryFile
+from types import SimpleNamespace
+from io import BytesIO
+from PIL import Image
+import threading
+import asyncio
+import random
+import math
+import json
+import time
+import re
+
+import lib.media
+import lib.image
+import lib.critic_review
+import lib.fused_generation
+from lib.aoai_model import aoaiText, aoaiImage, aoaiVision
+from lib.ollama_model import ollamaText, ollamaImage, ollamaVision
+from lib.model_clients import IMAGE_BUFFER_MAX_MEMORY
+from lib.request_governor import estimateTokens
+from lib.schemas import MOVIE_SCHEMA, CRITIC_REVIEW_SCHEMA, IMAGE_PROMPT_SCHEMA, VISION_LAYOUT_SCHEMA, FUSED_SCHEMA
+
+# Characters in each chunk of a fake streamed completion, about what a few tokens come back as
+STREAM_CHUNK_CHARS = 12
+# Text a chatty model adds after the json object, the stream is cancelled before it
+STREAM_TRAILER = "\n\nI hope this fits what you were looking for! Let me know if you would like any changes."
+# Size of the fake generated posters, the size dalle makes them
+FAKE_IMAGE_SIZE = (1024, 1792)
+
+# Filler text for the fake completions so they are about as long as real ones
+FILLER_WORDS = ("cabbage", "neon", "detective", "orbit", "whisper", "harbor", "velvet", "storm", "archive", "lantern",
+                "frontier", "mirror", "circuit", "meadow", "signal", "shadow", "engine", "glacier", "parade", "echo")
+
+class fakeBackendError(ConnectionError):
+    pass
+
+# Latency and failures of one kind of fake backend (text, image or vision). Latency is lognormal around latency seconds
+# with spread sigma (0 is always exactly latency) and each attempt fails with failure_rate. The random numbers come from
+# one seeded generator so a run with the same settings draws the same numbers
+class fakeBackend:
+    def __init__(self, name, latency=0.0, sigma=0.0, failure_rate=0.0, seed=0):
+        self.name = name
+        self.latency = latency
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.failures = 0
+        self._random = random.Random(f"{name}-{seed}")
+        self._lock = threading.Lock()
+
+    # Latency of the next request and whether it fails
+    def nextRequest(self):
+        with self._lock:
+            self.requests += 1
+            if self.latency <= 0:
+                latency = 0.0
+            elif self.sigma <= 0:
+                latency = self.latency
+            else:
+                # mu is picked so the mean of the lognormal is the latency
+                latency = self._random.lognormvariate(math.log(self.latency) - self.sigma ** 2 / 2, self.sigma)
+            failed = self._random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+            return latency, failed
+
+    def words(self, count):
+        with self._lock:
+            return " ".join(self._random.choice(FILLER_WORDS) for _ in range(count))
+
+    def wait(self):
+        latency, failed = self.nextRequest()
+        time.sleep(latency)
+        if failed:
+            raise fakeBackendError(f"Fake {self.name} backend failed the request")
+
+    async def waitAsync(self):
+        latency, failed = self.nextRequest()
+        await asyncio.sleep(latency)
+        if failed:
+            raise fakeBackendError(f"Fake {self.name} backend failed the request")
+
+    def to_json(self):
+        return {"latency": self.latency, "sigma": self.sigma, "failure_rate": self.failure_rate, "requests": self.requests, "failures": self.failures}
+
+# The fake backends in use, set by installFakeBackends
+_backends = {}
+# Encoded fake poster, made once since encoding it would cost more than the code being measured
+_fake_image = None
+_fake_image_lock = threading.Lock()
+
+def getFakeBackend(kind):
+    return _backends[kind]
+
+def getFakeImageBytes():
+    global _fake_image
+    with _fake_image_lock:
+        if _fake_image is None:
+            # A gradient so the poster has something to decode and compress, a flat color would be unrealistically cheap
+            gradient = Image.linear_gradient("L").resize(FAKE_IMAGE_SIZE)
+            poster = Image.merge("RGB", (gradient, gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM), gradient.rotate(90, expand=False)))
+            image_buffer = BytesIO()
+            poster.save(image_buffer, "PNG")
+            _fake_image = image_buffer.getvalue()
+    return _fake_image
+
+# A fresh buffer holding the fake poster, like the one downloadToBuffer returns
+def fakeImageBuffer():
+    buffer = SpooledTemporaryFile(max_size=IMAGE_BUFFER_MAX_MEMORY)
+    buffer.write(getFakeImageBytes())
+    buffer.seek(0)
+    return buffer
+
+# The completion a model would give for the prompt and schema, deterministic apart from the filler words
+def fakeCompletion(backend, schema, user_prompt):
+    if schema is MOVIE_SCHEMA:
+        completion = fakeMovie(backend)
+    elif schema is CRITIC_REVIEW_SCHEMA:
+        tone = re.search(r"Critic Tone: '([^']*)'", user_prompt)
+        completion = fakeReview(backend, tone.group(1) if tone else "Neutral")
+    elif schema is IMAGE_PROMPT_SCHEMA:
+        completion = fakeImagePrompt(backend, user_prompt)
+    elif schema is VISION_LAYOUT_SCHEMA:
+        completion = {"location": "bottom", "location_padding": 60, "font_color": "#FFFFFF", "has_text": False}
+    elif schema is FUSED_SCHEMA:
+        tones = re.search(r"Critic Tones: (\[.*\])", user_prompt)
+        completion = {
+            "movie": fakeMovie(backend),
+            "reviews": [fakeReview(backend, tone) for tone in (json.loads(tones.group(1)) if tones else ["Neutral"])],
+            "poster": fakeImagePrompt(backend, user_prompt)
+        }
+    else:
+        completion = {}
+    return json.dumps(completion, indent=2)
+
+def fakeMovie(backend):
+    return {
+        "title": f"The {backend.words(2).title()}",
+        "tagline": backend.words(8).capitalize() + ".",
+        "mpaa_rating": "PG-13",
+        "rating_content": "Some " + backend.words(4),
+        "description": backend.words(90).capitalize() + "."
+    }
+
+def fakeReview(backend, tone):
+    return {"critic_score": 7, "critic_review": backend.words(140).capitalize() + ".", "critic_tone": tone}
+
+def fakeImagePrompt(backend, user_prompt):
+    fonts = re.search(r"Fonts:(\[.*\])", user_prompt)
+    font_names = json.loads(fonts.group(1)) if fonts else []
+    return {"image_prompt": backend.words(70).capitalize() + ".", "font": font_names[0] if font_names else "Arial"}
+
+# A streamed completion, in the shape of the openai chunks (choices[0].delta.content) or the ollama ones (message.content)
+class fakeStream:
+    def __init__(self, completion, openai_chunks):
+        text = completion + STREAM_TRAILER
+        parts = [text[start:start + STREAM_CHUNK_CHARS] for start in range(0, len(text), STREAM_CHUNK_CHARS)]
+        if openai_chunks:
+            self.chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=part))]) for part in parts]
+        else:
+            self.chunks = [SimpleNamespace(message=SimpleNamespace(content=part)) for part in parts]
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.closed:
+                return
+            yield chunk
+
+    def __aiter__(self):
+        return self.chunksAsync()
+
+    async def chunksAsync(self):
+        for chunk in self.chunks:
+            if self.closed:
+                return
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+# The async streams are closed with an awaited close (openai) or aclose (ollama)
+class fakeAsyncStream(fakeStream):
+    async def close(self):
+        self.closed = True
+
+    async def aclose(self):
+        self.closed = True
+
+# Shared parts of the fake models. Requests still go through the request governor, the json stream reader and the
+# completion cache like the real ones, only the network call is replaced with the fake backend
+class fakeModel:
+    backend_kind = "text"
+    openai_chunks = True
+
+    def getGovernor(self):
+        governor = super().getGovernor()
+        governor.backoff_base = _backends["retry_backoff"]
+        return governor
+
+    def fakeResponse(self):
+        getFakeBackend(self.backend_kind).wait()
+        return self.readStream(fakeStream(fakeCompletion(getFakeBackend(self.backend_kind), self.response_schema, self.user_prompt), self.openai_chunks))
+
+    async def fakeResponseAsync(self):
+        await getFakeBackend(self.backend_kind).waitAsync()
+        return await self.readStreamAsync(fakeAsyncStream(fakeCompletion(getFakeBackend(self.backend_kind), self.response_schema, self.user_prompt), self.openai_chunks))
+
+    # Tokens reserved for the request, the same estimate the real models make
+    def requestTokens(self):
+        model_tokens = getattr(super(), "requestTokens", None)
+        if model_tokens is not None:
+            return model_tokens()
+        return estimateTokens(self.system_prompt, self.user_prompt, max_tokens=getattr(self, "max_tokens", 0))
+
+    def requestResponse(self):
+        return self.getGovernor().call(self.fakeResponse, tokens=self.requestTokens(), used_tokens=self.streamedTokens)
+
+    async def requestResponseAsync(self):
+        return await self.getGovernor().callAsync(self.fakeResponseAsync, tokens=self.requestTokens(), used_tokens=self.streamedTokens)
+
+class fakeImageModel(fakeModel):
+    backend_kind = "image"
+
+    def fakeImage(self):
+        getFakeBackend(self.backend_kind).wait()
+        return fakeImageBuffer()
+
+    async def fakeImageAsync(self):
+        await getFakeBackend(self.backend_kind).waitAsync()
+        return fakeImageBuffer()
+
+    def generateImage(self):
+        return self.getGovernor().call(self.fakeImage, retry_any=True)
+
+    async def generateImageAsync(self):
+        return await self.getGovernor().callAsync(self.fakeImageAsync, retry_any=True)
+
+    # The fake node makes a batch one image at a time, returning the image or the exception for each prompt
+    def generateImages(self, prompts):
+        results = []
+        for prompt in prompts:
+            try:
+                results.append(self.fakeImage())
+            except Exception as e:
+                results.append(e)
+        return results
+
+class fakeAoaiText(fakeModel, aoaiText):
+    pass
+
+class fakeAoaiImage(fakeImageModel, aoaiImage):
+    pass
+
+class fakeAoaiVision(fakeModel, aoaiVision):
+    backend_kind = "vision"
+
+class fakeOllamaText(fakeModel, ollamaText):
+    openai_chunks = False
+
+class fakeOllamaImage(fakeImageModel, ollamaImage):
+    openai_chunks = False
+
+class fakeOllamaVision(fakeModel, ollamaVision):
+    backend_kind = "vision"
+    openai_chunks = False
+
+# The modules that create the models and the fake each of their model classes is replaced with
+FAKE_MODELS = {
+    "aoaiText": fakeAoaiText,
+    "aoaiImage": fakeAoaiImage,
+    "aoaiVision": fakeAoaiVision,
+    "ollamaText": fakeOllamaText,
+    "ollamaImage": fakeOllamaImage,
+    "ollamaVision": fakeOllamaVision
+}
+MODEL_MODULES = (lib.media, lib.image, lib.critic_review, lib.fused_generation)
+
+# Swap the fake models in for the real ones everywhere the pipeline creates them. backends is the fakeBackend for
+# text, image and vision, retry_backoff the base backoff of the governors so retried failures don't sleep for seconds
+def installFakeBackends(text, image, vision, retry_backoff=0.01):
+    _backends.update({"text": text, "image": image, "vision": vision, "retry_backoff": retry_backoff})
+    getFakeImageBytes()
+    for module in MODEL_MODULES:
+        for name, fake_model in FAKE_MODELS.items():
+            if hasattr(module, name):
+                setattr(module, name, fake_model)
+
+def getFakeBackendStats():
+    return {kind: _backends[kind].to_json() for kind in ("text", "image", "vision")}
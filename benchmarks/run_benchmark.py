@@ -0,0 +1,215 @@
+from contextlib import redirect_stdout, redirect_stderr, nullcontext
+import threading
+import tempfile
+import argparse
+import resource
+import shutil
+import json
+import time
+import sys
+import os
+
+import media_generator
+from lib.metrics import getMetrics
+from lib.process_helper import stopLogging
+from benchmarks.fake_backends import fakeBackend, installFakeBackends, getFakeBackendStats
+
+# USAGE
+# Runs the whole media generator pipeline against fake backends, so throughput and the CPU and memory of our own code
+# can be measured without models, keys or network. From the repo root:
+#   python -m benchmarks.run_benchmark -c 20 -n 4
+#   python -m benchmarks.run_benchmark -c 50 -n 8 --text-latency 1.5 --image-latency 8 --image-failure-rate 0.1
+# Arguments the benchmark doesn't know are passed on to media_generator, e.g. --fused, --reviews 3, --target,
+# --image-batch 4 or --render-processes 2. Batch mode (-b) needs the Azure batch service and isn't faked
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stage functions of media_generator that are timed, and the pipeline stage each belongs to
+TIMED_STAGES = {
+    "textStage": "text",
+    "imageStage": "image",
+    "imageBatchStage": "image",
+    "visionStage": "vision",
+    "renderStage": "render"
+}
+
+# Environment the generator runs with, the endpoints are never contacted since the fakes replace every request
+def getBenchmarkEnv(backend, max_retries):
+    env = {
+        "MODEL_TYPE": backend,
+        "LOCAL_MODEL_NAME": "benchmark",
+        "COMPLETION_CACHE": "false",
+        "GOVERNOR_MAX_RETRIES": str(max_retries)
+    }
+    for kind in ("TEXT", "IMAGE", "VISION"):
+        env[f"AZURE_OPENAI_{kind}_ENDPOINT"] = "https://benchmark.invalid/"
+        env[f"AZURE_OPENAI_{kind}_ENDPOINT_KEY"] = "benchmark"
+        env[f"AZURE_OPENAI_{kind}_API_VERSION"] = "2024-08-01-preview"
+        env[f"AZURE_OPENAI_{kind}_DEPLOYMENT_NAME"] = f"benchmark-{kind.lower()}"
+        env[f"AZURE_OPENAI_{kind}_MODEL"] = f"benchmark-{kind.lower()}"
+    return env
+
+# CPU and wall time spent in each pipeline stage. CPU is the thread time of the worker running the stage, so it is
+# only our own work and not the time spent waiting on the fake backends
+class stageTimer:
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, cpu_seconds, wall_seconds, jobs):
+        with self._lock:
+            stats = self.stages.setdefault(stage, {"calls": 0, "jobs": 0, "cpu_seconds": 0.0, "wall_seconds": 0.0})
+            stats["calls"] += 1
+            stats["jobs"] += jobs
+            stats["cpu_seconds"] += cpu_seconds
+            stats["wall_seconds"] += wall_seconds
+
+    # Wrap a stage function so each call is timed, batch stages get a list of jobs
+    def wrap(self, stage, stage_function):
+        def timedStage(job):
+            cpu_start = time.thread_time()
+            wall_start = time.perf_counter()
+            try:
+                return stage_function(job)
+            finally:
+                self.record(stage, time.thread_time() - cpu_start, time.perf_counter() - wall_start, len(job) if isinstance(job, list) else 1)
+        return timedStage
+
+    def to_json(self):
+        with self._lock:
+            return {
+                stage: {
+                    "jobs": stats["jobs"],
+                    "cpu_seconds": round(stats["cpu_seconds"], 4),
+                    "cpu_ms_per_job": round(stats["cpu_seconds"] * 1000 / stats["jobs"], 3) if stats["jobs"] else None,
+                    "wall_seconds": round(stats["wall_seconds"], 4)
+                }
+                for stage, stats in self.stages.items()
+            }
+
+# Time the stage functions and set the backend of every media object, media_generator leaves model_type unset
+def instrumentGenerator(stage_timer, backend):
+    for function_name, stage in TIMED_STAGES.items():
+        setattr(media_generator, function_name, stage_timer.wrap(stage, getattr(media_generator, function_name)))
+
+    start_media_job = media_generator.startMediaJob
+    def startMediaJob(job):
+        start_media_job(job)
+        job.media_object.model_type = backend
+    media_generator.startMediaJob = startMediaJob
+
+def getCpuSeconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+# ru_maxrss is in kilobytes on Linux and bytes on macOS
+def getPeakRssMb(usage):
+    return round(usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+# Run the generator in a scratch directory with its own templates and outputs, returns the wall seconds it took
+def runGenerator(generator_args, show_log):
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="media_benchmark_") as work_dir:
+        shutil.copytree(os.path.join(REPO_DIR, "templates"), os.path.join(work_dir, "templates"))
+        os.makedirs(os.path.join(work_dir, "outputs"))
+        os.chdir(work_dir)
+        sys.argv = ["media_generator.py"] + generator_args
+        try:
+            with open(os.devnull, "w") as devnull:
+                with (nullcontext() if show_log else redirect_stdout(devnull)), (nullcontext() if show_log else redirect_stderr(devnull)):
+                    wall_start = time.perf_counter()
+                    try:
+                        media_generator.main()
+                    finally:
+                        wall_seconds = time.perf_counter() - wall_start
+                        # The log goes to outputs and the console handler holds devnull, both close with the run
+                        stopLogging()
+        finally:
+            os.chdir(original_dir)
+    return wall_seconds
+
+def buildReport(args, generator_args, stage_timer, wall_seconds, usage_start, usage_end, children_usage):
+    metrics = getMetrics().to_json()
+    successes = metrics["objects"].get("success", 0)
+    process_cpu = getCpuSeconds(usage_end) - getCpuSeconds(usage_start)
+    stages = stage_timer.to_json()
+    return {
+        "settings": {
+            "backend": args.backend,
+            "generator_args": generator_args,
+            "seed": args.seed,
+            "max_retries": args.max_retries
+        },
+        "objects": metrics["objects"],
+        "wall_seconds": round(wall_seconds, 3),
+        "objects_per_second": round(successes / wall_seconds, 3) if wall_seconds > 0 else 0,
+        "cpu_seconds": {
+            "process": round(process_cpu, 3),
+            "stages": round(sum(stats["cpu_seconds"] for stats in stages.values()), 3),
+            "child_processes": round(getCpuSeconds(children_usage), 3)
+        },
+        "cpu_ms_per_object": round(process_cpu * 1000 / successes, 3) if successes else None,
+        "peak_rss_mb": getPeakRssMb(usage_end),
+        "child_process_peak_rss_mb": getPeakRssMb(children_usage),
+        "stages": stages,
+        "steps": metrics["stages"],
+        "backends": getFakeBackendStats(),
+        "requests": metrics["backends"]
+    }
+
+def printReport(report):
+    objects = ", ".join(f"{result} {count}" for result, count in report["objects"].items())
+    print(f"Objects: {objects or 'none'}")
+    print(f"Wall time: {report['wall_seconds']}s, {report['objects_per_second']} objects/sec")
+    cpu = report["cpu_seconds"]
+    print(f"CPU: {cpu['process']}s process ({cpu['stages']}s in stages), {cpu['child_processes']}s child processes, {report['cpu_ms_per_object']} ms per object")
+    print(f"Peak RSS: {report['peak_rss_mb']} MB, child processes {report['child_process_peak_rss_mb']} MB")
+    print(f"{'Stage':<10}{'Jobs':>8}{'CPU s':>10}{'CPU ms/job':>12}{'Wall s':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<10}{stats['jobs']:>8}{stats['cpu_seconds']:>10}{str(stats['cpu_ms_per_job']):>12}{stats['wall_seconds']:>10}")
+    if report["steps"]:
+        print("Step latency p50/p95/p99: " + ", ".join(f"{step} {stats['p50']}/{stats['p95']}/{stats['p99']}s" for step, stats in report["steps"].items()))
+    print("Fake backends: " + ", ".join(f"{kind} {stats['requests']} requests {stats['failures']} failed" for kind, stats in report["backends"].items()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the media generator pipeline against fake backends. Unknown arguments are passed to media_generator.")
+    parser.add_argument("-c", "--count", default="20", help="Number of media objects to generate")
+    parser.add_argument("-n", "--concurrency", default="4", help="Number of media objects to generate at the same time")
+    parser.add_argument("--backend", choices=["azure_openai", "local"], default="azure_openai", help="Which model classes to fake, Azure OpenAI or ollama/ComfyUI")
+    # Latency defaults are a fast backend scaled down so a run takes seconds, pass real numbers to model a deployment
+    for kind, latency in (("text", 0.2), ("image", 1.0), ("vision", 0.2)):
+        parser.add_argument(f"--{kind}-latency", type=float, default=latency, help=f"Mean seconds a {kind} request takes")
+        parser.add_argument(f"--{kind}-sigma", type=float, default=0.25, help=f"Spread of the lognormal {kind} latency, 0 for a fixed latency")
+        parser.add_argument(f"--{kind}-failure-rate", type=float, default=0.0, help=f"Chance each {kind} request attempt fails")
+    parser.add_argument("--max-retries", type=int, default=2, help="Retries of a failed request before the stage fails")
+    parser.add_argument("--retry-backoff", type=float, default=0.01, help="Base backoff in seconds between retries")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the fake latencies, failures and completions")
+    parser.add_argument("--show-log", action='store_true', help="Show the generator log instead of only the report")
+    parser.add_argument("-o", "--output", help="Also write the report to this json file")
+    args, generator_args = parser.parse_known_args()
+    generator_args = ["-c", args.count, "-n", args.concurrency] + generator_args
+    if "-b" in generator_args or "--batch" in generator_args:
+        parser.error("Batch mode isn't supported by the benchmark")
+
+    os.environ.update(getBenchmarkEnv(args.backend, args.max_retries))
+    installFakeBackends(
+        fakeBackend("text", args.text_latency, args.text_sigma, args.text_failure_rate, args.seed),
+        fakeBackend("image", args.image_latency, args.image_sigma, args.image_failure_rate, args.seed),
+        fakeBackend("vision", args.vision_latency, args.vision_sigma, args.vision_failure_rate, args.seed),
+        args.retry_backoff)
+    stage_timer = stageTimer()
+    instrumentGenerator(stage_timer, args.backend)
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    wall_seconds = runGenerator(generator_args, args.show_log)
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    # The render processes have exited by now, so their usage has been added to the children along with any other subprocesses
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    report = buildReport(args, generator_args, stage_timer, wall_seconds, usage_start, usage_end, children_usage)
+    printReport(report)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            json.dump(report, report_file, indent=4)
+
+if __name__ == "__main__":
+    main()
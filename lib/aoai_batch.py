@@ -0,0 +1,106 @@
+import os
+import json
+import time
+
+from lib.aoai_model import aoaiModel, TEXT_MAX_TOKENS
+from lib.model_clients import getAzureClient
+from lib.schemas import azureResponseFormat
+
+# Seconds between checks on a batch job, batch jobs take minutes to hours so there is no point asking more often
+BATCH_POLL_INTERVAL = 30
+# Most requests sent in one batch job, bigger waves are split over several jobs that run side by side
+BATCH_MAX_REQUESTS = 50000
+# Batch job states that won't change anymore
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Azure OpenAI Batch API for bulk chat completions. Requests are collected with addRequest, written as a jsonl file,
+# submitted as batch jobs and the completions are read back by custom id. Uses the AZURE_OPENAI_BATCH settings and falls
+# back to the AZURE_OPENAI_TEXT ones, the deployment has to be a batch deployment. Pointing AZURE_OPENAI_BATCH_ENDPOINT at a
+# local server that speaks the files and batches routes lets the batch mode run against a fake
+class aoaiBatch(aoaiModel):
+    def __init__(self):
+        super().__init__()
+        self.endpoint = os.getenv("AZURE_OPENAI_BATCH_ENDPOINT") or os.getenv("AZURE_OPENAI_TEXT_ENDPOINT")
+        self.key = os.getenv("AZURE_OPENAI_BATCH_ENDPOINT_KEY") or os.getenv("AZURE_OPENAI_TEXT_ENDPOINT_KEY")
+        self.api_version = os.getenv("AZURE_OPENAI_BATCH_API_VERSION") or os.getenv("AZURE_OPENAI_TEXT_API_VERSION")
+        self.deployment_name = os.getenv("AZURE_OPENAI_BATCH_DEPLOYMENT_NAME") or os.getenv("AZURE_OPENAI_TEXT_DEPLOYMENT_NAME")
+        self.model = os.getenv("AZURE_OPENAI_TEXT_MODEL")
+        poll_interval = os.getenv("AZURE_OPENAI_BATCH_POLL_INTERVAL", "")
+        self.poll_interval = float(poll_interval) if poll_interval.replace(".", "", 1).isdigit() else BATCH_POLL_INTERVAL
+        self.requests = []
+        # (batch id, requests in that batch job) for each submitted job
+        self.batches = []
+
+        self.client = getAzureClient(self.endpoint, self.key, self.api_version)
+
+    # Add a chat completion to the batch, custom_id is how its completion is found in the results and schema the
+    # structured output it should follow
+    def addRequest(self, custom_id, system_prompt, user_prompt, max_tokens=TEXT_MAX_TOKENS, schema=None):
+        request = {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {
+                "model": self.deployment_name,
+                "messages": [
+                    { "role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                "max_tokens": max_tokens,
+                "temperature": self.prompts_temperature
+            }
+        }
+        response_format = azureResponseFormat(schema)
+        if response_format:
+            request["body"]["response_format"] = response_format
+        self.requests.append(request)
+
+    # Upload the requests as jsonl files and start a batch job for each, returns the batch ids
+    def submit(self):
+        for start in range(0, len(self.requests), BATCH_MAX_REQUESTS):
+            batch_requests = self.requests[start:start + BATCH_MAX_REQUESTS]
+            batch_input = "\n".join(json.dumps(request) for request in batch_requests) + "\n"
+            input_file = self.client.files.create(file=(f"batch_{start}.jsonl", batch_input.encode(), "application/jsonl"), purpose="batch")
+            batch = self.client.batches.create(input_file_id=input_file.id, endpoint="/chat/completions", completion_window="24h")
+            self.batches.append((batch.id, batch_requests))
+        return [batch_id for batch_id, _ in self.batches]
+
+    # Wait for the batch job to finish and return it
+    def waitForBatch(self, batch_id):
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in BATCH_FINAL_STATUSES:
+                return batch
+            time.sleep(self.poll_interval)
+
+    # Read the completions of a finished batch job into results by custom id, requests that failed get their error
+    def readResults(self, batch, results):
+        if batch.output_file_id:
+            for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    results[result["custom_id"]] = Exception(f"Batch request failed: {result.get('error') or response.get('body')}")
+                else:
+                    results[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        if batch.error_file_id:
+            for line in self.client.files.content(batch.error_file_id).text.splitlines():
+                if line.strip():
+                    result = json.loads(line)
+                    results.setdefault(result["custom_id"], Exception(f"Batch request failed: {result.get('error') or result.get('response')}"))
+
+    # Submit the requests, wait for the batch jobs and return the completion (or the exception) for each custom id
+    def run(self):
+        self.submit()
+        results = {}
+        for batch_id, batch_requests in self.batches:
+            batch = self.waitForBatch(batch_id)
+            self.readResults(batch, results)
+            if batch.status != "completed":
+                for request in batch_requests:
+                    results.setdefault(request["custom_id"], Exception(f"Batch job {batch_id} {batch.status}"))
+        for request in self.requests:
+            results.setdefault(request["custom_id"], Exception("No result in the batch output"))
+        return results
@@ -1,8 +1,17 @@
-from openai import AzureOpenAI
 import os
 import json
-import requests
-from io import BytesIO
+import asyncio
+
+from lib.model_clients import getAzureClient, getAsyncAzureClient, downloadToBuffer, downloadToBufferAsync
+from lib.completion_cache import cachedCompletion, cachedCompletionAsync
+from lib.request_governor import getGovernor, estimateTokens
+from lib.json_stream import jsonStreamScanner
+from lib.schemas import azureResponseFormat, getSchemaName, completionMatches
+
+# Default most tokens a text completion can use
+TEXT_MAX_TOKENS = 600
+# Tokens an image in a vision request counts for, a high detail 1024 square image is 765
+VISION_IMAGE_TOKENS = 765
 
 # Parent class for the Azure OpenAI models
 class aoaiModel():
@@ -16,6 +25,10 @@ class aoaiModel():
         self.client = None
         self.system_prompt = ""
         self.user_prompt = ""
+        self.prompts_temperature = 1
+        self.env_prefix = ""
+        # Schema the completion should follow (see lib/schemas.py), sent as structured output when set
+        self.response_schema = None
     
     def to_json(self):
         # Return a clean json object for saving details without sensitive information
@@ -26,6 +39,60 @@ class aoaiModel():
             "model": self.model
         }
 
+    # Requests to the deployment go through its governor, env_prefix picks the budgets from the environment (e.g. AZURE_OPENAI_TEXT_RPM)
+    def getGovernor(self):
+        return getGovernor(self.env_prefix, f"{self.endpoint}/{self.deployment_name}")
+
+    # The response_format argument for the chat completion when the model has a schema
+    def responseFormatArgs(self):
+        response_format = azureResponseFormat(self.response_schema)
+        return {"response_format": response_format} if response_format else {}
+
+    def getSchemaName(self):
+        return getSchemaName(self.response_schema) if self.response_schema is not None else None
+
+    # Only completions that fit the schema go into the completion cache
+    def isValidCompletion(self, completion):
+        return completionMatches(completion, self.response_schema)
+
+    # Reads a streamed chat completion until the json object in it is complete, then closes the stream so we stop
+    # waiting on (and paying for) whatever the model adds after it. Returns the completion up to the end of the object
+    def readStream(self, stream):
+        scanner = jsonStreamScanner()
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content and scanner.feed(chunk.choices[0].delta.content):
+                    break
+        finally:
+            stream.close()
+        return scanner.text
+
+    async def readStreamAsync(self, stream):
+        scanner = jsonStreamScanner()
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content and scanner.feed(chunk.choices[0].delta.content):
+                    break
+        finally:
+            await stream.close()
+        return scanner.text
+
+    # Tokens a streamed completion used, the stream is closed before any usage is sent so it is estimated from the text
+    def streamedTokens(self, completion):
+        return estimateTokens(self.system_prompt, self.user_prompt, completion)
+
+    # The async client is shared per endpoint and event loop, created on first use since it needs a running loop
+    def getAsyncClient(self):
+        return getAsyncAzureClient(self.endpoint, self.key, self.api_version)
+
+    # Async versions of the calls, children override these with native async clients
+    # so one event loop can keep many requests in flight, this fallback runs the sync call in a thread
+    async def generateResponseAsync(self):
+        return await asyncio.to_thread(self.generateResponse)
+
+    async def generateImageAsync(self):
+        return await asyncio.to_thread(self.generateImage)
+
 # Child class for the Azure OpenAI Text model
 class aoaiText(aoaiModel):
     def __init__(self):
@@ -35,23 +102,45 @@ class aoaiText(aoaiModel):
         self.api_version = os.getenv("AZURE_OPENAI_TEXT_API_VERSION")
         self.deployment_name = os.getenv("AZURE_OPENAI_TEXT_DEPLOYMENT_NAME")
         self.model = os.getenv("AZURE_OPENAI_TEXT_MODEL")
+        self.env_prefix = "AZURE_OPENAI_TEXT"
+        self.max_tokens = TEXT_MAX_TOKENS
 
-        self.client = AzureOpenAI(
-            api_key=self.key,  
-            api_version=self.api_version,
-            azure_endpoint=self.endpoint
-        )
+        # Shared client per endpoint, keeps its connection pool alive across requests
+        self.client = getAzureClient(self.endpoint, self.key, self.api_version)
+
+    # What goes into the completion cache key, the completion only depends on these
+    def cacheKeyParts(self):
+        return ("azure_openai", self.deployment_name, self.system_prompt, self.user_prompt, self.prompts_temperature, None, self.getSchemaName())
 
     def generateResponse(self):
-        response = self.client.chat.completions.create(
-            model=self.deployment_name, 
-            messages=[
-                { "role": "system", "content": self.system_prompt},
-                {"role": "user", "content":self.user_prompt}
-            ],
-            max_tokens=600, temperature=self.prompts_temperature)
-        
-        return response.choices[0].message.content
+        return cachedCompletion(self.cacheKeyParts(), self.requestResponse, self.isValidCompletion)
+
+    async def generateResponseAsync(self):
+        return await cachedCompletionAsync(self.cacheKeyParts(), self.requestResponseAsync, self.isValidCompletion)
+
+    def buildMessages(self):
+        return [
+            { "role": "system", "content": self.system_prompt},
+            {"role": "user", "content":self.user_prompt}
+        ]
+
+    # The completion is streamed and cut off once its json object is complete
+    def requestResponse(self):
+        return self.getGovernor().call(
+            lambda: self.readStream(self.client.chat.completions.create(
+                model=self.deployment_name, 
+                messages=self.buildMessages(),
+                max_tokens=self.max_tokens, temperature=self.prompts_temperature, stream=True, **self.responseFormatArgs())),
+            tokens=estimateTokens(self.system_prompt, self.user_prompt, max_tokens=self.max_tokens), used_tokens=self.streamedTokens)
+
+    async def requestResponseAsync(self):
+        async def request():
+            return await self.readStreamAsync(await self.getAsyncClient().chat.completions.create(
+                model=self.deployment_name, 
+                messages=self.buildMessages(),
+                max_tokens=self.max_tokens, temperature=self.prompts_temperature, stream=True, **self.responseFormatArgs()))
+        return await self.getGovernor().callAsync(request,
+            tokens=estimateTokens(self.system_prompt, self.user_prompt, max_tokens=self.max_tokens), used_tokens=self.streamedTokens)
 
 # Child class for the Azure OpenAI Image model
 class aoaiImage(aoaiModel):
@@ -62,31 +151,55 @@ class aoaiImage(aoaiModel):
         self.api_version = os.getenv("AZURE_OPENAI_IMAGE_API_VERSION")
         self.deployment_name = os.getenv("AZURE_OPENAI_IMAGE_DEPLOYMENT_NAME")
         self.model = os.getenv("AZURE_OPENAI_IMAGE_MODEL")
+        self.env_prefix = "AZURE_OPENAI_IMAGE"
 
-        self.client = AzureOpenAI(
-            api_key=self.key,  
-            api_version=self.api_version,
-            azure_endpoint=self.endpoint
-        )
+        # Shared client per endpoint, keeps its connection pool alive across requests
+        self.client = getAzureClient(self.endpoint, self.key, self.api_version)
 
+    # Image requests only count against the requests budget. Any failure is retried, a request that fails (e.g. the
+    # content filter on a borderline prompt) can go through on the next attempt
     def generateImage(self):
-                # Attempt to generate the image up to 5 times
-
+        result = self.getGovernor().call(
+            lambda: self.client.images.generate(
+                model=self.deployment_name,
+                prompt=self.user_prompt,
+                n=1,
+                size="1024x1792"
+            ),
+            retry_any=True)
 
-        result = self.client.images.generate(
-            model=self.deployment_name,
-            prompt=self.user_prompt,
-            n=1,
-            size="1024x1792"
-        )
-                
 
         # Grab the first image from the response
         json_response = json.loads(result.model_dump_json())
 
         # Retrieve the generated image and save it to the images directory
         image_url = json_response["data"][0]["url"]  # extract image URL from response
-        return BytesIO(requests.get(image_url).content)  # download the image
+        return downloadToBuffer(image_url)  # download the image
+
+    # Dalle only creates one image per request, so a batch is each prompt generated in turn
+    # Returns a list in the same order as the prompts holding the image or the exception for that prompt
+    def generateImages(self, prompts):
+        results = []
+        for prompt in prompts:
+            self.user_prompt = prompt
+            try:
+                results.append(self.generateImage())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def generateImageAsync(self):
+        result = await self.getGovernor().callAsync(
+            lambda: self.getAsyncClient().images.generate(
+                model=self.deployment_name,
+                prompt=self.user_prompt,
+                n=1,
+                size="1024x1792"
+            ),
+            retry_any=True)
+
+        image_url = result.data[0].url  # extract image URL from response
+        return await downloadToBufferAsync(image_url)  # download the image
 
 # Child class for the Azure OpenAI Vision model
 class aoaiVision(aoaiModel):
@@ -97,34 +210,67 @@ class aoaiVision(aoaiModel):
         self.api_version = os.getenv("AZURE_OPENAI_VISION_API_VERSION")
         self.deployment_name = os.getenv("AZURE_OPENAI_VISION_DEPLOYMENT_NAME")
         self.model = os.getenv("AZURE_OPENAI_VISION_MODEL")
+        self.env_prefix = "AZURE_OPENAI_VISION"
         self.image_base64 = ""
-        self.mime_type = "image/png"
+        self.mime_type = "image/jpeg"
+
+        # Shared client per endpoint, keeps its connection pool alive across requests
+        self.client = getAzureClient(self.endpoint, self.key, self.api_version)
 
-        self.client = AzureOpenAI(
-            api_key=self.key,  
-            api_version=self.api_version,
-            azure_endpoint=self.endpoint
-            #base_url=f"{self.endpoint}openai/deployments/{self.deployment_name}/extensions"
-        )
+    # Builds the chat messages with the image included as a base64 data url
+    def buildMessages(self):
+        return [
+            { "role": "system", "content": self.system_prompt },
+            { "role": "user", "content": [  
+                { 
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{self.mime_type};base64,{self.image_base64}"
+                    }
+                },
+                { 
+                    "type": "text", 
+                    "text": self.user_prompt
+                }
+            ] } 
+        ]
+
+    # What goes into the completion cache key, the image is keyed by a digest of its data
+    def cacheKeyParts(self):
+        return ("azure_openai", self.deployment_name, self.system_prompt, self.user_prompt, None, self.image_base64, self.getSchemaName())
 
     def generateResponse(self):
-        response = self.client.chat.completions.create(
+        return cachedCompletion(self.cacheKeyParts(), self.requestResponse, self.isValidCompletion)
+
+    async def generateResponseAsync(self):
+        return await cachedCompletionAsync(self.cacheKeyParts(), self.requestResponseAsync, self.isValidCompletion)
+
+    # Tokens estimated for the request, the image is about VISION_IMAGE_TOKENS on top of the prompt
+    def requestTokens(self):
+        return estimateTokens(self.system_prompt, self.user_prompt, max_tokens=2000) + VISION_IMAGE_TOKENS
+
+    def streamedTokens(self, completion):
+        return super().streamedTokens(completion) + VISION_IMAGE_TOKENS
+
+    # The completion is streamed and cut off once its json object is complete
+    def requestResponse(self):
+        return self.getGovernor().call(
+            lambda: self.readStream(self.client.chat.completions.create(
+                model=self.deployment_name,
+                messages=self.buildMessages(),
+                max_tokens=2000,
+                stream=True,
+                **self.responseFormatArgs()
+            )),
+            tokens=self.requestTokens(), used_tokens=self.streamedTokens)
+
+    async def requestResponseAsync(self):
+        async def request():
+            return await self.readStreamAsync(await self.getAsyncClient().chat.completions.create(
                 model=self.deployment_name,
-                messages=[
-                    { "role": "system", "content": self.system_prompt },
-                    { "role": "user", "content": [  
-                        { 
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{self.mime_type};base64,{self.image_base64}"
-                            }
-                        },
-                        { 
-                            "type": "text", 
-                            "text": self.user_prompt
-                        }
-                    ] } 
-                ],
-                max_tokens=2000 
-            )
-        return response.choices[0].message.content
\ No newline at end of file
+                messages=self.buildMessages(),
+                max_tokens=2000,
+                stream=True,
+                **self.responseFormatArgs()
+            ))
+        return await self.getGovernor().callAsync(request, tokens=self.requestTokens(), used_tokens=self.streamedTokens)
@@ -0,0 +1,129 @@
+import threading
+import time
+import os
+
+from lib.model_clients import getHttpSession
+
+# Default render node when COMFYUI_ENDPOINTS isn't set
+DEFAULT_COMFYUI_ENDPOINT = "http://172.23.112.1:8188"
+
+# Seconds between refreshes of the /queue depth of each node
+QUEUE_CHECK_INTERVAL = 1
+# How long a node that failed is left alone before it gets work again
+FAILED_NODE_COOLDOWN = 30
+
+# A ComfyUI render node and what we know about it
+class comfyEndpoint:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.failures = 0
+        self.unhealthy_until = 0
+
+    def isHealthy(self, now):
+        return now >= self.unhealthy_until
+
+    def to_json(self):
+        return {
+            "url": self.url,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "failures": self.failures,
+            "healthy": self.isHealthy(time.monotonic())
+        }
+
+# Pool of ComfyUI render nodes. Jobs go to the healthy node with the least work, going by its /queue depth plus the jobs
+# we have in flight on it. A node that fails is left alone for a cooldown and the job is moved on to another node
+# The queue depths are refreshed by one background poller every QUEUE_CHECK_INTERVAL, so picking a node never waits
+# on a slow one. With a single node there is nothing to pick between and it isn't polled
+class comfyEndpointPool:
+    def __init__(self, endpoints, cooldown=FAILED_NODE_COOLDOWN):
+        self.endpoints = [comfyEndpoint(url) for url in endpoints]
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._poller = None
+        self._stop_polling = threading.Event()
+
+    # Refresh the queue depth of the node from ComfyUI, a node that doesn't answer is marked failed
+    def checkQueue(self, endpoint):
+        try:
+            queue_json = getHttpSession().get(f"{endpoint.url}/queue", timeout=2).json()
+            queue_depth = len(queue_json.get("queue_running", [])) + len(queue_json.get("queue_pending", []))
+        except Exception:
+            self.markFailed(endpoint)
+            return
+        with self._lock:
+            endpoint.queue_depth = queue_depth
+
+    def pollQueues(self):
+        while not self._stop_polling.is_set():
+            now = time.monotonic()
+            for endpoint in self.endpoints:
+                if endpoint.isHealthy(now) and not self._stop_polling.is_set():
+                    self.checkQueue(endpoint)
+            self._stop_polling.wait(QUEUE_CHECK_INTERVAL)
+
+    def startPolling(self):
+        with self._lock:
+            if self._poller is not None or len(self.endpoints) < 2:
+                return
+            self._poller = threading.Thread(target=self.pollQueues, daemon=True, name="comfyui-queue-poller")
+        self._poller.start()
+
+    def stopPolling(self):
+        self._stop_polling.set()
+        if self._poller is not None:
+            self._poller.join()
+
+    # Pick the node for the next job and count it as in flight, call release when the job is done. Goes by the queue
+    # depths the poller last saw, so it doesn't block and is safe to call from an event loop
+    def acquire(self, exclude=()):
+        self.startPolling()
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.url not in exclude]
+        if not candidates:
+            raise Exception("No ComfyUI endpoints left to try")
+
+        with self._lock:
+            healthy = [endpoint for endpoint in candidates if endpoint.isHealthy(now)]
+            if healthy:
+                endpoint = min(healthy, key=lambda endpoint: endpoint.queue_depth + endpoint.in_flight)
+            else:
+                # Everything is down, try the node that is closest to coming back
+                endpoint = min(candidates, key=lambda endpoint: endpoint.unhealthy_until)
+            endpoint.in_flight += 1
+        return endpoint
+
+    def release(self, endpoint, success=True):
+        with self._lock:
+            endpoint.in_flight -= 1
+            if success:
+                endpoint.failures = 0
+                endpoint.unhealthy_until = 0
+
+    def markFailed(self, endpoint):
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.unhealthy_until = time.monotonic() + self.cooldown
+
+    def to_json(self):
+        return [endpoint.to_json() for endpoint in self.endpoints]
+
+_comfy_pool = None
+_comfy_pool_lock = threading.Lock()
+
+# Get the process wide pool of ComfyUI nodes from COMFYUI_ENDPOINTS, a comma separated list of urls
+def getComfyPool():
+    global _comfy_pool
+    if _comfy_pool is None:
+        with _comfy_pool_lock:
+            if _comfy_pool is None:
+                endpoints = [url.strip() for url in os.getenv("COMFYUI_ENDPOINTS", DEFAULT_COMFYUI_ENDPOINT).split(",") if url.strip()]
+                _comfy_pool = comfyEndpointPool(endpoints)
+    return _comfy_pool
+
+# Stop the queue poller of the pool, call at the end of the run before the http clients are closed
+def stopComfyPool():
+    if _comfy_pool is not None:
+        _comfy_pool.stopPolling()
@@ -0,0 +1,183 @@
+import threading
+import hashlib
+import asyncio
+import sqlite3
+import json
+import time
+import os
+
+# Default max size of the cached completions on disk
+COMPLETION_CACHE_MAX_MB = 256
+# Default seconds a cached completion is used for, 0 keeps them until they are evicted
+COMPLETION_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Disk cache of model completions keyed by a hash of everything that went into the request, so rerunning the same
+# prompts while tuning templates or replaying runs is answered from disk instead of the backend. Kept in sqlite under
+# outputs, the least recently used completions are evicted when it grows past max_bytes and expire after ttl seconds
+class completionCache:
+    def __init__(self, cache_path=None, max_bytes=COMPLETION_CACHE_MAX_MB * 1024 * 1024, ttl=COMPLETION_CACHE_TTL):
+        self.cache_path = cache_path if cache_path else os.path.join(os.getcwd(), "outputs", "completion_cache.db")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS completions (
+                cache_key TEXT PRIMARY KEY,
+                completion TEXT,
+                size INTEGER,
+                created REAL,
+                last_used REAL
+            )
+        """)
+        self._connection.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    # Content address of a request, image is the raw or base64 image sent along with the prompt and schema the name of
+    # the structured output schema it asked for
+    @staticmethod
+    def buildKey(backend, model, system_prompt, user_prompt, temperature=None, image=None, schema=None):
+        if image:
+            image_digest = hashlib.sha256(image.encode() if isinstance(image, str) else image).hexdigest()
+        else:
+            image_digest = None
+        key_parts = json.dumps([backend, model, system_prompt, user_prompt, temperature, image_digest, schema])
+        return hashlib.sha256(key_parts.encode()).hexdigest()
+
+    # Get the cached completion for a key, None when it isn't cached or has expired
+    def get(self, cache_key):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT completion, size, created FROM completions WHERE cache_key=?", (cache_key,)).fetchone()
+            if row is not None and self.ttl and now - row[2] > self.ttl:
+                self._connection.execute("DELETE FROM completions WHERE cache_key=?", (cache_key,))
+                self._connection.commit()
+                self._size -= row[1]
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE completions SET last_used=? WHERE cache_key=?", (now, cache_key))
+            self._connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, cache_key, completion):
+        if not isinstance(completion, str):
+            return
+        now = time.time()
+        size = len(completion.encode())
+        with self._lock:
+            old_row = self._connection.execute("SELECT size FROM completions WHERE cache_key=?", (cache_key,)).fetchone()
+            self._connection.execute("""
+                INSERT OR REPLACE INTO completions (cache_key, completion, size, created, last_used) VALUES (?, ?, ?, ?, ?)
+            """, (cache_key, completion, size, now, now))
+            self._size += size - (old_row[0] if old_row else 0)
+            self.evict()
+            self._connection.commit()
+
+    def delete(self, cache_key):
+        with self._lock:
+            row = self._connection.execute("SELECT size FROM completions WHERE cache_key=?", (cache_key,)).fetchone()
+            if row is not None:
+                self._connection.execute("DELETE FROM completions WHERE cache_key=?", (cache_key,))
+                self._connection.commit()
+                self._size -= row[0]
+
+    # Drop the least recently used completions until the cache fits in max_bytes, called holding the lock
+    def evict(self):
+        while self._size > self.max_bytes:
+            rows = self._connection.execute("SELECT cache_key, size FROM completions ORDER BY last_used LIMIT 100").fetchall()
+            if not rows:
+                self._size = 0
+                break
+            for cache_key, size in rows:
+                self._connection.execute("DELETE FROM completions WHERE cache_key=?", (cache_key,))
+                self._size -= size
+                self.evictions += 1
+                if self._size <= self.max_bytes:
+                    break
+
+    def to_json(self):
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size_bytes": self._size
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+# Turn on the process wide completion cache, the cache is opt in so the models only use it once this is called
+# Size and ttl default to COMPLETION_CACHE_MAX_MB and COMPLETION_CACHE_TTL from the environment
+def enableCompletionCache(cache_path=None):
+    global _completion_cache
+    with _completion_cache_lock:
+        if _completion_cache is None:
+            max_mb = os.getenv("COMPLETION_CACHE_MAX_MB", "")
+            ttl = os.getenv("COMPLETION_CACHE_TTL", "")
+            _completion_cache = completionCache(
+                cache_path,
+                max_bytes=(int(max_mb) if max_mb.isdigit() else COMPLETION_CACHE_MAX_MB) * 1024 * 1024,
+                ttl=int(ttl) if ttl.isdigit() else COMPLETION_CACHE_TTL)
+    return _completion_cache
+
+# The completion cache, None when it hasn't been enabled
+def getCompletionCache():
+    return _completion_cache
+
+def closeCompletionCache():
+    global _completion_cache
+    with _completion_cache_lock:
+        if _completion_cache is not None:
+            _completion_cache.close()
+            _completion_cache = None
+
+# Answer a request from the cache when it is enabled and has it, otherwise call generate and cache what comes back
+# Only completions that pass validate (when given) are cached, a cached one that doesn't is dropped and generated again,
+# so a malformed completion can't be replayed to every retry of the request
+def cachedCompletion(cache_key_parts, generate, validate=None):
+    cache = getCompletionCache()
+    if cache is None:
+        return generate()
+    cache_key = completionCache.buildKey(*cache_key_parts)
+    completion = cache.get(cache_key)
+    if completion is not None and validate is not None and not validate(completion):
+        cache.delete(cache_key)
+        completion = None
+    if completion is None:
+        completion = generate()
+        if validate is None or validate(completion):
+            cache.put(cache_key, completion)
+    return completion
+
+# The sqlite calls run in a thread so they don't hold up the other requests on the event loop
+async def cachedCompletionAsync(cache_key_parts, generate, validate=None):
+    cache = getCompletionCache()
+    if cache is None:
+        return await generate()
+    cache_key = completionCache.buildKey(*cache_key_parts)
+    completion = await asyncio.to_thread(cache.get, cache_key)
+    if completion is not None and validate is not None and not validate(completion):
+        await asyncio.to_thread(cache.delete, cache_key)
+        completion = None
+    if completion is None:
+        completion = await generate()
+        if validate is None or validate(completion):
+            await asyncio.to_thread(cache.put, cache_key, completion)
+    return completion
@@ -1,11 +1,26 @@
 import json
 import random
+import asyncio
 import traceback
 
 import lib.media as media
+from lib.prompt_template import renderTemplate, chainResolvers, promptListResolver, fieldResolver
 from lib.aoai_model import aoaiText
 from lib.ollama_model import ollamaText
+from lib.model_clients import runAsync
+from lib.schemas import parseCompletion, CRITIC_REVIEW_SCHEMA
 
+# Tones for count critic reviews of a media object, the first is the tone of the movie like a single review gets and
+# the rest are different tones from the tones template, repeating only once the template runs out of them
+def pickCriticTones(media_object, count):
+    object_prompt_list = media_object.object_prompt_list
+    tones = [object_prompt_list["tones"][0]] if object_prompt_list.get("tones") else []
+    all_tones = list(media_object._templates.getValues("tones"))
+    other_tones = [tone for tone in all_tones if tone not in tones]
+    tones += random.sample(other_tones, min(max(0, count - len(tones)), len(other_tones)))
+    while all_tones and len(tones) < count:
+        tones.append(random.choice(all_tones))
+    return tones[:count]
 
 # Class for a critic review
 class criticReview:
@@ -17,34 +32,26 @@ class criticReview:
         self.score = 0
         self.tone = ""
 
-    # Generate the prompt for the critic review based upon the media object info
-    def buildCriticPrompt(self):
+    # Generate the prompt for the critic review based upon the media object info, tone is the critic tone to ask for
+    # instead of the tone of the movie
+    def buildCriticPrompt(self, tone=None):
         prompt_file_path = self.media_object._prompt_file_path
         process = self.media_object._process
         verbose = self.media_object._verbose
         try:
-            with open(prompt_file_path) as prompt_file:
-                prompt_json=json.load(prompt_file)
+            prompt_json=self.media_object._templates.getPrompts()
         except IOError as e:
             process.outputMessage(f"Error opening prompt file. {prompt_file_path}. Check that it exists!", "error")
-            exit()
+            return False
         except Exception as e:
             process.outputMessage(f"An issue occurred building the object prompt: {e}", "error")
-            return False, "An error occurred."
+            return False
 
         self.system_prompt = random.choice(prompt_json["critic_system"])
         critic_prompt_json=random.choice(prompt_json["critic"])
-        start_index = critic_prompt_json.find("{")
-        while start_index != -1:
-            end_index = critic_prompt_json.find("}")
-            key = critic_prompt_json[start_index+1:end_index]
-            key_value = ""
-            try:
-                key_value = self.media_object.object_prompt_list[key][0] if key in self.media_object.object_prompt_list else self.media_object.__dict__[key]
-            except:
-                key_value = "NO VALUE"
-            critic_prompt_json = critic_prompt_json.replace("{"+key+"}", key_value,1)
-            start_index = critic_prompt_json.find("{")
+        # Fill in the {} values from object_prompt_list or the media object, whatever has it
+        resolver = chainResolvers(fieldResolver({"tones": tone}), promptListResolver(self.media_object.object_prompt_list), fieldResolver(self.media_object.__dict__))
+        critic_prompt_json = renderTemplate(critic_prompt_json, resolver)
         
         self.prompt=critic_prompt_json
         return True
@@ -62,37 +69,73 @@ class criticReview:
 
         text_model.user_prompt = self.prompt
         text_model.system_prompt = self.system_prompt
+        text_model.response_schema = CRITIC_REVIEW_SCHEMA
       
         # Send the prompt to the API
         try:
             #self.movie_prompt["prompt_temperature"] = round(random.uniform(0.6,1.1),2) # Generate a random movie prompt temperature for funsies
             completion = text_model.generateResponse()
         except Exception as e:
-            self._process.outputMessage(f"Error generating object : {e}", "error")
-            if self._verbose: 
-                self._process.outputMessage(traceback.format_exc(), "verbose")
+            process.outputMessage(f"Error generating critic review : {e}", "error")
+            if verbose: 
+                process.outputMessage(traceback.format_exc(), "verbose")
             return False
 
-        # Find the start and end index of the json object
+        return self.parseCriticCompletion(completion)
+
+    async def generateCriticReviewAsync(self):
+        process = self.media_object._process
+        verbose = self.media_object._verbose
+
+        if self.media_object.model_type == "azure_openai":
+            text_model = aoaiText()
+        else:
+            text_model = ollamaText()
+
+        text_model.user_prompt = self.prompt
+        text_model.system_prompt = self.system_prompt
+        text_model.response_schema = CRITIC_REVIEW_SCHEMA
+
         try:
+            completion = await text_model.generateResponseAsync()
+        except Exception as e:
+            process.outputMessage(f"Error generating critic review : {e}", "error")
+            if verbose:
+                process.outputMessage(traceback.format_exc(), "verbose")
+            return False
+
+        return self.parseCriticCompletion(completion)
+
+    # Generate several critic reviews at the same time on the shared event loop, so the async clients and their
+    # connections are reused across media objects. Returns a list of True/False per review
+    @staticmethod
+    def generateCriticReviews(critic_reviews):
+        if len(critic_reviews) == 1:
+            return [critic_reviews[0].generateCriticReview()]
+        async def generateAll():
+            return await asyncio.gather(*[critic_review.generateCriticReviewAsync() for critic_review in critic_reviews])
+        return runAsync(generateAll())
 
-            json_from_completion = process.extractJson(completion, "{", "}")
-
-            if json_from_completion["critic_score"] and json_from_completion["critic_review"]:
-                self.review = json_from_completion["critic_review"]
-                self.score = json_from_completion["critic_score"]
-                self.tone = json_from_completion["critic_tone"]
-                return True
-            else:
-                process.outputMessage(f"Error generating critic review, missing important details (score or review) in completion.","error")
-                return False
-            
+    # Parse the completion into the review, used for completions from generateCriticReview and from batch jobs
+    def parseCriticCompletion(self, completion):
+        process = self.media_object._process
+        # Parse the response and check it has the score and review
+        try:
+            json_from_completion = parseCompletion(completion, CRITIC_REVIEW_SCHEMA)
         except Exception as e:
             process.outputMessage(f"Error parsing review completion","error")
             process.outputMessage(completion,"info")
             process.outputMessage(e,"error")
-            traceback.print_exc()
             return False
+
+        self.useReviewJson(json_from_completion)
+        return True
+
+    # Fill in the review from a completion that matched CRITIC_REVIEW_SCHEMA
+    def useReviewJson(self, json_from_completion):
+        self.review = json_from_completion["critic_review"]
+        self.score = json_from_completion["critic_score"]
+        self.tone = json_from_completion.get("critic_tone", "")
         
     def to_json(self):
         return {
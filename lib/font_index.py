@@ -0,0 +1,96 @@
+from matplotlib import font_manager
+from fontTools.ttLib import TTFont, TTCollection
+import threading
+import json
+import os
+
+# Index of the system fonts by family name, so we don't have to open every font file for every poster
+# The font names are saved to disk keyed by the file path, mtime and size so the next run only reads new or changed files
+class fontIndex:
+    def __init__(self, index_path=None):
+        self.index_path = index_path if index_path else os.path.join(os.getcwd(), "outputs", "font_index.json")
+        self.files = {}
+        self.fonts = {}
+        self.font_names = []
+
+    # Load the saved index, scan the system fonts and only read the files that are new or have changed
+    def load(self):
+        saved_files = {}
+        try:
+            with open(self.index_path) as index_file:
+                saved_files = json.load(index_file)
+        except (IOError, ValueError):
+            pass
+
+        changed = False
+        files = {}
+        for font_file in font_manager.findSystemFonts(fontpaths=None, fontext='ttf'):
+            try:
+                stat = os.stat(font_file)
+            except OSError:
+                continue
+
+            saved = saved_files.get(font_file)
+            if saved and saved["mtime"] == stat.st_mtime and saved["size"] == stat.st_size:
+                files[font_file] = saved
+            else:
+                files[font_file] = {"mtime": stat.st_mtime, "size": stat.st_size, "names": self.readFontNames(font_file)}
+                changed = True
+
+        if changed or len(files) != len(saved_files):
+            self.save(files)
+
+        self.files = files
+        self.fonts = {}
+        for font_file, details in files.items():
+            for name in details["names"]:
+                # Keep the first file found for a name, same as the old search did
+                if name not in self.fonts:
+                    self.fonts[name] = font_file
+        self.font_names = list(self.fonts.keys())
+        return self
+
+    # Get the family names from a font file, a collection file can hold several fonts
+    def readFontNames(self, font_file):
+        try:
+            # Try to open as a single font file, lazy loading keeps the file open until it is closed
+            with TTFont(font_file, lazy=True) as font:
+                return [font['name'].getDebugName(1)]
+        except:
+            pass
+        try:
+            # If that fails, try to open as a font collection file
+            with TTCollection(font_file, lazy=True) as font_collection:
+                return [font['name'].getDebugName(1) for font in font_collection.fonts]
+        except:
+            return []
+
+    def save(self, files):
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as index_file:
+                json.dump(files, index_file)
+            os.replace(temp_path, self.index_path)
+        except OSError:
+            # Not being able to save the index only costs us a rescan next run
+            pass
+
+    # Get the path of a font by its family name, falling back to the default if we don't have it
+    def getFontPath(self, font_name, default="arial.ttf"):
+        return self.fonts.get(font_name, default)
+
+    def getFontNames(self):
+        return self.font_names
+
+_font_index = None
+_font_index_lock = threading.Lock()
+
+# Get the process wide font index, building it the first time it is needed
+def getFontIndex():
+    global _font_index
+    if _font_index is None:
+        with _font_index_lock:
+            if _font_index is None:
+                _font_index = fontIndex().load()
+    return _font_index
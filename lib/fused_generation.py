@@ -0,0 +1,108 @@
+import json
+import random
+import traceback
+
+import lib.media as media
+import lib.image as image
+from lib.image import getFontChoices
+from lib.critic_review import criticReview, pickCriticTones
+from lib.aoai_model import aoaiText
+from lib.ollama_model import ollamaText
+from lib.schemas import parseCompletion, FUSED_SCHEMA
+
+# Tokens for the movie and poster prompt in a fused completion, each review gets FUSED_REVIEW_TOKENS on top
+FUSED_BASE_TOKENS = 1000
+FUSED_REVIEW_TOKENS = 500
+
+# Fused mode, the movie, its critic reviews and the poster prompt come back from one structured request instead of a
+# request each, so the system prompts and movie details are only sent once. The media object ends up filled in the
+# same as the separate requests would leave it, the fused prompts are recorded where the separate ones would be
+class fusedGeneration:
+    def __init__(self, media_object: media, image_object: image, review_count=1, review_quorum=1):
+        self.media_object = media_object
+        self.image_object = image_object
+        self.review_count = max(1, review_count)
+        self.review_quorum = min(max(1, review_quorum), self.review_count)
+        self.system_prompt = ""
+        self.prompt = ""
+        self.tones = []
+
+    # Build the fused prompt, the movie details from the templates with the tone of each review and the fonts to pick from
+    def buildFusedPrompt(self):
+        media_object = self.media_object
+        process = media_object._process
+        try:
+            prompt_json = media_object._templates.getPrompts()
+            self.system_prompt = media_object.parseTemplate(random.choice(prompt_json["fused_system"]))
+            movie_prompt = media_object.parseTemplate(random.choice(prompt_json["fused"]))
+            # The first review is in the tone of the movie like a review on its own would be, the rest in other tones
+            self.tones = pickCriticTones(media_object, self.review_count)
+        except IOError as e:
+            process.outputMessage(f"Error opening prompt file. {media_object._prompt_file_path}. Check that it exists!", "error")
+            return False
+        except Exception as e:
+            process.outputMessage(f"An issue occurred building the fused prompt: {e}", "error")
+            return False
+
+        self.prompt = movie_prompt + "\nCritic Tones: " + json.dumps(self.tones) + "\nFonts:" + json.dumps(getFontChoices())
+
+        media_object.movie_prompt["movie_system"] = self.system_prompt
+        media_object.movie_prompt["movie"] = self.prompt
+        media_object.image_prompt["image_prompt_system"] = self.system_prompt
+        media_object.image_prompt["image_prompt"] = self.prompt
+        return True
+
+    # Most tokens the fused completion can need
+    def getMaxTokens(self):
+        return FUSED_BASE_TOKENS + FUSED_REVIEW_TOKENS * self.review_count
+
+    # Send the fused prompt for completion and fill in the media object
+    def generateFused(self):
+        media_object = self.media_object
+        process = media_object._process
+        if media_object.model_type == "azure_openai":
+            text_model = aoaiText()
+            text_model.max_tokens = self.getMaxTokens()
+        else:
+            text_model = ollamaText()
+
+        text_model.user_prompt = self.prompt
+        text_model.system_prompt = self.system_prompt
+        text_model.response_schema = FUSED_SCHEMA
+
+        try:
+            completion = text_model.generateResponse()
+        except Exception as e:
+            process.outputMessage(f"Error generating fused object : {e}", "error")
+            if media_object._verbose:
+                process.outputMessage(traceback.format_exc(), "verbose")
+            return False
+
+        return self.parseFusedCompletion(completion)
+
+    # Parse the completion into the media object, reviews and image prompt, used for completions from generateFused and from batch jobs
+    def parseFusedCompletion(self, completion):
+        media_object = self.media_object
+        process = media_object._process
+        try:
+            json_from_completion = parseCompletion(completion, FUSED_SCHEMA)
+        except Exception as e:
+            process.outputMessage(f"Error parsing fused completion","error")
+            process.outputMessage(completion,"info")
+            process.outputMessage(e,"error")
+            return False
+        # The model can come back with fewer reviews than asked for, the object is only kept with a quorum of them
+        if len(json_from_completion["reviews"]) < self.review_quorum:
+            process.outputMessage(f"Fused completion has {len(json_from_completion['reviews'])} critic reviews, needed {self.review_quorum}","error")
+            return False
+
+        media_object.useObjectJson(json_from_completion["movie"])
+        # Each review records the fused system prompt and the tone it was asked for as its prompt
+        for index, review_json in enumerate(json_from_completion["reviews"][:self.review_count]):
+            review = criticReview(media_object, media_object._verbose)
+            review.system_prompt = self.system_prompt
+            review.prompt = f"Critic Tone: '{self.tones[index] if index < len(self.tones) else review_json.get('critic_tone', '')}'"
+            review.useReviewJson(review_json)
+            media_object.reviews.append(review.to_json())
+        self.image_object.useImagePromptJson(json_from_completion["poster"])
+        return True
@@ -1,7 +1,4 @@
-from PIL import Image, ImageDraw, ImageFont
-from matplotlib import font_manager
-from fontTools.ttLib import TTFont, TTCollection
-import requests
+from PIL import Image
 from io import BytesIO
 import base64
 import traceback
@@ -10,8 +7,42 @@ import os
 import random
 
 import lib.media as media
+from lib.font_index import getFontIndex
+from lib.poster_render import renderPoster, getRenderPool
+from lib.prompt_template import renderTemplate, chainResolvers, promptListResolver, fieldResolver
 from lib.aoai_model import aoaiText, aoaiImage, aoaiVision
 from lib.ollama_model import ollamaText, ollamaImage, ollamaVision
+from lib.schemas import parseCompletion, IMAGE_PROMPT_SCHEMA, VISION_LAYOUT_SCHEMA
+
+# Longest side of the poster thumbnail sent to the vision model
+VISION_THUMBNAIL_SIZE = 768
+# Base64 is encoded in chunks of this many bytes, a multiple of 3 so the chunks join without padding
+BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+# Create a downscaled jpeg of the image for the vision model, returns the jpeg bytes as a memoryview
+def createThumbnail(image_buffer, size=VISION_THUMBNAIL_SIZE):
+    image_buffer.seek(0)
+    with Image.open(image_buffer) as img:
+        img.thumbnail((size, size))
+        thumbnail_buffer = BytesIO()
+        img.convert("RGB").save(thumbnail_buffer, "JPEG", quality=85)
+    image_buffer.seek(0)
+    return thumbnail_buffer.getbuffer()
+
+# Base64 encode the data a chunk at a time from a memoryview, so we never hold a second full copy of the raw bytes
+def encodeBase64(data, chunk_size=BASE64_CHUNK_SIZE):
+    view = memoryview(data)
+    return "".join(base64.b64encode(view[start:start + chunk_size]).decode("ascii") for start in range(0, len(view), chunk_size))
+
+# The font names the model picks the title font from, a random 50 from the font index
+def getFontChoices():
+    # Get a list of all font names from the font index
+    font_names = list(getFontIndex().getFontNames())
+
+    # trim the list to 50 random fonts
+    if len(font_names) > 50:
+        font_names = random.sample(font_names, 50)
+    return font_names
 
 # Class for the image object
 class image:
@@ -20,45 +51,25 @@ class image:
         self.poster_prompt = {}
         self.generated_image = 0
         self.completed_poster = 0
+        self.font_path = "arial.ttf"
 
-    # Generate the prompt for the image based upon the media object info
-    def generateImagePrompt(self):
+    # Build the prompt for the image based upon the media object info
+    def buildImagePrompt(self):
         prompt_file_path = self.media_object._prompt_file_path
         process = self.media_object._process
         verbose = self.media_object._verbose
-        # Get a list of all font files
-        font_files = font_manager.findSystemFonts(fontpaths=None, fontext='ttf')
-
-        # Get a list of all font names
-        font_names = []
-        for font_file in font_files:
-            try:
-                # Try to open as a single font file
-                font = TTFont(font_file)
-                font_names.append(font['name'].getDebugName(1))
-            except:
-                # If that fails, try to open as a font collection file
-                font_collection = TTCollection(font_file)
-                for font in font_collection.fonts:
-                    font_names.append(font['name'].getDebugName(1))
-
-        # trim the list to 25 random fonts
-        if len(font_names) > 50:
-            font_names = random.sample(font_names, 50)  
+        font_names = getFontChoices()
 
         # Send the description to the API
         try: 
-            prompt_file = open(prompt_file_path, 'r')
+            prompt_json=self.media_object._templates.getPrompts()
         except IOError as e:
-            process.outputMessage(f"Error opening {prompt_file}: {e}","error")
-            exit()
+            process.outputMessage(f"Error opening {prompt_file_path}: {e}","error")
+            return False
         except Exception as e:
             process.outputMessage(f"An error occurred: {e}","error")
             return False
 
-        with open(prompt_file_path) as prompt_file:
-            prompt_json=json.load(prompt_file)
-
         # Get system prompt for generating image prompt completion    
         self.media_object.image_prompt["image_prompt_system"] = random.choice(prompt_json["image_prompt_system"])
 
@@ -69,22 +80,18 @@ class image:
         pruned_media_object = {k: v for k, v in self.media_object.__dict__.items() if k in object_keys_keep}
 
         # Take a string and anywhere there is a {} replace it with the value from object_prompt_list or media_object, whatever has it
-        # TODO we do this logic multiple times so likely a better way to do this
-        start_index = prompt_image_json.find("{")
-        while start_index != -1:
-            end_index = prompt_image_json.find("}")
-            key = prompt_image_json[start_index+1:end_index]
-            key_value = ""
-            try:
-                key_value = object_prompt_list[key][0] if key in object_prompt_list else pruned_media_object[key]
-            except:
-                key_value = "NO VALUE"
-            prompt_image_json = prompt_image_json.replace("{"+key+"}", key_value,1)
-            start_index = prompt_image_json.find("{")
+        resolver = chainResolvers(promptListResolver(object_prompt_list), fieldResolver(pruned_media_object))
+        prompt_image_json = renderTemplate(prompt_image_json, resolver)
 
         self.media_object.image_prompt["image_prompt"] = prompt_image_json + "\nFonts:" + json.dumps(font_names)
 
-        if verbose: process.outputMessage(f"Prompt\n {self.media_object.image_prompt}","verbose")
+        if verbose: process.outputMessage(lambda: f"Prompt\n {self.media_object.image_prompt}","verbose")
+        return True
+
+    # Generate the prompt for the image and send it for completion
+    def generateImagePrompt(self):
+        if not self.buildImagePrompt():
+            return False
 
         # Create a text model object
         if self.media_object.model_type == "azure_openai":
@@ -94,28 +101,39 @@ class image:
         
         text_model.user_prompt = self.media_object.image_prompt["image_prompt"]
         text_model.system_prompt = self.media_object.image_prompt["image_prompt_system"]
+        text_model.response_schema = IMAGE_PROMPT_SCHEMA
 
         # Send the prompt to the API
         try:
             #self.movie_prompt["prompt_temperature"] = round(random.uniform(0.6,1.1),2) # Generate a random movie prompt temperature for funsies
             completion = text_model.generateResponse()
         except Exception as e:
-            self._process.outputMessage(f"Error generating object : {e}", "error")
-            if self._verbose: 
-                self._process.outputMessage(traceback.format_exc(), "verbose")
+            process = self.media_object._process
+            process.outputMessage(f"Error generating image prompt : {e}", "error")
+            if self.media_object._verbose: 
+                process.outputMessage(traceback.format_exc(), "verbose")
             return False
 
+        return self.parseImagePromptCompletion(completion)
+
+    # Parse the completion into the image prompt and font, used for completions from generateImagePrompt and from batch jobs
+    def parseImagePromptCompletion(self, completion):
+        process = self.media_object._process
         # Find the start and end index of the json object
         try:
-            json_from_completion = process.extractJson(completion, "{", "}")
-            self.media_object.image_prompt["image_prompt_completion"] = json_from_completion["image_prompt"]
-            self.media_object.image_prompt["font"] = json_from_completion["font"]
-            return True
+            json_from_completion = parseCompletion(completion, IMAGE_PROMPT_SCHEMA)
         except Exception as e:
             process.outputMessage(f"Error parsing image prompt completion","error")
             process.outputMessage(completion,"info")
             process.outputMessage(e,"error")
             return False
+        self.useImagePromptJson(json_from_completion)
+        return True
+
+    # Fill in the image prompt and font from a completion that matched IMAGE_PROMPT_SCHEMA
+    def useImagePromptJson(self, json_from_completion):
+        self.media_object.image_prompt["image_prompt_completion"] = json_from_completion["image_prompt"]
+        self.media_object.image_prompt["font"] = json_from_completion.get("font", "")
         
     # Generate the image using the prompt
     def generateImage(self):
@@ -129,64 +147,74 @@ class image:
 
         image_model.user_prompt = self.media_object.image_prompt["image_prompt_completion"]
 
-        retries=5
-        for _ in range(retries):
-            try:
-                self.generated_image = image_model.generateImage()
-                break
-            except Exception as e:
-                process.outputMessage(f"Attempt {_+1} of {retries} failed to generate image for '{self.media_object.title}'\n{e}.","warning")
-                continue
-        else:
-            process.outputMessage(f"Error generating image for '{self.media_object.title}' after {retries} attempts","error")
+        # The image model retries with backoff through its request governor, an error here means it gave up
+        try:
+            self.generated_image = image_model.generateImage()
+        except Exception as e:
+            process.outputMessage(f"Error generating image for '{self.media_object.title}'\n{e}.","error")
             return False
         
         return True
 
+    # Generate the images for several image objects in one batch request, falling back to generating
+    # an image on its own (retried by the request governor) for any that fail in the batch. Returns a list of True/False per image object
+    @staticmethod
+    def generateImageBatch(image_objects):
+        if not image_objects:
+            return []
+        if image_objects[0].media_object.model_type == "azure_openai":
+            image_model = aoaiImage()
+        else:
+            image_model = ollamaImage()
+
+        prompts = [image_object.media_object.image_prompt["image_prompt_completion"] for image_object in image_objects]
+        try:
+            batch_results = image_model.generateImages(prompts)
+        except Exception as e:
+            batch_results = [e] * len(image_objects)
+
+        results = []
+        for image_object, batch_result in zip(image_objects, batch_results):
+            if isinstance(batch_result, Exception):
+                process = image_object.media_object._process
+                process.outputMessage(f"Batch image generation failed for '{image_object.media_object.title}', retrying on its own\n{batch_result}.","warning")
+                results.append(image_object.generateImage())
+            else:
+                image_object.generated_image = batch_result
+                results.append(True)
+        return results
+
     # Add text to the image and resize
     def processImage(self):
+        return self.analyzeImage() and self.addTitle()
+
+    # Send the generated image to the vision model to find where and how the title should be placed
+    def analyzeImage(self):
         prompt_file_path = self.media_object._prompt_file_path
         process = self.media_object._process
         verbose = self.media_object._verbose
-        # Get a list of all font files
-        font_files = font_manager.findSystemFonts(fontpaths=None, fontext='ttf')
-
         # The name of the font you're looking for
         font_name_to_find = self.media_object.image_prompt["font"]
         
-        # Start with arial as the default font
-        font_path="arial.ttf"
-
-        # Get the path of the font
-        for font_file in font_files:
-            try:
-                # Try to open as a single font file
-                font = TTFont(font_file)
-                if font['name'].getDebugName(1) == font_name_to_find:
-                    font_path = font_file
-                    break
-                
-            except:
-                # If that fails, try to open as a font collection file
-                font_collection = TTCollection(font_file)
-                for font in font_collection.fonts:
-                    if font['name'].getDebugName(1) == font_name_to_find:
-                        font_path = font_file
-                        break
+        # Get the path of the font, starting with arial as the default font
+        font_path = getFontIndex().getFontPath(font_name_to_find, "arial.ttf")
+        self.font_path = font_path
                 
-        # Open prompt file and parse the prompt
-        with open(prompt_file_path) as json_file:
-            prompt_json=json.load(json_file)
+        # Get the parsed prompts
+        prompt_json=self.media_object._templates.getPrompts()
         
-        # Making this less dynamic to keep myself sane
-        prompt = random.choice(prompt_json["vision"])
-        prompt = prompt.replace("{title}", self.media_object.title)
-        prompt = prompt.replace("{font}", self.media_object.image_prompt["font"] if self.media_object.image_prompt["font"] != "" else font_path.replace(".ttf", ""))
+        # Fill in the title and font for the vision prompt
+        prompt_fields = {
+            "title": self.media_object.title,
+            "font": self.media_object.image_prompt["font"] if self.media_object.image_prompt["font"] != "" else font_path.replace(".ttf", "")
+        }
+        prompt = renderTemplate(random.choice(prompt_json["vision"]), chainResolvers(fieldResolver(prompt_fields)))
         self.media_object.vision_prompt["vision"] = prompt
         self.media_object.vision_prompt["vision_system"] = random.choice(prompt_json["vision_system"])
   
-        mime_type = "image/png"
-        base64_encoded_data = base64.b64encode(self.generated_image.read()).decode('utf-8')
+        # The vision model gets a downscaled jpeg of the poster, it only needs to see the layout not every pixel
+        mime_type = "image/jpeg"
+        base64_encoded_data = encodeBase64(createThumbnail(self.generated_image))
 
         if self.media_object.model_type == "azure_openai":
             vision_model = aoaiVision()
@@ -197,6 +225,7 @@ class image:
         vision_model.mime_type = mime_type
         vision_model.user_prompt = self.media_object.vision_prompt["vision"]
         vision_model.system_prompt = self.media_object.vision_prompt["vision_system"]
+        vision_model.response_schema = VISION_LAYOUT_SCHEMA
         try:
 
             vision_completion = vision_model.generateResponse()
@@ -206,9 +235,9 @@ class image:
             if verbose: 
                 process.outputMessage(traceback.format_exc(), "verbose")
             return False
-        # Find the start and end index of the json object for the vision completion
+        # Parse the vision completion, anything it left out or got wrong keeps the default layout
         try:
-            json_from_vision_completion = process.extractJson(vision_completion, "{", "}")
+            json_from_vision_completion = parseCompletion(vision_completion, VISION_LAYOUT_SCHEMA)
         except Exception as e:
             process.outputMessage(f"Error parsing vision prompt completion","error")
             if verbose:
@@ -225,72 +254,39 @@ class image:
         if "has_text" in json_from_vision_completion:
             self.media_object.vision_prompt["has_text"] = json_from_vision_completion["has_text"]
 
-        # Open the image file for manipulation
-        with Image.open(self.generated_image) as img:
-
-            draw = ImageDraw.Draw(img)
-            
-            # Check if the poster has text and if it doesnt, title it.
-            if self.media_object.vision_prompt["has_text"] == False:
-
-                img_w, img_h = img.size
-                fontsize = 1  # starting font size
-                font = ImageFont.truetype(font_path, fontsize)
-                # Find font size to fit the text based upon fraction of the image width and biggest string section
-                scale=.85
+        return True
 
-                text_string = self.media_object.title
+    # Add the title to the generated image based upon the vision model layout, completed_poster is the encoded jpeg
+    # Rendered in the poster render process pool when it is started, otherwise in this thread
+    def addTitle(self):
+        vision_prompt = self.media_object.vision_prompt
 
+        # A bad font or image, or a render process that died (BrokenProcessPool), fails this poster instead of the stage
+        try:
+            self.generated_image.seek(0)
+            render_args = (
+                self.generated_image.read(),
+                self.media_object.title,
+                self.font_path,
+                vision_prompt["location"],
+                vision_prompt["location_padding"],
+                vision_prompt["font_color"],
+                vision_prompt["has_text"],
                 # Randomly choose to uppercase the text
-                uppercase_chance = random.randint(1, 10)
-                if uppercase_chance == 1:
-                    text_string = text_string.upper()
-
-                # split the string on a delimeter into a list and find the biggest portion, keep the delimiter
-                delimiter = ":"
-                text_list = text_string.split(delimiter)
-                # If the count of the delimiter in the string is 1 then add the delimtier back to the string
-                if text_string.count(delimiter) == 1:
-                    text_list[0] += delimiter
-                max_text = max(text_list, key=len)
-
-                while font.getlength(max_text) < scale*img_w:
-                    # iterate until the text size is just larger than the criteria
-                    fontsize += 1
-                    font = ImageFont.truetype(font_path, fontsize)
-                
-                # Decrement to be sure it is less than criteria and styled
-                fontsize -= 1
-                font = ImageFont.truetype(font_path, fontsize)
-                
-                # The height of the font is the delta of its ascent and descent
-                ascent, descent = font.getmetrics()
-                font_height = ascent - descent
-                section_top =  self.media_object.vision_prompt["location_padding"]
-                section_middle = (img_h / 2) - (font_height * len(text_list) + (20 * len(text_list))) # Center of the image but offset by font, line count and general padding
-                section_bottom = img_h - (img_h / 8)
-                section_bottom = section_bottom - font_height if len(text_list) > 1 else section_bottom # shave off one font height if there are two lines of text
-                y_placements = {"top": section_top, "middle": section_middle, "bottom": section_bottom}
-                w = font.getlength(max_text)
-                w_placement=(img_w-w)/2
-                line_count = 1
-                for text_line in text_list:
-                    # remove proceeding and trailing spaces
-                    text_line = text_line.strip()
-                
-                    # Get the starting location for the text based upon the layout
-                    y_location = self.media_object.vision_prompt["location"]
-                    if line_count == 1:
-                        y_placement = y_placements[y_location]
-                    else:
-                        y_placement = y_placements[y_location] + (font_height * (line_count - 1)) + (font_height * .70) 
-                    font_color = self.media_object.vision_prompt["font_color"]
-                    stroke_color = "#111111" if font_color > "#999999" else "#DDDDDD"
-                    # put the text on the image
-                    draw.text((w_placement, y_placement), text_line, fill=font_color, font=font, stroke_width=1, stroke_fill=stroke_color, align='center') 
-                    line_count += 1
-
-        self.completed_poster = img
+                random.randint(1, 10) == 1
+            )
+
+            render_pool = getRenderPool()
+            if render_pool is not None:
+                self.completed_poster = render_pool.submit(renderPoster, *render_args).result()
+            else:
+                self.completed_poster = renderPoster(*render_args)
+        except Exception as e:
+            process = self.media_object._process
+            process.outputMessage(f"Error adding title to poster for '{self.media_object.title}': {e}", "error")
+            if self.media_object._verbose:
+                process.outputMessage(traceback.format_exc(), "verbose")
+            return False
         return True
     
     # Save the image to the images directory
@@ -300,7 +296,8 @@ class image:
         image_dir = os.path.dirname(image_path) 
         if process.createDirectory(image_dir):
             try:
-                self.completed_poster.save(image_path, 'JPEG', quality=75)
+                with open(image_path, "wb") as image_file:
+                    image_file.write(self.completed_poster)
                 return image_path
             except Exception as e:
                 process.outputMessage(f"Error saving image: {e}","error")
@@ -0,0 +1,118 @@
+import threading
+import sqlite3
+import shutil
+import json
+import time
+import os
+
+# Stages recorded for each media object in the order they complete, a resumed object picks up after its last stage
+LEDGER_STAGES = ["prompt", "completion", "review", "image_prompt", "image", "poster"]
+# Objects that have failed this many times aren't resumed again
+MAX_ATTEMPTS = 3
+
+# Durable record of each media object and the results of each stage, kept in sqlite under outputs so a crashed or
+# killed run can be resumed from the last completed stage instead of paying for the model calls again
+class jobLedger:
+    def __init__(self, ledger_path=None):
+        self.ledger_path = ledger_path if ledger_path else os.path.join(os.getcwd(), "outputs", "job_ledger.db")
+        self.images_dir = os.path.join(os.path.dirname(self.ledger_path), "ledger_images")
+        os.makedirs(self.images_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.ledger_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                process_id TEXT PRIMARY KEY,
+                stage TEXT,
+                status TEXT,
+                attempts INTEGER DEFAULT 0,
+                state TEXT,
+                image_path TEXT,
+                updated REAL
+            )
+        """)
+        self._connection.commit()
+
+    def _execute(self, query, params=()):
+        with self._lock:
+            self._connection.execute(query, params)
+            self._connection.commit()
+
+    # Record the start of an attempt at a media object
+    def startJob(self, process_id):
+        self._execute("""
+            INSERT INTO jobs (process_id, status, attempts, updated) VALUES (?, 'running', 1, ?)
+            ON CONFLICT(process_id) DO UPDATE SET status='running', attempts=attempts+1, updated=excluded.updated
+        """, (process_id, time.time()))
+
+    # Record a completed stage along with the media object state at that point
+    def recordStage(self, process_id, stage, media_object):
+        self._execute("UPDATE jobs SET stage=?, state=?, updated=? WHERE process_id=?",
+            (stage, json.dumps(media_object.to_state()), time.time(), process_id))
+
+    # Save the raw generated image so a resumed object doesn't have to generate it again, the buffer is rewound after
+    def recordImage(self, process_id, image_buffer, media_object):
+        image_path = os.path.join(self.images_dir, f"{process_id}.png")
+        image_buffer.seek(0)
+        with open(image_path, "wb") as image_file:
+            shutil.copyfileobj(image_buffer, image_file)
+        image_buffer.seek(0)
+        self._execute("UPDATE jobs SET stage='image', state=?, image_path=?, updated=? WHERE process_id=?",
+            (json.dumps(media_object.to_state()), image_path, time.time(), process_id))
+
+    # Remove the raw image saved for the media object, once it won't be resumed it isn't needed
+    def removeImage(self, process_id):
+        with self._lock:
+            row = self._connection.execute("SELECT image_path FROM jobs WHERE process_id=?", (process_id,)).fetchone()
+        if row and row[0]:
+            try:
+                os.remove(row[0])
+            except OSError:
+                pass
+        self._execute("UPDATE jobs SET image_path=NULL WHERE process_id=?", (process_id,))
+
+    # Record how the media object finished, the raw image is removed once the poster is saved or the object has used
+    # up its attempts, so ledger_images only holds images of objects that can still be resumed
+    def finishJob(self, process_id, result):
+        if result == "success":
+            self.removeImage(process_id)
+            self._execute("UPDATE jobs SET stage='poster', status='done', updated=? WHERE process_id=?", (time.time(), process_id))
+        elif result == "cancelled":
+            # Cancelled objects didn't fail so the attempt doesn't count, a later run can resume them
+            self._execute("UPDATE jobs SET status='cancelled', attempts=MAX(attempts-1, 0), updated=? WHERE process_id=?", (time.time(), process_id))
+        else:
+            self._execute("UPDATE jobs SET status='failed', updated=? WHERE process_id=?", (time.time(), process_id))
+            with self._lock:
+                row = self._connection.execute("SELECT attempts FROM jobs WHERE process_id=?", (process_id,)).fetchone()
+            if row and row[0] >= MAX_ATTEMPTS:
+                self.removeImage(process_id)
+
+    # Get the media objects that didn't finish (crashed, killed or failed) and still have attempts left, oldest first
+    def getResumableJobs(self, limit):
+        with self._lock:
+            rows = self._connection.execute("""
+                SELECT process_id, stage, state, image_path FROM jobs
+                WHERE status != 'done' AND attempts < ? ORDER BY updated LIMIT ?
+            """, (MAX_ATTEMPTS, limit)).fetchall()
+        return [ledgerEntry(process_id, stage, json.loads(state) if state else None, image_path) for process_id, stage, state, image_path in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+# What the ledger knows about a media object being resumed
+class ledgerEntry:
+    def __init__(self, process_id, stage, state, image_path):
+        self.process_id = process_id
+        self.stage = stage
+        self.state = state
+        self.image_path = image_path if image_path and os.path.exists(image_path) else None
+
+    # Whether the stage was completed in an earlier attempt, the image stage also needs its saved image to still be there
+    def hasCompleted(self, stage):
+        if self.stage is None or self.state is None:
+            return False
+        if stage == "image" and self.image_path is None:
+            return False
+        return LEDGER_STAGES.index(self.stage) >= LEDGER_STAGES.index(stage)
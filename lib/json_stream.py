@@ -0,0 +1,110 @@
+import json
+import re
+
+# Incremental scanner for the first top level json object in a completion, fed a chunk at a time as the completion
+# streams in. Tracks the nesting outside of json strings so braces inside values like a description don't count, and
+# reports as soon as the object closes so the rest of the stream can be cancelled. Objects that close but don't parse
+# (like a {placeholder} in the text before the real object) are skipped
+class jsonStreamScanner:
+    def __init__(self, start="{", end="}"):
+        self.start = start
+        self.end = end
+        self.start_index = -1
+        self.end_index = -1
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        # Start and end of the first closed object even if it wasn't json, the best guess when nothing parses
+        self.first_candidate = None
+        self._parts = []
+        self._length = 0
+        # Only these characters change the state, everything between them is skipped over
+        self._special = re.compile("[" + re.escape(start + end + '"\\') + "]")
+
+    # Add the next chunk of the completion, returns True once the object is complete
+    def feed(self, chunk):
+        if self.end_index >= 0:
+            return True
+        offset = self._length
+        self._parts.append(chunk)
+        self._length += len(chunk)
+
+        position = 0
+        if self.escaped:
+            # The escape was the last character of the previous chunk, skip what it escaped
+            self.escaped = False
+            position = 1
+
+        while True:
+            if self.start_index < 0:
+                position = chunk.find(self.start, position)
+                if position < 0:
+                    return False
+                self.start_index = offset + position
+                self.depth = 1
+                position += 1
+                continue
+
+            match = self._special.search(chunk, position)
+            if match is None:
+                return False
+            char = match.group()
+            position = match.end()
+            if self.in_string:
+                if char == "\\":
+                    if position >= len(chunk):
+                        self.escaped = True
+                        return False
+                    position += 1
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == self.start:
+                self.depth += 1
+            elif char == self.end:
+                self.depth -= 1
+                if self.depth == 0:
+                    end_index = offset + match.start()
+                    if self.first_candidate is None:
+                        self.first_candidate = (self.start_index, end_index)
+                    if self.isJson(self.start_index, end_index):
+                        self.end_index = end_index
+                        return True
+                    # Not json (like a {placeholder} in the text before the object), look for the next one after it
+                    self.start_index = -1
+
+    # Whether the text between the indexes parses, control characters like raw newlines are allowed in the strings
+    def isJson(self, start_index, end_index):
+        try:
+            json.loads(self.text[start_index:end_index + 1], strict=False)
+            return True
+        except ValueError:
+            return False
+
+    def isComplete(self):
+        return self.end_index >= 0
+
+    # Everything fed so far
+    @property
+    def text(self):
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    # The json object text. When no object parsed it is the first closed one, or what has been seen of an object that
+    # never closed, or "" when there was no object at all
+    def getJson(self):
+        if self.end_index >= 0:
+            return self.text[self.start_index:self.end_index + 1]
+        if self.first_candidate is not None:
+            return self.text[self.first_candidate[0]:self.first_candidate[1] + 1]
+        if self.start_index >= 0:
+            return self.text[self.start_index:]
+        return ""
+
+# Find the first top level json object in the text
+def findJson(text, start="{", end="}"):
+    scanner = jsonStreamScanner(start, end)
+    scanner.feed(text)
+    return scanner.getJson()
@@ -5,8 +5,11 @@ import os
 import traceback
 
 from lib.process_helper import processHelper
+from lib.template_store import getTemplateStore
+from lib.prompt_template import renderTemplate, templateValueResolver
 from lib.aoai_model import aoaiText
 from lib.ollama_model import ollamaText
+from lib.schemas import parseCompletion, MOVIE_SCHEMA
 
 
 
@@ -47,6 +50,7 @@ class media:
         self._process = process
         self._prompt_file_path = prompt_file_path
         self._templates_base = templates_base
+        self._templates = getTemplateStore(templates_base)
         self._verbose = verbose
         self._object_path = ""
 
@@ -72,52 +76,59 @@ class media:
             "create_time": self.create_time.strftime("%Y-%m-%d %H:%M:%S")
         }
 
-    # Simply grabs a random value from the template file provided
+    # Everything needed to pick the media object back up later (e.g. resuming from the job ledger)
+    def to_state(self):
+        state = self.to_json()
+        state["mpaa_rating_content"] = getattr(self, "mpaa_rating_content", "")
+        state["model_type"] = self.model_type
+        return state
+
+    # Restore the media object from a saved state, the inverse of to_state
+    def restoreState(self, state):
+        for key in ["media_id", "title", "tagline", "mpaa_rating", "mpaa_rating_content", "description", "popularity_score", "genre",
+                    "reviews", "movie_prompt", "image_prompt", "vision_prompt", "prompts_temperature", "model_type"]:
+            if key in state:
+                setattr(self, key, state[key])
+        self.object_prompt_list = state.get("prompt_value_list", {})
+        self.create_time = datetime.datetime.strptime(state["create_time"], "%Y-%m-%d %H:%M:%S") if "create_time" in state else self.create_time
+
+    # Simply grabs a random value from the template provided
     def getTemplateValue(self, template):
+        template_path = os.path.join(self._templates_base, f"{template}.json")
         try:
-            template_path = os.path.join(self._templates_base, f"{template}.json")
-            with open(template_path) as json_file:
-                return random.choice(json.load(json_file)[template])
+            return self._templates.getRandomValue(template)
         except IOError as e:
             self._process.outputMessage(f"Error opening template file {template_path}: {e}", "error")
-            exit()
+            return False
         except Exception as e:
             self._process.outputMessage(f"An error occurred for {template_path}: {e}", "error")
             return False
 
     # Parses the prompt template and replaces the values with the random values from the template file
     def parseTemplate(self, template):
-        start_index = template.find("{")
-        while start_index != -1:
-            end_index = template.find("}")
-            text = template[start_index+1:end_index]
-            replace_value=self.getTemplateValue(text)
-            template = template.replace("{"+text+"}", replace_value,1)
-            if text not in self.object_prompt_list:
-                self.object_prompt_list[text] = []
-            self.object_prompt_list[text].append(replace_value)
-            start_index = template.find("{")
-        return template
+        template_resolver = templateValueResolver(self.getTemplateValue, self.object_prompt_list)
+        def resolve(key):
+            value = template_resolver(key)
+            if value is None:
+                raise ValueError(f"No template value found for {{{key}}}")
+            return value
+        return renderTemplate(template, resolve)
     
     # Builds the prompt from the prompt template selected
     def generateObjectPrompt(self):
         prompt_file_path = self._prompt_file_path
         try:
-            with open(prompt_file_path) as prompt_file:
-                prompts_json=json.load(prompt_file)
+            prompts_json=self._templates.getPrompts()
 
             self.movie_prompt["movie_system"] = self.parseTemplate(random.choice(prompts_json["movie_system"]))
             self.movie_prompt["movie"]=self.parseTemplate(random.choice(prompts_json["movie"]))
             return True
         except IOError as e:
             self._process.outputMessage(f"Error opening prompt file. {prompt_file_path}. Check that it exists!", "error")
-            exit()
+            return False
         except Exception as e:
             self._process.outputMessage(f"An issue occurred building the object prompt: {e}", "error")
-            return False, "An error occurred."
-        except:
-            self._process.outputMessage(f"Error opening prompt file. {prompt_file_path}. Check that it exists!","error")
-            exit(1)
+            return False
 
     # Submits the prompt to the API and returns the response as a formatted json object
     def generateObject(self):
@@ -130,6 +141,7 @@ class media:
 
         text_model.user_prompt = self.movie_prompt["movie"]
         text_model.system_prompt = self.movie_prompt["movie_system"]
+        text_model.response_schema = MOVIE_SCHEMA
       
         # Send the prompt to the API
         try:
@@ -141,31 +153,33 @@ class media:
                 self._process.outputMessage(traceback.format_exc(), "verbose")
             return False
 
-        # Parse the response and return the formatted json object
-        # Find the start and end index of the json object
+        return self.parseObjectCompletion(completion)
+
+    # Parse the completion into the media object, used for completions from generateObject and from batch jobs
+    def parseObjectCompletion(self, completion):
+        # Parse the response and check it has what we need, the title, tagline and description, before using it
         try:
-            json_from_completion = self._process.extractJson(completion, "{", "}")
-            
-            # We need to check if the title, tagline and description exists in the completion, if not we cant use the completion for later purposes
-            if "title" in json_from_completion and "tagline" in json_from_completion and "description" in json_from_completion:
-                self.media_id = self._process.process_id
-                self.title = json_from_completion["title"]
-                self.tagline = json_from_completion["tagline"]
-                self.mpaa_rating = json_from_completion["mpaa_rating"] if "mpaa_rating" in json_from_completion else "NR"
-                self.mpaa_rating_content = json_from_completion["rating_content"] if "rating_content" in json_from_completion else "NO RATING CONTENT"
-                self.genre = self.object_prompt_list["genres"][0] if "genres" in self.object_prompt_list else "NO GENRE"
-                self.description = json_from_completion["description"]
-                self.poster_url = "movie_poster_url.jpeg"
-                return True
-            else:
-                self._process.outputMessage(f"Error generating object, missing important details (title, tagline or description) in completion.","error")
-                return False
+            json_from_completion = parseCompletion(completion, MOVIE_SCHEMA)
         except Exception as e:
             self._process.outputMessage(f"Error parsing object completion","error")
             self._process.outputMessage(completion,"info")
             self._process.outputMessage(e,"error")
             return False
 
+        self.useObjectJson(json_from_completion)
+        return True
+
+    # Fill in the media object from a completion that matched MOVIE_SCHEMA
+    def useObjectJson(self, json_from_completion):
+        self.media_id = self._process.process_id
+        self.title = json_from_completion["title"]
+        self.tagline = json_from_completion["tagline"]
+        self.mpaa_rating = json_from_completion.get("mpaa_rating", "NR")
+        self.mpaa_rating_content = json_from_completion.get("rating_content", "NO RATING CONTENT")
+        self.genre = self.object_prompt_list["genres"][0] if "genres" in self.object_prompt_list else "NO GENRE"
+        self.description = json_from_completion["description"]
+        self.poster_url = "movie_poster_url.jpeg"
+
     # Save the media object to a json file
     def saveMediaObject(self):
         object_path = self._process.getOutputPath("json", "json")
@@ -0,0 +1,250 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+import threading
+import logging
+import bisect
+import json
+import time
+import os
+
+# Upper bounds in seconds of the latency histogram buckets, from a template render up to a slow image generation
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+# Prefix of the metric names in the Prometheus output
+METRICS_PREFIX = "media_generator"
+# Quantiles reported for each histogram
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+
+logger = logging.getLogger(__name__)
+
+# Latency histogram with fixed buckets, so it stays the same size however many values go in. Quantiles are estimated
+# by interpolating within the bucket they fall in, the same as Prometheus histogram_quantile. Not thread safe on its
+# own, the registry holds its lock around it
+class latencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - cumulative) / count)
+            cumulative += count
+        return self.max
+
+    def to_json(self):
+        summary = {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "mean": round(self.sum / self.count, 4) if self.count else None,
+            "max": round(self.max, 4)
+        }
+        for q in METRICS_QUANTILES:
+            value = self.quantile(q)
+            summary[f"p{int(q * 100)}"] = round(value, 4) if value is not None else None
+        return summary
+
+    # Prometheus histogram lines, labels is the label text without the braces
+    def prometheusLines(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Process wide metrics for a run: how long each stage of a media object takes, how long each backend takes to answer,
+# the tokens, requests and errors per backend and how the media objects turned out
+class metricsRegistry:
+    def __init__(self):
+        self.start_time = time.time()
+        self.stage_seconds = {}
+        self.request_seconds = {}
+        self.tokens = {}
+        self.requests = {}
+        self.errors = {}
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def observeStage(self, stage, seconds):
+        with self._lock:
+            self.stage_seconds.setdefault(stage, latencyHistogram()).observe(seconds)
+
+    # Time the block as a stage, it is recorded even when the block fails
+    @contextmanager
+    def timeStage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observeStage(stage, time.perf_counter() - start)
+
+    # A request answered by a backend, with how long it took and the tokens it used
+    def recordRequest(self, backend, seconds, tokens=0):
+        with self._lock:
+            self.request_seconds.setdefault(backend, latencyHistogram()).observe(seconds)
+            self.requests[backend] = self.requests.get(backend, 0) + 1
+            self.tokens[backend] = self.tokens.get(backend, 0) + (tokens or 0)
+
+    # A failed request, kind is throttled, transient or error
+    def recordError(self, backend, kind):
+        with self._lock:
+            self.errors[(backend, kind)] = self.errors.get((backend, kind), 0) + 1
+
+    # How a media object finished, e.g. success or the stage it failed at
+    def recordResult(self, result):
+        with self._lock:
+            self.results[result] = self.results.get(result, 0) + 1
+
+    def to_json(self):
+        with self._lock:
+            elapsed = time.time() - self.start_time
+            successes = self.results.get("success", 0)
+            backends = {}
+            # Backends that only ever failed have errors but no requests or latency
+            for backend in list(self.requests) + [backend for backend, _ in self.errors]:
+                latency = self.request_seconds.get(backend)
+                backends[backend] = {
+                    "requests": self.requests.get(backend, 0),
+                    "tokens": self.tokens.get(backend, 0),
+                    "errors": {kind: count for (error_backend, kind), count in self.errors.items() if error_backend == backend},
+                    "latency": latency.to_json() if latency is not None else None
+                }
+            return {
+                "uptime_seconds": round(elapsed, 1),
+                "objects": dict(self.results),
+                "objects_per_minute": round(successes * 60 / elapsed, 3) if elapsed > 0 else 0,
+                "stages": {stage: histogram.to_json() for stage, histogram in self.stage_seconds.items()},
+                "backends": backends
+            }
+
+    # The metrics in the Prometheus text exposition format
+    def to_prometheus(self):
+        lines = []
+        def header(name, metric_type, help_text):
+            lines.append(f"# HELP {METRICS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} {metric_type}")
+
+        with self._lock:
+            header("stage_seconds", "histogram", "Time spent in each stage of a media object")
+            for stage, histogram in self.stage_seconds.items():
+                lines.extend(histogram.prometheusLines(f"{METRICS_PREFIX}_stage_seconds", f'stage="{escapeLabel(stage)}"'))
+            header("request_seconds", "histogram", "Time a backend took to answer a request, retries are separate requests")
+            for backend, histogram in self.request_seconds.items():
+                lines.extend(histogram.prometheusLines(f"{METRICS_PREFIX}_request_seconds", f'backend="{escapeLabel(backend)}"'))
+            header("requests_total", "counter", "Requests answered by each backend")
+            for backend, count in self.requests.items():
+                lines.append(f'{METRICS_PREFIX}_requests_total{{backend="{escapeLabel(backend)}"}} {count}')
+            header("tokens_total", "counter", "Tokens used by the requests to each backend")
+            for backend, count in self.tokens.items():
+                lines.append(f'{METRICS_PREFIX}_tokens_total{{backend="{escapeLabel(backend)}"}} {count}')
+            header("request_errors_total", "counter", "Failed requests to each backend by kind of error")
+            for (backend, kind), count in self.errors.items():
+                lines.append(f'{METRICS_PREFIX}_request_errors_total{{backend="{escapeLabel(backend)}",kind="{escapeLabel(kind)}"}} {count}')
+            header("objects_total", "counter", "Media objects finished by result")
+            for result, count in self.results.items():
+                lines.append(f'{METRICS_PREFIX}_objects_total{{result="{escapeLabel(result)}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+_metrics = metricsRegistry()
+_metrics_server = None
+_metrics_snapshots = None
+_metrics_lock = threading.Lock()
+
+def getMetrics():
+    return _metrics
+
+# Serves /metrics in the Prometheus format and /metrics.json as the json snapshot
+class metricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            self.sendBody(getMetrics().to_prometheus(), "text/plain; version=0.0.4")
+        elif path == "/metrics.json":
+            self.sendBody(json.dumps(getMetrics().to_json()), "application/json")
+        else:
+            self.send_error(404)
+
+    def sendBody(self, body, content_type):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes every few seconds would drown out the run log
+    def log_message(self, format, *args):
+        pass
+
+# Start the metrics endpoint on the port, listening on METRICS_HOST (localhost unless set) so Prometheus can scrape it
+def startMetricsServer(port, host=None):
+    global _metrics_server
+    with _metrics_lock:
+        if _metrics_server is None:
+            _metrics_server = ThreadingHTTPServer((host or os.getenv("METRICS_HOST", "127.0.0.1"), port), metricsRequestHandler)
+            _metrics_server.daemon_threads = True
+            threading.Thread(target=_metrics_server.serve_forever, daemon=True, name="metrics-server").start()
+    return _metrics_server
+
+# Write the json snapshot to the path, through a temp file so a reader never sees half of it
+def writeMetricsSnapshot(snapshot_path):
+    temp_path = f"{snapshot_path}.tmp"
+    with open(temp_path, "w") as snapshot_file:
+        json.dump(getMetrics().to_json(), snapshot_file, indent=4)
+    os.replace(temp_path, snapshot_path)
+
+# Write the json snapshot every interval seconds until the metrics are stopped
+def startMetricsSnapshots(interval, snapshot_path=None):
+    global _metrics_snapshots
+    snapshot_path = snapshot_path if snapshot_path else os.path.join(os.getcwd(), "outputs", "metrics.json")
+    with _metrics_lock:
+        if _metrics_snapshots is None:
+            stop = threading.Event()
+            def writeSnapshots():
+                while not stop.wait(interval):
+                    try:
+                        writeMetricsSnapshot(snapshot_path)
+                    except Exception as e:
+                        logger.warning(f"Error writing the metrics snapshot {snapshot_path}: {e}")
+            _metrics_snapshots = (stop, snapshot_path)
+            threading.Thread(target=writeSnapshots, daemon=True, name="metrics-snapshots").start()
+    return snapshot_path
+
+# Stop the endpoint and snapshots, the snapshot is written one last time so it has the whole run
+def stopMetrics():
+    global _metrics_server, _metrics_snapshots
+    with _metrics_lock:
+        if _metrics_snapshots is not None:
+            stop, snapshot_path = _metrics_snapshots
+            stop.set()
+            try:
+                writeMetricsSnapshot(snapshot_path)
+            except Exception as e:
+                logger.warning(f"Error writing the metrics snapshot {snapshot_path}: {e}")
+            _metrics_snapshots = None
+        if _metrics_server is not None:
+            _metrics_server.shutdown()
+            _metrics_server.server_close()
+            _metrics_server = None
@@ -0,0 +1,197 @@
+from openai import AzureOpenAI, AsyncAzureOpenAI
+from requests.adapters import HTTPAdapter
+from tempfile import SpooledTemporaryFile
+import threading
+import asyncio
+import requests
+import ollama
+import shutil
+import httpx
+import os
+
+# Process wide registry of model clients, so every request reuses one long lived client (and its keep alive
+# connection pool) per endpoint instead of paying for client setup and a new HTTPS connection each time.
+# The underlying httpx clients and requests sessions are safe to share across the pipeline worker threads.
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Max connections kept open per endpoint, should be at least the number of workers hitting that endpoint
+def getPoolSize():
+    pool_size = os.getenv("MODEL_CONNECTION_POOL_SIZE", "")
+    return int(pool_size) if pool_size.isdigit() and int(pool_size) > 0 else 50
+
+def _getClient(client_key, create):
+    client = _clients.get(client_key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(client_key)
+            if client is None:
+                client = _clients[client_key] = create()
+    return client
+
+# Get the shared Azure OpenAI client for an endpoint, retries are left to the request governor so they aren't stacked
+def getAzureClient(endpoint, key, api_version):
+    def create():
+        pool_size = getPoolSize()
+        return AzureOpenAI(
+            api_key=key,
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            max_retries=0,
+            http_client=httpx.Client(limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+        )
+    return _getClient(("azure_openai", endpoint, api_version, key), create)
+
+# Get the shared ollama client, host defaults to OLLAMA_HOST like the ollama module does
+def getOllamaClient(host=None):
+    def create():
+        pool_size = getPoolSize()
+        return ollama.Client(host=host, limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+    return _getClient(("ollama", host), create)
+
+# Get the shared requests session for plain HTTP calls like ComfyUI and image downloads
+def getHttpSession():
+    def create():
+        pool_size = getPoolSize()
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+    return _getClient(("http",), create)
+
+# Images are kept in memory up to this size before spilling to a temp file
+IMAGE_BUFFER_MAX_MEMORY = 8 * 1024 * 1024
+# Size of the chunks read from the response while streaming a download
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Stream a download straight into a spooled buffer instead of holding the whole response body and then copying it
+# into a BytesIO, returns the buffer rewound to the start. The buffer is closed if the download fails
+def downloadToBuffer(url, params=None):
+    buffer = SpooledTemporaryFile(max_size=IMAGE_BUFFER_MAX_MEMORY)
+    try:
+        with getHttpSession().get(url, params=params, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                buffer.write(chunk)
+    except BaseException:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+# Read a file saved earlier into the same kind of buffer, the file is closed once it is read
+def fileToBuffer(path):
+    buffer = SpooledTemporaryFile(max_size=IMAGE_BUFFER_MAX_MEMORY)
+    try:
+        with open(path, "rb") as source_file:
+            shutil.copyfileobj(source_file, buffer, DOWNLOAD_CHUNK_SIZE)
+    except BaseException:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+async def downloadToBufferAsync(url, params=None):
+    buffer = SpooledTemporaryFile(max_size=IMAGE_BUFFER_MAX_MEMORY)
+    try:
+        async with getAsyncHttpClient().stream("GET", url, params=params) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                buffer.write(chunk)
+    except BaseException:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+# Async clients are tied to the event loop they were created on, so they are shared per endpoint and loop
+
+# Get the shared async Azure OpenAI client for an endpoint on the running event loop
+def getAsyncAzureClient(endpoint, key, api_version):
+    def create():
+        pool_size = getPoolSize()
+        return AsyncAzureOpenAI(
+            api_key=key,
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            max_retries=0,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+        )
+    return _getClient(("async_azure_openai", asyncio.get_running_loop(), endpoint, api_version, key), create)
+
+# Get the shared async ollama client on the running event loop
+def getAsyncOllamaClient(host=None):
+    def create():
+        pool_size = getPoolSize()
+        return ollama.AsyncClient(host=host, limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+    return _getClient(("async_ollama", asyncio.get_running_loop(), host), create)
+
+# Get the shared async httpx client for plain HTTP calls on the running event loop
+def getAsyncHttpClient():
+    def create():
+        pool_size = getPoolSize()
+        return httpx.AsyncClient(timeout=httpx.Timeout(60.0), limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+    return _getClient(("async_http", asyncio.get_running_loop()), create)
+
+# Close all the async clients created on the running event loop, call before the loop is closed
+async def closeAsyncClients():
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        client_keys = [client_key for client_key in _clients if client_key[0].startswith("async_") and client_key[1] is loop]
+        clients = [_clients.pop(client_key) for client_key in client_keys]
+    for client in clients:
+        try:
+            if hasattr(client, "aclose"):
+                await client.aclose()
+            else:
+                await client.close()
+        except Exception:
+            pass
+
+_async_loop = None
+_async_thread = None
+_async_loop_lock = threading.Lock()
+
+# Process wide event loop running on its own thread for the async requests. The async clients are tied to the loop
+# they were made on, so with one loop for the run they and their keep alive connections are reused by every object
+# instead of being made (and their TLS handshakes paid) again for each asyncio.run
+def getAsyncLoop():
+    global _async_loop, _async_thread
+    with _async_loop_lock:
+        if _async_loop is None:
+            _async_loop = asyncio.new_event_loop()
+            _async_thread = threading.Thread(target=_async_loop.run_forever, daemon=True, name="async-requests")
+            _async_thread.start()
+    return _async_loop
+
+# Run the coroutine on the shared event loop and wait for its result, called from the pipeline worker threads
+def runAsync(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, getAsyncLoop()).result()
+
+# Close the async clients and stop the shared event loop
+def stopAsyncLoop():
+    global _async_loop, _async_thread
+    with _async_loop_lock:
+        loop, thread = _async_loop, _async_thread
+        _async_loop = _async_thread = None
+    if loop is None:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(closeAsyncClients(), loop).result()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+# Close all the shared clients, mainly for the end of a run
+def closeClients():
+    stopAsyncLoop()
+    with _clients_lock:
+        client_keys = [client_key for client_key in _clients if not client_key[0].startswith("async_")]
+        for client_key in client_keys:
+            try:
+                _clients.pop(client_key).close()
+            except Exception:
+                pass
@@ -1,54 +1,42 @@
-import ollama
-
 import os
-import requests
 import json
 import time
 import random
 
-from io import BytesIO
+import asyncio
+import uuid
+import httpx
 
-# Parent class for the Azure OpenAI models
-class ollamaModel():
+# websocket-client is optional, without it ComfyUI completion is found by polling /history
+try:
+    import websocket
+except ImportError:
+    websocket = None
 
-    def __init__(self):
-        self.model = ""
-        self.system_prompt = ""
-        self.user_prompt = ""
-    
-    def to_json(self):
-        # Return a clean json object for saving details without sensitive information
-        return {
-            "model": self.model
-        }
+from lib.comfyui_pool import getComfyPool
+from lib.model_clients import getOllamaClient, getHttpSession, getAsyncOllamaClient, getAsyncHttpClient, downloadToBuffer, downloadToBufferAsync
+from lib.completion_cache import cachedCompletion, cachedCompletionAsync
+from lib.request_governor import getGovernor, estimateTokens
+from lib.json_stream import jsonStreamScanner
+from lib.schemas import ollamaFormat, getSchemaName, completionMatches
 
-# Child class for the Azure OpenAI Text model
-class ollamaText(ollamaModel):
-    def __init__(self):
-        super().__init__()
-        self.model = os.getenv("LOCAL_MODEL_NAME")
+# Polling for ComfyUI, starts quick and backs off to the max, the max is also how often we double check /history
+# when listening on the websocket in case an event was missed
+COMFYUI_POLL_MIN = .25
+COMFYUI_POLL_MAX = 5
+COMFYUI_POLL_BACKOFF = 1.5
+# Most seconds to wait for a ComfyUI prompt to finish before giving up on it
+COMFYUI_WAIT_MAX = 900
 
-    def generateResponse(self):
-        response = ollama.chat(
-            model=self.model, 
-            messages=[
-                { "role": "system", "content": self.system_prompt},
-                {"role": "user", "content":self.user_prompt}
-            ],
-        )
-        
-        return response.message.content
+# Errors that mean the ComfyUI node itself has a problem (connection, timeouts, bad responses), includes requests
+# and httpx errors, rather than the workflow failing
+COMFYUI_NODE_ERRORS = (OSError, httpx.HTTPError, ValueError)
 
-# Child class for the Azure OpenAI Image model
-# We are doing ComfyUI/StableDiffusion here, but I am too lazy to name the class better
-class ollamaImage(ollamaModel):
-    def __init__(self):
-        super().__init__()
-        self.model = os.getenv("AZURE_OPENAI_IMAGE_MODEL")
+# Max images generated in one batched latent when posters share a prompt
+COMFYUI_MAX_BATCH = 4
 
-    def generateImage(self):
-        full_prompt = json.loads(
-"""
+# ComfyUI StableDiffusion workflow used for the poster images, the prompt text and seed are filled in per image
+COMFYUI_WORKFLOW = """
 {"prompt": 
   {
   "3": {
@@ -159,41 +147,417 @@ class ollamaImage(ollamaModel):
 }
 }
 """
+
+# Parent class for the Azure OpenAI models
+class ollamaModel():
+
+    def __init__(self):
+        self.model = ""
+        self.system_prompt = ""
+        self.user_prompt = ""
+        self.env_prefix = ""
+        # Schema the completion should follow (see lib/schemas.py), sent as the format when set
+        self.response_schema = None
+    
+    def to_json(self):
+        # Return a clean json object for saving details without sensitive information
+        return {
+            "model": self.model
+        }
+
+    # Requests to the model go through its governor, env_prefix picks the budgets from the environment (e.g. LOCAL_TEXT_MAX_CONCURRENCY)
+    def getGovernor(self):
+        return getGovernor(self.env_prefix, self.model or "")
+
+    def getSchemaName(self):
+        return getSchemaName(self.response_schema) if self.response_schema is not None else None
+
+    # Only completions that fit the schema go into the completion cache
+    def isValidCompletion(self, completion):
+        return completionMatches(completion, self.response_schema)
+
+    # Reads a streamed chat until the json object in it is complete, then closes the stream so ollama stops generating
+    # what the model adds after it. Returns the completion up to the end of the object
+    def readStream(self, stream):
+        scanner = jsonStreamScanner()
+        try:
+            for chunk in stream:
+                if chunk.message.content and scanner.feed(chunk.message.content):
+                    break
+        finally:
+            stream.close()
+        return scanner.text
+
+    async def readStreamAsync(self, stream):
+        scanner = jsonStreamScanner()
+        try:
+            async for chunk in stream:
+                if chunk.message.content and scanner.feed(chunk.message.content):
+                    break
+        finally:
+            await stream.aclose()
+        return scanner.text
+
+    # Tokens a streamed chat used, the stream is closed before the counts are sent so it is estimated from the text
+    def streamedTokens(self, completion):
+        return estimateTokens(self.system_prompt, self.user_prompt, completion)
+
+    # Async versions of the calls, children override these with native async clients
+    # so one event loop can keep many requests in flight, this fallback runs the sync call in a thread
+    async def generateResponseAsync(self):
+        return await asyncio.to_thread(self.generateResponse)
+
+    async def generateImageAsync(self):
+        return await asyncio.to_thread(self.generateImage)
+
+# Child class for the Azure OpenAI Text model
+class ollamaText(ollamaModel):
+    def __init__(self):
+        super().__init__()
+        self.model = os.getenv("LOCAL_MODEL_NAME")
+        self.env_prefix = "LOCAL_TEXT"
+
+    # What goes into the completion cache key, ollama runs at the model's own temperature
+    def cacheKeyParts(self):
+        return ("ollama", self.model, self.system_prompt, self.user_prompt, None, None, self.getSchemaName())
+
+    def generateResponse(self):
+        return cachedCompletion(self.cacheKeyParts(), self.requestResponse, self.isValidCompletion)
+
+    async def generateResponseAsync(self):
+        return await cachedCompletionAsync(self.cacheKeyParts(), self.requestResponseAsync, self.isValidCompletion)
+
+    def buildMessages(self):
+        return [
+            { "role": "system", "content": self.system_prompt},
+            {"role": "user", "content":self.user_prompt}
+        ]
+
+    # The chat is streamed and cut off once its json object is complete
+    def requestResponse(self):
+        return self.getGovernor().call(
+            lambda: self.readStream(getOllamaClient().chat(
+                model=self.model, 
+                messages=self.buildMessages(),
+                format=ollamaFormat(self.response_schema),
+                stream=True
+            )),
+            tokens=estimateTokens(self.system_prompt, self.user_prompt), used_tokens=self.streamedTokens)
+
+    async def requestResponseAsync(self):
+        async def request():
+            return await self.readStreamAsync(await getAsyncOllamaClient().chat(
+                model=self.model, 
+                messages=self.buildMessages(),
+                format=ollamaFormat(self.response_schema),
+                stream=True
+            ))
+        return await self.getGovernor().callAsync(request,
+            tokens=estimateTokens(self.system_prompt, self.user_prompt), used_tokens=self.streamedTokens)
+
+# Child class for the Azure OpenAI Image model
+# We are doing ComfyUI/StableDiffusion here, but I am too lazy to name the class better
+class ollamaImage(ollamaModel):
+    def __init__(self):
+        super().__init__()
+        self.model = os.getenv("AZURE_OPENAI_IMAGE_MODEL")
+        self.env_prefix = "COMFYUI"
+        # Set to the ComfyUI node picked from the pool (COMFYUI_ENDPOINTS) for each call
+        self.endpoint = ""
+
+    # Builds the ComfyUI workflow for the prompt with a random seed, batch_size images share the prompt
+    def buildWorkflow(self, prompt=None, batch_size=1):
+        full_prompt = json.loads(COMFYUI_WORKFLOW)
+        full_prompt["prompt"]["16"]["inputs"]["text"] = self.user_prompt if prompt is None else prompt
+        full_prompt["prompt"]["3"]["inputs"]["seed"] = random.randint(10**14, 10**15)
+        full_prompt["prompt"]["53"]["inputs"]["batch_size"] = batch_size
+        return full_prompt
+
+    # Gets the status and output filenames for the prompt from a ComfyUI /history response
+    def parseHistory(self, history_json, prompt_id):
+        if prompt_id not in history_json:
+            return "running", []
+        status = history_json[prompt_id]["status"]["status_str"]
+        if status == "success":
+            return status, [output_image["filename"] for output_image in history_json[prompt_id]["outputs"]["9"]["images"]]
+        elif status == "error":
+            raise Exception("Error generating image")
+        return status, []
+
+    # Checks a ComfyUI websocket message, returns the prompt id from prompt_ids that finished (or failed) or None
+    def finishedPrompt(self, message, prompt_ids):
+        # Binary messages are preview images, we only care about the json events
+        if not isinstance(message, str):
+            return None
+        event = json.loads(message)
+        data = event.get("data") or {}
+        if data.get("prompt_id") not in prompt_ids:
+            return None
+        # Older ComfyUI versions only send executing with no node when the prompt is done
+        if event.get("type") in ("execution_success", "execution_error") or (event.get("type") == "executing" and data.get("node") is None):
+            return data["prompt_id"]
+        return None
+
+    # Opens the ComfyUI websocket for execution events, None if we can't so we fall back to polling
+    def connectEvents(self, client_id):
+        if websocket is None:
+            return None
+        try:
+            ws_endpoint = self.endpoint.replace("https://", "wss://").replace("http://", "ws://")
+            return websocket.create_connection(f"{ws_endpoint}/ws?clientId={client_id}", timeout=COMFYUI_POLL_MAX)
+        except Exception:
+            return None
+
+    # Queues the workflow on ComfyUI and returns its prompt id
+    def queueWorkflow(self, workflow, client_id):
+        workflow["client_id"] = client_id
+        response = getHttpSession().post(
+            f"{self.endpoint}/prompt",
+            headers={
+                "Content-Type": "application/json"
+            },
+            data=json.dumps(workflow)
         )
+        return response.json()["prompt_id"]
+
+    # Waits for the prompts to finish and returns their output filenames (or the exception if it failed) by prompt id. Listens for the execution events on the
+    # websocket and fetches the history as soon as a prompt is done, if there is no websocket (or it drops) it polls /history
+    # with a backoff instead. With a websocket /history is still checked every COMFYUI_POLL_MAX seconds in case an event was missed,
+    # however busy the socket is with progress messages. Prompts not done after COMFYUI_WAIT_MAX seconds get a TimeoutError
+    def waitForImages(self, prompt_ids, ws=None):
+        session = getHttpSession()
+        pending = set(prompt_ids)
+        filenames = {}
+        delay = COMFYUI_POLL_MIN
+        now = time.monotonic()
+        deadline = now + COMFYUI_WAIT_MAX
+        next_poll = now + (COMFYUI_POLL_MAX if ws is not None else delay)
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                for prompt_id in pending:
+                    filenames[prompt_id] = TimeoutError(f"ComfyUI prompt {prompt_id} didn't finish within {COMFYUI_WAIT_MAX} seconds")
+                break
+
+            if now >= next_poll:
+                ready = list(pending)
+                if ws is None:
+                    delay = min(delay * COMFYUI_POLL_BACKOFF, COMFYUI_POLL_MAX)
+                next_poll = now + (COMFYUI_POLL_MAX if ws is not None else delay)
+            elif ws is not None:
+                try:
+                    # Only wait on the socket until the next poll is due, other messages don't push the poll back
+                    ws.settimeout(max(.01, min(next_poll, deadline) - now))
+                    finished = self.finishedPrompt(ws.recv(), pending)
+                except websocket.WebSocketTimeoutException:
+                    continue
+                except (websocket.WebSocketException, OSError):
+                    ws = None
+                    next_poll = now + delay
+                    continue
+                if finished is None:
+                    continue
+                ready = [finished]
+            else:
+                time.sleep(max(0, min(next_poll, deadline) - now))
+                continue
+
+            for prompt_id in ready:
+                history_response = session.get(f"{self.endpoint}/history/{prompt_id}")
+                try:
+                    status, images = self.parseHistory(history_response.json(), prompt_id)
+                except Exception as e:
+                    status, images = "error", e
+                if status in ("success", "error"):
+                    filenames[prompt_id] = images
+                    pending.discard(prompt_id)
+        return filenames
+
+    def downloadImage(self, filename):
+        return downloadToBuffer(f"{self.endpoint}/view", params={"filename": filename})
+
+    # Runs the call on the least busy ComfyUI node from the pool. If the node fails (connection errors, bad responses)
+    # it is marked failed and the work is moved on to the next node, errors from the workflow itself are raised as is
+    def runOnNode(self, call):
+        pool = getComfyPool()
+        tried = []
+        while True:
+            endpoint = pool.acquire(exclude=tried)
+            self.endpoint = endpoint.url
+            try:
+                result = call()
+            except COMFYUI_NODE_ERRORS:
+                pool.release(endpoint, success=False)
+                pool.markFailed(endpoint)
+                tried.append(endpoint.url)
+                if len(tried) >= len(pool.endpoints):
+                    raise
+                continue
+            except Exception:
+                pool.release(endpoint)
+                raise
+            pool.release(endpoint)
+            return result
+
+    async def runOnNodeAsync(self, call):
+        pool = getComfyPool()
+        tried = []
+        while True:
+            endpoint = pool.acquire(exclude=tried)
+            self.endpoint = endpoint.url
+            try:
+                result = await call()
+            except COMFYUI_NODE_ERRORS:
+                pool.release(endpoint, success=False)
+                pool.markFailed(endpoint)
+                tried.append(endpoint.url)
+                if len(tried) >= len(pool.endpoints):
+                    raise
+                continue
+            except Exception:
+                pool.release(endpoint)
+                raise
+            pool.release(endpoint)
+            return result
+
+    # Any failure is retried with backoff, a workflow that fails can go through with the next seed
+    def generateImage(self):
+        return self.getGovernor().call(lambda: self.runOnNode(self.generateImageOnNode), retry_any=True)
+
+    def generateImageOnNode(self):
+        client_id = uuid.uuid4().hex
+        # Connect before queueing the prompt so we can't miss its events
+        ws = self.connectEvents(client_id)
+        try:
+            prompt_id = self.queueWorkflow(self.buildWorkflow(), client_id)
+            filenames = self.waitForImages([prompt_id], ws)[prompt_id]
+        finally:
+            if ws is not None:
+                ws.close()
+
+        if isinstance(filenames, Exception):
+            raise filenames
+        return self.downloadImage(filenames[0])
+
+    # Generates an image for each prompt in one go, returns a list in the same order as the prompts holding the image
+    # or the exception for that prompt. Everything is queued up front so the GPU goes from one to the next without waiting
+    # on us, and prompts that are the same are sent as one workflow with a batched latent (up to COMFYUI_MAX_BATCH)
+    # The batch goes through the governor like a single image, so it keeps to the COMFYUI budgets and a batch that
+    # comes back with nothing is retried with backoff
+    def generateImages(self, prompts):
+        return self.getGovernor().call(lambda: self.generateImagesOnPool(prompts), retry_any=True)
+
+    def generateImagesOnPool(self, prompts):
+        pool = getComfyPool()
+        endpoint = pool.acquire()
+        self.endpoint = endpoint.url
         try:
-            full_prompt["prompt"]["16"]["inputs"]["text"] = self.user_prompt
-            full_prompt["prompt"]["3"]["inputs"]["seed"] = random.randint(10**14, 10**15)
-            response = requests.post(
-                "http://172.23.112.1:8188/prompt",
-                headers={
-                    "Content-Type": "application/json"
-                },
-                data=json.dumps(full_prompt)
-            )
-
-            initial_gen_response = response.json()
-
-            status = "running"
-            filename = ""
-            while status != "success":
-                time.sleep(.5)
-                history_response = requests.get(
-                    f"http://172.23.112.1:8188/history/{initial_gen_response['prompt_id']}"
-                )
-                if history_response.json() != {}:
-                    status = history_response.json()[initial_gen_response['prompt_id']]["status"]["status_str"]
-                    if status == "success":
-                        filename = history_response.json()[initial_gen_response['prompt_id']]["outputs"]["9"]["images"][0]["filename"]
-                        break
-                    elif status == "error":
-                        raise Exception("Error generating image")
-                time.sleep(5)
-            
-            return BytesIO(requests.get(f"http://172.23.112.1:8188/view?filename={filename}").content)
-        except Exception as e:
+            results = self.generateImagesOnNode(prompts)
+        except Exception:
+            pool.release(endpoint, success=False)
+            pool.markFailed(endpoint)
             raise
-        
-        
+        node_failed = any(isinstance(result, COMFYUI_NODE_ERRORS) for result in results)
+        pool.release(endpoint, success=not node_failed)
+        # Anything that failed gets retried on its own by the caller, which moves it to a healthy node
+        if node_failed:
+            pool.markFailed(endpoint)
+        # When every prompt failed the error is raised for the governor to back off and retry the whole batch
+        if all(isinstance(result, Exception) for result in results):
+            raise results[0]
+        return results
+
+    def generateImagesOnNode(self, prompts):
+        results = [None] * len(prompts)
+
+        # Group the positions of the same prompts together, split into chunks of the max batch size
+        batches = []
+        for prompt in dict.fromkeys(prompts):
+            positions = [index for index, value in enumerate(prompts) if value == prompt]
+            for start in range(0, len(positions), COMFYUI_MAX_BATCH):
+                batches.append((prompt, positions[start:start + COMFYUI_MAX_BATCH]))
+
+        client_id = uuid.uuid4().hex
+        ws = self.connectEvents(client_id)
+        try:
+            queued = {}
+            for prompt, positions in batches:
+                try:
+                    queued[self.queueWorkflow(self.buildWorkflow(prompt, len(positions)), client_id)] = positions
+                except Exception as e:
+                    for index in positions:
+                        results[index] = e
+
+            try:
+                filenames = self.waitForImages(list(queued), ws)
+            except Exception as e:
+                filenames = {}
+                for positions in queued.values():
+                    for index in positions:
+                        results[index] = e
+        finally:
+            if ws is not None:
+                ws.close()
+
+        # Map the batch outputs back to the prompt positions
+        for prompt_id, images in filenames.items():
+            if isinstance(images, Exception):
+                for index in queued[prompt_id]:
+                    results[index] = images
+                continue
+            for index, filename in zip(queued[prompt_id], images):
+                try:
+                    results[index] = self.downloadImage(filename)
+                except Exception as e:
+                    results[index] = e
+            for index in queued[prompt_id][len(images):]:
+                results[index] = Exception("ComfyUI returned fewer images than the batch size")
+
+        return results
+
+    # The async version polls /history with a backoff so it doesn't tie up a thread on the websocket. Like generateImage
+    # it goes through the governor and runs on a node from the pool
+    async def generateImageAsync(self):
+        return await self.getGovernor().callAsync(lambda: self.runOnNodeAsync(self.generateImageOnNodeAsync), retry_any=True)
+
+    async def generateImageOnNodeAsync(self):
+        client = getAsyncHttpClient()
+        response = await client.post(f"{self.endpoint}/prompt", json=self.buildWorkflow())
+
+        prompt_id = response.json()["prompt_id"]
+        filenames = (await self.waitForImagesAsync([prompt_id]))[prompt_id]
+
+        if isinstance(filenames, Exception):
+            raise filenames
+        return await downloadToBufferAsync(f"{self.endpoint}/view", params={"filename": filenames[0]})
+
+    # Async version of waitForImages without the websocket, polls /history with the backoff and gives prompts not done
+    # after COMFYUI_WAIT_MAX seconds a TimeoutError the same way
+    async def waitForImagesAsync(self, prompt_ids):
+        client = getAsyncHttpClient()
+        pending = set(prompt_ids)
+        filenames = {}
+        delay = COMFYUI_POLL_MIN
+        deadline = time.monotonic() + COMFYUI_WAIT_MAX
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                for prompt_id in pending:
+                    filenames[prompt_id] = TimeoutError(f"ComfyUI prompt {prompt_id} didn't finish within {COMFYUI_WAIT_MAX} seconds")
+                break
+            await asyncio.sleep(min(delay, deadline - now))
+            delay = min(delay * COMFYUI_POLL_BACKOFF, COMFYUI_POLL_MAX)
+
+            for prompt_id in list(pending):
+                history_response = await client.get(f"{self.endpoint}/history/{prompt_id}")
+                try:
+                    status, images = self.parseHistory(history_response.json(), prompt_id)
+                except Exception as e:
+                    status, images = "error", e
+                if status in ("success", "error"):
+                    filenames[prompt_id] = images
+                    pending.discard(prompt_id)
+        return filenames
 
 
 # Child class for the Azure OpenAI Vision model
@@ -202,14 +566,42 @@ class ollamaVision(ollamaModel):
         super().__init__()
         self.model = "llama3.2-vision" #os.getenv("LOCAL_MODEL_NAME")
         self.image_base64 = ""
+        self.env_prefix = "LOCAL_VISION"
+
+    # What goes into the completion cache key, the image is keyed by a digest of its data
+    def cacheKeyParts(self):
+        return ("ollama", self.model, self.system_prompt, self.user_prompt, None, self.image_base64, self.getSchemaName())
 
     def generateResponse(self):
-        response = ollama.chat(
-            model=self.model, 
-            messages=[
-                { "role": "system", "content": self.system_prompt},
-                {"role": "user", "content":self.user_prompt, "images": [self.image_base64] }
-            ],
-        )
-        
-        return response.message.content
\ No newline at end of file
+        return cachedCompletion(self.cacheKeyParts(), self.requestResponse, self.isValidCompletion)
+
+    async def generateResponseAsync(self):
+        return await cachedCompletionAsync(self.cacheKeyParts(), self.requestResponseAsync, self.isValidCompletion)
+
+    def buildMessages(self):
+        return [
+            { "role": "system", "content": self.system_prompt},
+            {"role": "user", "content":self.user_prompt, "images": [self.image_base64] }
+        ]
+
+    # The chat is streamed and cut off once its json object is complete
+    def requestResponse(self):
+        return self.getGovernor().call(
+            lambda: self.readStream(getOllamaClient().chat(
+                model=self.model, 
+                messages=self.buildMessages(),
+                format=ollamaFormat(self.response_schema),
+                stream=True
+            )),
+            tokens=estimateTokens(self.system_prompt, self.user_prompt), used_tokens=self.streamedTokens)
+
+    async def requestResponseAsync(self):
+        async def request():
+            return await self.readStreamAsync(await getAsyncOllamaClient().chat(
+                model=self.model, 
+                messages=self.buildMessages(),
+                format=ollamaFormat(self.response_schema),
+                stream=True
+            ))
+        return await self.getGovernor().callAsync(request,
+            tokens=estimateTokens(self.system_prompt, self.user_prompt), used_tokens=self.streamedTokens)
@@ -0,0 +1,149 @@
+import queue
+import threading
+import traceback
+
+# Marker put on a stage queue to tell one of its workers there is no more work
+_STOP = object()
+
+# A single step of the pipeline, handler is called with a job and returns None to pass the job on to the
+# next stage or a result (e.g. "success" or the failed stage) to finish the job early
+# With a batch_size over 1 the handler is called with a list of up to batch_size jobs (waiting up to batch_wait
+# seconds for more to show up) and returns a list of results in the same order
+class pipelineStage:
+    def __init__(self, name, handler, workers=1, queue_size=0, batch_size=1, batch_wait=0):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.batch_wait = batch_wait
+        # Bounded so a fast stage can't run too far ahead of a slow one, defaults to a couple of jobs (or a batch) per worker
+        self.queue = queue.Queue(maxsize=queue_size if queue_size > 0 else self.workers * max(2, self.batch_size))
+        self._running = self.workers
+        self._lock = threading.Lock()
+        # Jobs queued for or running in the stage, and how many the stage passed on (or finished successfully) or failed
+        self.active = 0
+        self.passed = 0
+        self.failed = 0
+
+    # Fraction of the jobs through the stage it passed on, prior_rate stands in for prior_weight jobs so a stage
+    # without many jobs through it yet isn't judged on one or two
+    def passRate(self, prior_rate=1.0, prior_weight=1):
+        with self._lock:
+            return (self.passed + prior_rate * prior_weight) / (self.passed + self.failed + prior_weight)
+
+    def addActive(self):
+        with self._lock:
+            self.active += 1
+
+# Runs jobs through a list of stages, each stage has its own worker threads and they are connected by bounded queues
+# so throughput is set by the slowest stage instead of the sum of all of them
+# Cancelling stops feeding new jobs and the jobs still queued finish as "cancelled" instead of running their next
+# stage, a stage already running a job finishes it first
+class stagePipeline:
+    def __init__(self, stages, process=None):
+        self.stages = stages
+        self.process = process
+        self._results = queue.Queue()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def isCancelled(self):
+        return self._cancelled.is_set()
+
+    # Feeds the jobs into the first stage and yields (job, result) as jobs finish, in completion order
+    def run(self, jobs):
+        threads = [threading.Thread(target=self._feed, args=(jobs,), daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target=self._work, args=(index,), daemon=True, name=f"{stage.name}-worker"))
+
+        for thread in threads:
+            thread.start()
+
+        while True:
+            item = self._results.get()
+            if item is _STOP:
+                break
+            yield item
+
+        for thread in threads:
+            thread.join()
+
+    def _feed(self, jobs):
+        first = self.stages[0]
+        try:
+            for job in jobs:
+                if self._cancelled.is_set():
+                    break
+                first.addActive()
+                first.queue.put(job)
+        finally:
+            for _ in range(first.workers):
+                first.queue.put(_STOP)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+
+        try:
+            stopping = False
+            while not stopping:
+                job = stage.queue.get()
+                if job is _STOP:
+                    break
+
+                jobs = [job]
+                while len(jobs) < stage.batch_size:
+                    try:
+                        job = stage.queue.get(timeout=stage.batch_wait) if stage.batch_wait > 0 else stage.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is _STOP:
+                        stopping = True
+                        break
+                    jobs.append(job)
+
+                try:
+                    if self._cancelled.is_set():
+                        results = ["cancelled"] * len(jobs)
+                    elif stage.batch_size > 1:
+                        results = stage.handler(jobs)
+                    else:
+                        results = [stage.handler(jobs[0])]
+                # BaseException too, a SystemExit or KeyboardInterrupt in a handler would otherwise end the worker without
+                # passing on its jobs or the stop signal and run() would wait forever
+                except BaseException as e:
+                    results = ["error"] * len(jobs)
+                    for job in jobs:
+                        self._log(job, f"Unexpected error in {stage.name} stage: {e}\n{traceback.format_exc()}")
+
+                for job, result in zip(jobs, results):
+                    with stage._lock:
+                        stage.active -= 1
+                        if result is None or result == "success":
+                            stage.passed += 1
+                        elif result != "cancelled":
+                            stage.failed += 1
+                    if result is None and next_stage is not None:
+                        next_stage.addActive()
+                        next_stage.queue.put(job)
+                    else:
+                        self._results.put((job, result if result is not None else "success"))
+        finally:
+            # The last worker out of a stage lets the next stage know there is nothing else coming
+            with stage._lock:
+                stage._running -= 1
+                last_worker = stage._running == 0
+            if last_worker:
+                if next_stage is not None:
+                    for _ in range(next_stage.workers):
+                        next_stage.queue.put(_STOP)
+                else:
+                    self._results.put(_STOP)
+
+    def _log(self, job, message):
+        process = getattr(job, "process", None) or self.process
+        if process is not None:
+            process.outputMessage(message, "error")
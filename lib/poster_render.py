@@ -0,0 +1,59 @@
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
+from io import BytesIO
+import multiprocessing
+import threading
+
+from lib.title_layout import layoutTitle, splitTitle
+
+# JPEG quality of the saved posters
+POSTER_QUALITY = 75
+
+# Add the title to the poster and encode it as a jpeg. Only takes and returns plain values so it can run in a
+# worker process, the text drawing and jpeg encoding hold the GIL and would otherwise serialize on one core
+def renderPoster(image_bytes, title, font_path, location, location_padding, font_color, has_text, uppercase=False, quality=POSTER_QUALITY):
+    with Image.open(BytesIO(image_bytes)) as img:
+        img = img.convert("RGB")
+
+    # Check if the poster has text and if it doesnt, title it.
+    if has_text == False:
+        draw = ImageDraw.Draw(img)
+        text_string = title.upper() if uppercase else title
+
+        # Size the font to fit the biggest line and place the lines based upon the vision layout
+        font, lines = layoutTitle(font_path, splitTitle(text_string), img.size, location, location_padding)
+        stroke_color = "#111111" if font_color > "#999999" else "#DDDDDD"
+        for w_placement, y_placement, text_line in lines:
+            # put the text on the image
+            draw.text((w_placement, y_placement), text_line, fill=font_color, font=font, stroke_width=1, stroke_fill=stroke_color, align='center')
+
+    poster_buffer = BytesIO()
+    img.save(poster_buffer, "JPEG", quality=quality)
+    return poster_buffer.getvalue()
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+# Start the process pool for rendering posters, when it isn't started posters are rendered in the calling thread
+# The workers are started from a forkserver (spawn where there is none) rather than forked from this process, forking
+# while the logging, event loop and stage threads hold locks can deadlock the workers. Call it before those threads
+# start, the workers are started up front so none are started mid run
+def startRenderPool(processes):
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None and processes > 0:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _render_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context(start_method))
+            for future in [_render_pool.submit(int) for _ in range(processes)]:
+                future.result()
+    return _render_pool
+
+def getRenderPool():
+    return _render_pool
+
+def stopRenderPool():
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown()
+            _render_pool = None
@@ -1,9 +1,38 @@
+from logging.handlers import QueueHandler, QueueListener
+import threading
 import logging
+import atexit
+import queue
 import json
 import os
 import datetime
 import hashlib
 import random
+import copy
+
+from lib.json_stream import findJson
+
+# Log levels of the outputMessage levels, anything else logs at info
+OUTPUT_LEVELS = {
+    "error": logging.ERROR,
+    "success": logging.INFO,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "debug": logging.DEBUG,
+    "verbose": logging.DEBUG
+}
+# Client libraries that log every request at debug, kept at info when verbose turns debug on
+QUIET_LOGGERS = ("httpx", "httpcore", "openai", "urllib3")
+
+# Text log line, the process id of the message goes in front of it when it has one
+class textFormatter(logging.Formatter):
+    def __init__(self, fmt="%(asctime)s - [%(levelname)s] - %(process_prefix)s%(message)s"):
+        super().__init__(fmt)
+
+    def format(self, record):
+        process_id = getattr(record, "process_id", None)
+        record.process_prefix = f"{process_id} - " if process_id is not None else ""
+        return super().format(record)
 
 # Custom format class to handle coloring of console output
 class CustomFormatter(logging.Formatter):
@@ -13,20 +42,90 @@ class CustomFormatter(logging.Formatter):
     red = "\x1b[31;20m"
     bold_red = "\x1b[31;1m"
     reset = "\x1b[0m"
-    format = "%(asctime)s - [%(levelname)s] - %(message)s"
-
-    FORMATS = {
-        logging.DEBUG: grey + format + reset,
-        logging.INFO: grey + format + reset,
-        logging.WARNING: yellow + format + reset,
-        logging.ERROR: red + format + reset,
-        logging.CRITICAL: bold_red + format + reset
+    format = "%(asctime)s - [%(levelname)s] - %(process_prefix)s%(message)s"
+
+    # Built once, format is called for every record
+    FORMATTERS = {
+        logging.DEBUG: textFormatter(grey + format + reset),
+        logging.INFO: textFormatter(grey + format + reset),
+        logging.WARNING: textFormatter(yellow + format + reset),
+        logging.ERROR: textFormatter(red + format + reset),
+        logging.CRITICAL: textFormatter(bold_red + format + reset)
     }
 
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self.FORMATTERS.get(record.levelno, self.FORMATTERS[logging.INFO]).format(record)
+
+# One json object per line for log shippers, with the process id and outputMessage level as their own fields
+class jsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        for field in ("process_id", "message_type"):
+            if hasattr(record, field):
+                line[field] = getattr(record, field)
+        if record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, default=str)
+
+# Queue handler that leaves the formatting to the listener thread, only the message itself is built in the thread that
+# logged it (the standard one formats the whole record there)
+class deferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_log_listener = None
+_log_lock = threading.Lock()
+
+# Send the root logger through a queue to a background thread that writes outputs/movie_generation.log and the console,
+# so the pipeline workers never wait on the file or terminal. json_lines writes both as json lines instead of text
+def configureLogging(json_lines=False, verbose=False):
+    global _log_listener
+    with _log_lock:
+        stopLogging(locked=True)
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            root_logger.removeHandler(handler)
+
+        fileHandler = logging.FileHandler("{0}/{1}.log".format('outputs', 'movie_generation'))
+        fileHandler.setFormatter(jsonLineFormatter() if json_lines else textFormatter())
+        consoleHandler = logging.StreamHandler()
+        consoleHandler.setFormatter(jsonLineFormatter() if json_lines else CustomFormatter())
+
+        log_queue = queue.SimpleQueue()
+        _log_listener = QueueListener(log_queue, fileHandler, consoleHandler, respect_handler_level=True)
+        _log_listener.start()
+        root_logger.addHandler(deferredQueueHandler(log_queue))
+
+        root_logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+        for logger_name in QUIET_LOGGERS:
+            logging.getLogger(logger_name).setLevel(logging.INFO if verbose else logging.NOTSET)
+
+# Write out everything still in the log queue and stop the background thread, called at the end of a run
+def stopLogging(locked=False):
+    global _log_listener
+    if not locked:
+        with _log_lock:
+            return stopLogging(locked=True)
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+atexit.register(stopLogging)
 
 # Create a class for common values and functions across the script
 class processHelper:
@@ -39,61 +138,70 @@ class processHelper:
         self.image_fail_count = 0
         self.completion_fail_count = 0
         self.save_fail_count = 0
+        self.cancelled_count = 0
+        self.json_lines = False
 
-        logFormatter = logging.Formatter("%(asctime)s - [%(levelname)s] - %(message)s")
         self.rootLogger = logging.getLogger()
 
-        fileHandler = logging.FileHandler("{0}/{1}.log".format('outputs', 'movie_generation'))
-        fileHandler.setFormatter(logFormatter)
-        self.rootLogger.addHandler(fileHandler)
+        # Only attach handlers once, child helpers share the parent's logger
+        if self.rootLogger.handlers:
+            return
 
-        consoleHandler = logging.StreamHandler()
-        consoleHandler.setFormatter(CustomFormatter())
-        self.rootLogger.addHandler(consoleHandler)
+        configureLogging()
 
-        self.rootLogger.setLevel(logging.INFO)
+    # Switch the log format and level once the command line has been read
+    def configureLogging(self, json_lines=False, verbose=False):
+        self.json_lines = json_lines
+        configureLogging(json_lines, verbose)
 
     def createProcessId(self):
         self.process_id = hashlib.md5(str(random.random()).encode()).hexdigest()[:16]
+
+    # Creates a helper for a single media object, sharing logging with this one but with its own process id
+    # so concurrent objects don't overwrite each others id
+    def createChild(self):
+        child = copy.copy(self)
+        child.createProcessId()
+        return child
     
     def envCheck(self, env_var):
         if os.getenv(env_var) is None:
             self.outputMessage(f"Environment variable {env_var} not set. Check '.example.env' for details.","error")
             exit(1)
 
-    def outputMessage(self, message, level):
-    
-        if level == "error":
-            self.rootLogger.error(f"{self.process_id} - {message}")
-            #color = "\033[91m" # Red
-        elif level == "success":
-            self.rootLogger.info(f"{self.process_id} - {message}")
+    # Log a message for this process id. The message is only built when the level is logged, so a callable can be passed
+    # for messages that are expensive to build (like verbose dumps) and it is called then, args are %-formatted lazily
+    def outputMessage(self, message, level, *args):
+        log_level = OUTPUT_LEVELS.get(level, logging.INFO)
+        if not self.rootLogger.isEnabledFor(log_level):
+            return
+        if callable(message):
+            message = message()
+
+        self.rootLogger.log(log_level, message, *args, extra={"process_id": self.process_id, "message_type": level or "info"})
+        if level == "success" and not self.json_lines:
             color = "\033[92m" # Green
-            print(f"{str(datetime.datetime.now())} - {self.process_id} - {color}{message}")
+            print(f"{str(datetime.datetime.now())} - {self.process_id} - {color}{message % args if args else message}")
             print("\033[0m", end="") # Reset color
-        elif level == "info":
-            self.rootLogger.info(f"{self.process_id} - {message}")
-            #color = "\033[94m" # Blue
-        elif level == "warning":
-            self.rootLogger.warning(f"{self.process_id} - {message}")
-            #color = "\033[93m"  # Yellow
-        elif level == "debug":
-            self.rootLogger.debug(f"{self.process_id} - {message}")
-            #color = "\033[95m"  # Purple
-        elif level == "verbose":
-            self.rootLogger.debug(f"{self.process_id} - {message}")
-            #color = "\033[96m"  # Cyan
-        else:
-            self.rootLogger.info(f"{self.process_id} - {message}")
-            #color = "\033[0m" # white
-
-        #print(f"{str(datetime.datetime.now())} - {self.process_id} - {color}{message}")
-        #print("\033[0m", end="") # Reset color
 
     # increments the generated count to keep loop going, is there a better way to do this?
     def incrementGenerateCount(self):
         self.generated_count += 1
 
+    # Records the result of a single media object, only called from the main thread so the counters stay correct
+    def recordResult(self, result):
+        self.incrementGenerateCount()
+        if result == "success":
+            self.success_count += 1
+        elif result == "completion":
+            self.completion_fail_count += 1
+        elif result == "image":
+            self.image_fail_count += 1
+        elif result == "save":
+            self.save_fail_count += 1
+        elif result == "cancelled":
+            self.cancelled_count += 1
+
     # Creates a directory based upon the directory path provided
     def createDirectory(self, directory):
 
@@ -121,15 +229,14 @@ class processHelper:
         end_index = text.find(end)        
         return text[start_index:end_index+1]
 
+    # Get the first json object out of a completion, nested objects and braces inside strings are matched properly
     def extractJson(self, text, start, end):
-        start_index = text.find(start)
-        end_index = text.find(end)
-        text = text[start_index:end_index+1]
+        text = findJson(text, start, end)
         try:
             completion_json = json.loads(text)
         except:         
-            # Escape the json string and return it
-            completion_json = json.loads(text.replace("'", "\\'").replace("\n", "\\n"))
-            self.outputMessage(f"Issue loading json, had to do some escaping:\n{completion_json}.","warning")
+            # Models sometimes put raw newlines and tabs inside the strings, allow them and let us know
+            completion_json = json.loads(text, strict=False)
+            self.outputMessage(f"Issue loading json, had to allow control characters:\n{completion_json}.","warning")
 
         return completion_json
\ No newline at end of file
@@ -0,0 +1,73 @@
+from functools import lru_cache
+import re
+
+# Matches a {key} placeholder in a prompt
+_PLACEHOLDER = re.compile(r"\{([^{}]*)\}")
+
+# A prompt string split once into literal text and {key} slots so it can be rendered in a single pass
+# literals always has one more entry than slots, rendering is literals[0] + slots[0] + literals[1] + ...
+class promptTemplate:
+    def __init__(self, text):
+        self.text = text
+        self.literals = []
+        self.slots = []
+
+        last_index = 0
+        for match in _PLACEHOLDER.finditer(text):
+            self.literals.append(text[last_index:match.start()])
+            self.slots.append(match.group(1))
+            last_index = match.end()
+        self.literals.append(text[last_index:])
+
+    # Render the template, resolver is called with each slot key in order and returns the value to put in its place
+    def render(self, resolver):
+        literals = self.literals
+        parts = [literals[0]]
+        for index, key in enumerate(self.slots):
+            parts.append(str(resolver(key)))
+            parts.append(literals[index + 1])
+        return "".join(parts)
+
+# Compile a prompt string, the prompts are reused for every media object so the compiled templates are cached
+@lru_cache(maxsize=256)
+def compileTemplate(text):
+    return promptTemplate(text)
+
+# Shortcut to compile (cached) and render a prompt string
+def renderTemplate(text, resolver):
+    return compileTemplate(text).render(resolver)
+
+# Resolvers return the value for a key or None when they don't have it, so they can be chained
+
+# Resolves a key from the values already picked for the prompt (object_prompt_list), using the first value picked
+def promptListResolver(prompt_list):
+    def resolve(key):
+        values = prompt_list.get(key)
+        return values[0] if values else None
+    return resolve
+
+# Resolves a key from a dict of fields, e.g. the media object title, tagline and description
+def fieldResolver(fields):
+    def resolve(key):
+        return fields.get(key)
+    return resolve
+
+# Resolves a key with a random value from the template store, recording the value picked in the prompt list
+def templateValueResolver(get_value, prompt_list):
+    def resolve(key):
+        value = get_value(key)
+        if value is None or value is False:
+            return None
+        prompt_list.setdefault(key, []).append(value)
+        return value
+    return resolve
+
+# Tries each resolver in order and uses the default when none of them has the key
+def chainResolvers(*resolvers, default="NO VALUE"):
+    def resolve(key):
+        for resolver in resolvers:
+            value = resolver(key)
+            if value is not None:
+                return value
+        return default
+    return resolve
@@ -0,0 +1,285 @@
+from email.utils import parsedate_to_datetime
+import threading
+import datetime
+import logging
+import asyncio
+import random
+import httpx
+import time
+import os
+
+import openai
+
+from lib.metrics import getMetrics
+
+# Default retries of a request before the error is raised to the caller
+GOVERNOR_MAX_RETRIES = 6
+# Backoff before retry n is a random delay up to min(GOVERNOR_BACKOFF_MAX, GOVERNOR_BACKOFF_BASE * 2^n) seconds
+GOVERNOR_BACKOFF_BASE = 1
+GOVERNOR_BACKOFF_MAX = 60
+# Default max requests in flight per deployment when its MAX_CONCURRENCY isn't set
+GOVERNOR_MAX_CONCURRENCY = 32
+# Concurrency is only cut once per this many seconds, a burst of 429s from the requests already in flight is one signal
+GOVERNOR_DECREASE_INTERVAL = 2
+# Rough characters per token, used to estimate the tokens of a prompt before sending it
+CHARS_PER_TOKEN = 4
+
+# Status codes that mean the backend is throttling us (ollama answers 503 when its queue is full)
+THROTTLE_STATUS_CODES = (429, 503)
+# Status codes worth retrying that aren't throttling
+TRANSIENT_STATUS_CODES = (408, 500, 502, 504)
+# Errors from the connection itself, requests errors are OSErrors
+TRANSIENT_ERRORS = (OSError, httpx.TransportError, openai.APIConnectionError)
+
+logger = logging.getLogger(__name__)
+
+# Gets the http status code of an error from the openai, ollama, httpx or requests clients, None if it has none
+def getStatusCode(error):
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+# Gets how many seconds the backend asked us to wait from the Retry-After headers of the error, None if it didn't say
+def getRetryAfter(error):
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms:
+            return float(retry_after_ms) / 1000
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return None
+        if retry_after.replace(".", "", 1).isdigit():
+            return float(retry_after)
+        return max(0, (parsedate_to_datetime(retry_after) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def isThrottled(error):
+    return getStatusCode(error) in THROTTLE_STATUS_CODES or isinstance(error, openai.RateLimitError)
+
+def isTransient(error):
+    return getStatusCode(error) in TRANSIENT_STATUS_CODES or isinstance(error, TRANSIENT_ERRORS)
+
+# Estimate the tokens of a request from its prompt text plus the most it can answer with
+def estimateTokens(*texts, max_tokens=0):
+    return sum(len(text) for text in texts if isinstance(text, str)) // CHARS_PER_TOKEN + max_tokens
+
+# Budget of a per minute quota. Taking from it reserves the amount straight away and returns how long to wait until
+# the quota covers it, so callers queue up behind each other instead of all waking at once. 0 per minute is unlimited
+class tokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Reserve amount and return the seconds to wait before using it
+    def take(self, amount):
+        if self.capacity <= 0 or amount <= 0:
+            return 0
+        with self._lock:
+            self.refill(time.monotonic())
+            self.tokens -= min(amount, self.capacity)
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    # Correct an earlier reservation once the real amount is known, a positive amount takes more and negative gives back
+    def adjust(self, amount):
+        if self.capacity <= 0 or amount == 0:
+            return
+        with self._lock:
+            self.refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+# Governs the requests to one model deployment. Keeps them inside the requests and tokens per minute budgets, retries
+# throttling and transient errors with jittered exponential backoff (or as long as Retry-After says), and finds the
+# concurrency the backend can take with AIMD, halving it when throttled and growing it back by one per window of successes
+class requestGovernor:
+    def __init__(self, name, rpm=0, tpm=0, max_concurrency=GOVERNOR_MAX_CONCURRENCY, max_retries=GOVERNOR_MAX_RETRIES,
+                 backoff_base=GOVERNOR_BACKOFF_BASE, backoff_max=GOVERNOR_BACKOFF_MAX):
+        self.name = name
+        self.requests = tokenBucket(rpm)
+        self.tokens = tokenBucket(tpm)
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.in_flight = 0
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.throttled_count = 0
+        self.retry_count = 0
+        self._condition = threading.Condition()
+
+    def tryAcquire(self):
+        with self._condition:
+            if self.in_flight < max(1, int(self.concurrency)):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= max(1, int(self.concurrency)):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    # Additive increase, about one more slot after a full window of successful requests
+    def recordSuccess(self):
+        with self._condition:
+            if self.concurrency < self.max_concurrency:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self._condition.notify_all()
+
+    # Multiplicative decrease, and every request to the deployment waits out the Retry-After
+    def recordThrottle(self, retry_after):
+        now = time.monotonic()
+        with self._condition:
+            self.throttled_count += 1
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if now - self.last_decrease >= GOVERNOR_DECREASE_INTERVAL:
+                self.last_decrease = now
+                self.concurrency = max(1.0, self.concurrency / 2)
+
+    # Seconds before the next attempt of a request, the Retry-After when the backend gave one
+    def backoffDelay(self, attempt, error):
+        retry_after = getRetryAfter(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # How long to wait before sending a request of the estimated tokens
+    def budgetDelay(self, tokens):
+        delay = max(self.requests.take(1), self.tokens.take(tokens))
+        return max(delay, self.paused_until - time.monotonic())
+
+    # Whether the error is worth another attempt, retry_any also retries errors from the request itself
+    def shouldRetry(self, attempt, error, retry_any):
+        if attempt >= self.max_retries:
+            return False
+        return retry_any or isThrottled(error) or isTransient(error)
+
+    # Count the failed request in the metrics, by whether the backend throttled it, it can be retried or neither
+    def recordError(self, error):
+        kind = "throttled" if isThrottled(error) else "transient" if isTransient(error) else "error"
+        getMetrics().recordError(self.name, kind)
+
+    def handleError(self, attempt, error, tokens):
+        # A failed request didn't use its tokens
+        self.tokens.adjust(-tokens)
+        if isThrottled(error):
+            self.recordThrottle(getRetryAfter(error))
+        delay = self.backoffDelay(attempt, error)
+        self.retry_count += 1
+        logger.warning(f"{self.name} request failed, attempt {attempt + 1} of {self.max_retries + 1}, retrying in {delay:.1f}s: {error}")
+        return delay
+
+    def handleSuccess(self, result, tokens, used_tokens, seconds):
+        self.recordSuccess()
+        actual_tokens = None
+        if used_tokens is not None:
+            try:
+                actual_tokens = used_tokens(result)
+            except Exception:
+                actual_tokens = None
+            if actual_tokens is not None:
+                self.tokens.adjust(actual_tokens - tokens)
+        getMetrics().recordRequest(self.name, seconds, actual_tokens if actual_tokens is not None else tokens)
+
+    # Send a request under the governor. tokens is the estimate reserved from the tokens budget, used_tokens optionally
+    # gets the real count from the result to correct it. Errors are raised once they can't or shouldn't be retried
+    def call(self, request, tokens=0, used_tokens=None, retry_any=False):
+        attempt = 0
+        while True:
+            time.sleep(max(0, self.budgetDelay(tokens)))
+            self.acquire()
+            start = time.perf_counter()
+            try:
+                result = request()
+            except Exception as e:
+                self.recordError(e)
+                if not self.shouldRetry(attempt, e, retry_any):
+                    raise
+                delay = self.handleError(attempt, e, tokens)
+            else:
+                self.handleSuccess(result, tokens, used_tokens, time.perf_counter() - start)
+                return result
+            finally:
+                self.release()
+            time.sleep(delay)
+            attempt += 1
+
+    async def callAsync(self, request, tokens=0, used_tokens=None, retry_any=False):
+        attempt = 0
+        while True:
+            await asyncio.sleep(max(0, self.budgetDelay(tokens)))
+            while not self.tryAcquire():
+                await asyncio.sleep(.05)
+            start = time.perf_counter()
+            try:
+                result = await request()
+            except Exception as e:
+                self.recordError(e)
+                if not self.shouldRetry(attempt, e, retry_any):
+                    raise
+                delay = self.handleError(attempt, e, tokens)
+            else:
+                self.handleSuccess(result, tokens, used_tokens, time.perf_counter() - start)
+                return result
+            finally:
+                self.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "concurrency": round(self.concurrency, 2),
+            "in_flight": self.in_flight,
+            "throttled": self.throttled_count,
+            "retries": self.retry_count
+        }
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+def getEnvNumber(name, default):
+    value = os.getenv(name, "")
+    return int(value) if value.isdigit() else default
+
+# Get the shared governor for a deployment. The budgets come from the environment using the prefix of the model,
+# e.g. AZURE_OPENAI_TEXT_RPM, AZURE_OPENAI_TEXT_TPM and AZURE_OPENAI_TEXT_MAX_CONCURRENCY, unset budgets are unlimited
+def getGovernor(env_prefix, deployment=""):
+    governor_key = (env_prefix, deployment)
+    governor = _governors.get(governor_key)
+    if governor is None:
+        with _governors_lock:
+            governor = _governors.get(governor_key)
+            if governor is None:
+                governor = _governors[governor_key] = requestGovernor(
+                    f"{env_prefix} {deployment}".strip(),
+                    rpm=getEnvNumber(f"{env_prefix}_RPM", 0),
+                    tpm=getEnvNumber(f"{env_prefix}_TPM", 0),
+                    max_concurrency=getEnvNumber(f"{env_prefix}_MAX_CONCURRENCY", GOVERNOR_MAX_CONCURRENCY),
+                    max_retries=getEnvNumber("GOVERNOR_MAX_RETRIES", GOVERNOR_MAX_RETRIES))
+    return governor
+
+# State of every governor, for the end of run summary
+def getGovernorStats():
+    with _governors_lock:
+        return [governor.to_json() for governor in _governors.values()]
@@ -0,0 +1,203 @@
+import json
+import os
+import re
+
+from lib.json_stream import findJson
+
+# JSON schemas of what each stage asks the model for. With STRUCTURED_OUTPUT on they are sent as structured output
+# (Azure response_format, ollama format) so the backend only produces completions that parse, and every completion
+# is checked against them with validateJson. required lists what a completion can't be used without, the other
+# properties are dropped when they don't fit. The schema sent to the backend asks for every property since that is
+# what Azure strict mode needs
+
+MOVIE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string", "minLength": 1},
+        "tagline": {"type": "string", "minLength": 1},
+        "description": {"type": "string", "minLength": 1},
+        "mpaa_rating": {"type": "string"},
+        "rating_content": {"type": "string"}
+    },
+    "required": ["title", "tagline", "description"],
+    "additionalProperties": False
+}
+
+CRITIC_REVIEW_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "critic_score": {"type": "number"},
+        "critic_review": {"type": "string", "minLength": 1},
+        "critic_tone": {"type": "string"}
+    },
+    "required": ["critic_score", "critic_review"],
+    "additionalProperties": False
+}
+
+IMAGE_PROMPT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "image_prompt": {"type": "string", "minLength": 1},
+        "font": {"type": "string"}
+    },
+    "required": ["image_prompt"],
+    "additionalProperties": False
+}
+
+VISION_LAYOUT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "location": {"type": "string", "enum": ["top", "middle", "bottom"]},
+        "location_padding": {"type": "integer"},
+        "font_color": {"type": "string"},
+        "has_text": {"type": "boolean"}
+    },
+    "required": [],
+    "additionalProperties": False
+}
+
+# The movie, its critic reviews and the poster prompt from one request in fused mode
+FUSED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "movie": MOVIE_SCHEMA,
+        "reviews": {"type": "array", "items": CRITIC_REVIEW_SCHEMA, "minItems": 1},
+        "poster": IMAGE_PROMPT_SCHEMA
+    },
+    "required": ["movie", "reviews", "poster"],
+    "additionalProperties": False
+}
+
+# Name of each schema as sent to the backend
+SCHEMA_NAMES = {
+    id(MOVIE_SCHEMA): "movie",
+    id(CRITIC_REVIEW_SCHEMA): "critic_review",
+    id(IMAGE_PROMPT_SCHEMA): "image_prompt",
+    id(VISION_LAYOUT_SCHEMA): "vision_layout",
+    id(FUSED_SCHEMA): "fused_media"
+}
+
+_TYPE_CHECKS = {
+    "object": lambda value: isinstance(value, dict),
+    "array": lambda value: isinstance(value, list),
+    "string": lambda value: isinstance(value, str),
+    "boolean": lambda value: isinstance(value, bool),
+    "integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool)
+}
+
+# Structured output is only sent when STRUCTURED_OUTPUT is true. Older api versions and models without json_schema
+# support answer it with a 400 that isn't retried, so it is off unless the deployment is known to take it
+def structuredOutputEnabled():
+    return os.getenv("STRUCTURED_OUTPUT", "false").lower() == "true"
+
+def getSchemaName(schema):
+    return SCHEMA_NAMES.get(id(schema), "response")
+
+# Keywords only checked by validateJson, Azure strict mode and the ollama grammar don't take them
+VALIDATION_ONLY_KEYWORDS = ("minLength", "minimum", "maximum", "minItems")
+
+_backend_schemas = {}
+
+# The schema as sent to the backend, every property of an object is required and the validation only keywords are left out
+def getBackendSchema(schema):
+    backend_schema = _backend_schemas.get(id(schema))
+    if backend_schema is None:
+        def strip(value):
+            value = {key: item for key, item in value.items() if key not in VALIDATION_ONLY_KEYWORDS}
+            if "properties" in value:
+                value["properties"] = {key: strip(item) for key, item in value["properties"].items()}
+                value["required"] = list(value["properties"])
+            if "items" in value:
+                value["items"] = strip(value["items"])
+            return value
+        backend_schema = _backend_schemas[id(schema)] = strip(schema)
+    return backend_schema
+
+# The response_format for an Azure OpenAI chat completion
+def azureResponseFormat(schema):
+    if schema is None or not structuredOutputEnabled():
+        return None
+    return {"type": "json_schema", "json_schema": {"name": getSchemaName(schema), "schema": getBackendSchema(schema), "strict": True}}
+
+# The format for an ollama chat
+def ollamaFormat(schema):
+    if schema is None or not structuredOutputEnabled():
+        return None
+    return getBackendSchema(schema)
+
+# Numbers sometimes come back as strings from backends without structured output, "7" is taken as 7 and a score like
+# "8/10" or "7.5 out of 10" as the number it starts with
+def coerceNumber(value, value_type):
+    if isinstance(value, str):
+        match = re.match(r"\s*(-?\d+(?:\.\d+)?)", value)
+        if match is None:
+            return value
+        number = float(match.group(1))
+        if value_type == "integer" and number.is_integer():
+            return int(number)
+        if value_type == "number":
+            return int(number) if number.is_integer() else number
+    return value
+
+# Check the data against the schema, returns the list of problems found (empty when it is valid) and the data with
+# numeric strings converted. Only the parts of json schema used by the schemas here are checked. Properties that aren't
+# required and don't fit are dropped from the data instead of failing it, the stages have defaults for them
+def validateJson(data, schema, path="$"):
+    errors = []
+    value_type = schema.get("type")
+    if value_type in ("integer", "number"):
+        data = coerceNumber(data, value_type)
+    if value_type and not _TYPE_CHECKS[value_type](data):
+        return [f"{path} should be {value_type}"], data
+    if "enum" in schema and data not in schema["enum"]:
+        errors.append(f"{path} should be one of {schema['enum']}")
+    if "minLength" in schema and len(data) < schema["minLength"]:
+        errors.append(f"{path} is empty")
+    if "minimum" in schema and data < schema["minimum"]:
+        errors.append(f"{path} is under {schema['minimum']}")
+    if "maximum" in schema and data > schema["maximum"]:
+        errors.append(f"{path} is over {schema['maximum']}")
+    if "minItems" in schema and len(data) < schema["minItems"]:
+        errors.append(f"{path} has fewer than {schema['minItems']} items")
+    if value_type == "array" and "items" in schema:
+        for index, item in enumerate(data):
+            item_errors, data[index] = validateJson(item, schema["items"], f"{path}[{index}]")
+            errors.extend(item_errors)
+    if value_type == "object":
+        required = schema.get("required", [])
+        for key in required:
+            if key not in data:
+                errors.append(f"{path}.{key} is missing")
+        for key, property_schema in schema.get("properties", {}).items():
+            if key in data:
+                property_errors, data[key] = validateJson(data[key], property_schema, f"{path}.{key}")
+                if property_errors and key not in required:
+                    del data[key]
+                else:
+                    errors.extend(property_errors)
+    return errors, data
+
+# Parse a completion and check it against the schema, raises ValueError when something it requires is missing or
+# wrong. Anything else that doesn't fit is left out so the stage uses its default, the completion has been paid for.
+# Structured output gives plain json so that is tried first, otherwise the json object is found in the text
+def parseCompletion(completion, schema):
+    try:
+        data = json.loads(completion)
+    except ValueError:
+        data = json.loads(findJson(completion), strict=False)
+
+    errors, data = validateJson(data, schema)
+    if errors:
+        raise ValueError(f"Completion doesn't match the {getSchemaName(schema)} schema: {', '.join(errors)}")
+    return data
+
+# Whether the completion parses and fits the schema, any completion fits when there is no schema
+def completionMatches(completion, schema):
+    if schema is None:
+        return True
+    try:
+        parseCompletion(completion, schema)
+    except Exception:
+        return False
+    return True
@@ -0,0 +1,64 @@
+import threading
+
+# Pass rate each stage is assumed to have before jobs have gone through it, counted as PRIOR_WEIGHT jobs
+PRIOR_PASS_RATE = 0.95
+PRIOR_WEIGHT = 10
+# Default most media objects started for a target, as a multiple of the target
+MAX_JOBS_FACTOR = 3
+
+# Feeds a pipeline media objects until a target number of them have succeeded. Enough objects are kept in flight to
+# make up for the failures seen so far at each stage: a job in a stage is expected to succeed at the pass rate of that
+# stage and every stage after it, and new jobs are started while the successes plus the expected successes of the jobs
+# in flight fall short of the target. Once the target is reached the pipeline is cancelled so the surplus jobs stop
+class successTarget:
+    def __init__(self, pipeline, target, max_jobs=None, poll_interval=0.5):
+        self.pipeline = pipeline
+        self.target = target
+        self.max_jobs = max_jobs if max_jobs else target * MAX_JOBS_FACTOR
+        self.poll_interval = poll_interval
+        self.started = 0
+        self.successes = 0
+        self._condition = threading.Condition()
+
+    # Successes so far plus the successes expected from the jobs still in the pipeline
+    def expectedSuccesses(self):
+        expected = self.successes
+        success_rate = 1.0
+        for stage in reversed(self.pipeline.stages):
+            success_rate *= stage.passRate(PRIOR_PASS_RATE, PRIOR_WEIGHT)
+            expected += stage.active * success_rate
+        return expected
+
+    # Whether to start another job, waits while the jobs in flight are expected to reach the target
+    def needsJob(self):
+        with self._condition:
+            while True:
+                if self.successes >= self.target or self.started >= self.max_jobs or self.pipeline.isCancelled():
+                    return False
+                if self.expectedSuccesses() < self.target:
+                    self.started += 1
+                    return True
+                # Jobs moving between stages change the estimate too, so check again after a while even without a result
+                self._condition.wait(self.poll_interval)
+
+    # Yields the jobs for the pipeline, create_job is called with the 1 based index of each job started
+    def jobs(self, create_job):
+        while self.needsJob():
+            yield create_job(self.started)
+
+    # Record a finished job, cancels the pipeline once the target is reached
+    def recordResult(self, result):
+        with self._condition:
+            if result == "success":
+                self.successes += 1
+                if self.successes >= self.target:
+                    self.pipeline.cancel()
+            self._condition.notify_all()
+
+    def to_json(self):
+        return {
+            "target": self.target,
+            "started": self.started,
+            "successes": self.successes,
+            "pass_rates": {stage.name: round(stage.passRate(PRIOR_PASS_RATE, PRIOR_WEIGHT), 3) for stage in self.pipeline.stages}
+        }
@@ -0,0 +1,81 @@
+from types import MappingProxyType
+import threading
+import random
+import json
+import glob
+import os
+import time
+
+# Holds the template json files in memory so they are only read and parsed once per process
+# The loaded templates are read only (mapping proxies of tuples) so they can be shared across worker threads
+class templateStore:
+    def __init__(self, templates_base, reload=False, reload_interval=2):
+        self.templates_base = templates_base
+        self.reload = reload
+        self.reload_interval = reload_interval
+        self._templates = {}
+        self._last_check = time.monotonic()
+        self._lock = threading.Lock()
+
+        for template_path in glob.glob(os.path.join(templates_base, "*.json")):
+            self._load(os.path.splitext(os.path.basename(template_path))[0])
+
+    def _load(self, template):
+        template_path = os.path.join(self.templates_base, f"{template}.json")
+        mtime = os.path.getmtime(template_path)
+        with open(template_path) as json_file:
+            template_json = json.load(json_file)
+        values = MappingProxyType({key: tuple(value) if isinstance(value, list) else value for key, value in template_json.items()})
+        self._templates[template] = (mtime, values)
+        return values
+
+    # When reload is enabled, reload any template files that have changed, checked at most every reload_interval seconds
+    def _checkReload(self):
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval:
+            return
+        with self._lock:
+            self._last_check = now
+            for template, (mtime, _) in list(self._templates.items()):
+                try:
+                    if os.path.getmtime(os.path.join(self.templates_base, f"{template}.json")) != mtime:
+                        self._load(template)
+                except (IOError, ValueError):
+                    # Keep the last good copy if the file is mid edit or gone
+                    pass
+
+    # Get the whole template file, e.g. getTemplate("prompts")["movie"]
+    def getTemplate(self, template):
+        if self.reload:
+            self._checkReload()
+        loaded = self._templates.get(template)
+        if loaded is None:
+            # Not found at startup, try loading it in case it was added since, raises IOError if it doesn't exist
+            with self._lock:
+                return self._load(template)
+        return loaded[1]
+
+    # Get the list of values for a template, e.g. getValues("actors")
+    def getValues(self, template):
+        return self.getTemplate(template)[template]
+
+    # Simply grabs a random value from the template
+    def getRandomValue(self, template):
+        return random.choice(self.getValues(template))
+
+    # Get the prompts from prompts.json
+    def getPrompts(self):
+        return self.getTemplate("prompts")
+
+_template_stores = {}
+_template_stores_lock = threading.Lock()
+
+# Get the process wide template store for a templates directory, creating it the first time it is needed
+def getTemplateStore(templates_base, reload=False):
+    store = _template_stores.get(templates_base)
+    if store is None:
+        with _template_stores_lock:
+            store = _template_stores.get(templates_base)
+            if store is None:
+                store = _template_stores[templates_base] = templateStore(templates_base, reload)
+    return store
@@ -0,0 +1,76 @@
+from PIL import ImageFont
+from functools import lru_cache
+
+# Size the font is first measured at to estimate the size that fits, the text length scales about linearly with the size
+REFERENCE_FONT_SIZE = 100
+# Largest font size we will ever use for a title
+MAX_FONT_SIZE = 4096
+
+# Loaded fonts by path and size, the binary search and every poster with the same font reuse them
+@lru_cache(maxsize=256)
+def loadFont(font_path, size):
+    return ImageFont.truetype(font_path, size)
+
+# Find the biggest font size where the text is still narrower than max_width. The length at the reference size gives an
+# estimate since it scales about linearly with the size, then a binary search around it finds the exact size in O(log n) loads
+def fitFontSize(font_path, text, max_width):
+    reference_length = loadFont(font_path, REFERENCE_FONT_SIZE).getlength(text)
+    if reference_length <= 0:
+        return MAX_FONT_SIZE
+    estimate = int(max_width * REFERENCE_FONT_SIZE / reference_length)
+
+    # Bracket the answer around the estimate, low fits and high doesn't
+    low = min(MAX_FONT_SIZE - 1, max(1, int(estimate * .9)))
+    while low > 1 and loadFont(font_path, low).getlength(text) >= max_width:
+        low = max(1, low // 2)
+    high = min(MAX_FONT_SIZE, max(low + 1, int(estimate * 1.1) + 1))
+    while high < MAX_FONT_SIZE and loadFont(font_path, high).getlength(text) < max_width:
+        low = high
+        high = min(MAX_FONT_SIZE, high * 2)
+
+    while high - low > 1:
+        middle = (low + high) // 2
+        if loadFont(font_path, middle).getlength(text) < max_width:
+            low = middle
+        else:
+            high = middle
+    return low
+
+# Split the title on a delimiter into lines, keeping the delimiter on the first line when there is only one of them
+def splitTitle(text_string, delimiter=":"):
+    text_list = text_string.split(delimiter)
+    # If the count of the delimiter in the string is 1 then add the delimtier back to the string
+    if text_string.count(delimiter) == 1:
+        text_list[0] += delimiter
+    return text_list
+
+# Work out the font and where each line of the title goes on the image. The font is sized so the longest line fills
+# scale of the image width, location is top, middle or bottom. Returns the font and a list of (x, y, line)
+def layoutTitle(font_path, text_list, image_size, location, location_padding, scale=.85):
+    img_w, img_h = image_size
+    max_text = max(text_list, key=len)
+
+    font = loadFont(font_path, fitFontSize(font_path, max_text, scale * img_w))
+
+    # The height of the font is the delta of its ascent and descent
+    ascent, descent = font.getmetrics()
+    font_height = ascent - descent
+    line_total = len(text_list)
+    section_top = location_padding
+    section_middle = (img_h / 2) - (font_height * line_total + (20 * line_total)) # Center of the image but offset by font, line count and general padding
+    section_bottom = img_h - (img_h / 8)
+    section_bottom = section_bottom - font_height if line_total > 1 else section_bottom # shave off one font height if there are two lines of text
+    y_placements = {"top": section_top, "middle": section_middle, "bottom": section_bottom}
+    y_start = y_placements.get(location, section_top)
+
+    w = font.getlength(max_text)
+    w_placement = (img_w - w) / 2
+    lines = []
+    for line_count, text_line in enumerate(text_list, start=1):
+        if line_count == 1:
+            y_placement = y_start
+        else:
+            y_placement = y_start + (font_height * (line_count - 1)) + (font_height * .70)
+        # remove proceeding and trailing spaces
+        lines.append((w_placement, y_placement, text_line.strip()))
+    return font, lines
@@ -7,7 +7,21 @@ import datetime
 from lib.process_helper import processHelper
 from lib.media import media
 from lib.image import image
-from lib.critic_review import criticReview
+from lib.critic_review import criticReview, pickCriticTones
+from lib.fused_generation import fusedGeneration
+from lib.aoai_batch import aoaiBatch
+from lib.schemas import MOVIE_SCHEMA, CRITIC_REVIEW_SCHEMA, IMAGE_PROMPT_SCHEMA, FUSED_SCHEMA
+from lib.aoai_model import TEXT_MAX_TOKENS
+from lib.template_store import getTemplateStore
+from lib.model_clients import closeClients, fileToBuffer
+from lib.poster_render import startRenderPool, stopRenderPool
+from lib.comfyui_pool import stopComfyPool
+from lib.job_ledger import jobLedger
+from lib.completion_cache import enableCompletionCache, closeCompletionCache
+from lib.request_governor import getGovernorStats
+from lib.pipeline import stagePipeline, pipelineStage
+from lib.success_target import successTarget
+from lib.metrics import getMetrics, startMetricsServer, startMetricsSnapshots, stopMetrics
 
 # REQUIREMENTS
 # pip install python-dotenv
@@ -19,6 +33,372 @@ from lib.critic_review import criticReview
 # but I made it worse. There is a lot that could be improved, lots of repeated logic/methods and just general messiness because it being such hybrid of procedural
 # and OOP
 
+# Holds everything for a single media object as it moves through the pipeline stages
+# resume is the job ledger entry when picking a media object back up from an earlier run, fused generates the text in
+# one request. Each object gets review_count critic reviews and is kept when at least review_quorum of them succeed
+class mediaJob:
+    def __init__(self, process, prompt_file_path, templates_base, verbose, index, count, ledger=None, resume=None, fused=False, review_count=1, review_quorum=1):
+        self.process = process
+        self.prompt_file_path = prompt_file_path
+        self.templates_base = templates_base
+        self.verbose = verbose
+        self.index = index
+        self.count = count
+        self.ledger = ledger
+        self.resume = resume
+        self.fused = fused
+        self.review_count = review_count
+        self.review_quorum = review_quorum
+        self.media_object = None
+        self.image_object = None
+        self.start_time = datetime.datetime.now()
+        self.image_start_time = self.start_time
+
+    # Whether the stage was already completed in an earlier run
+    def hasCompleted(self, stage):
+        return self.resume is not None and self.resume.hasCompleted(stage)
+
+    # Fused mode only starts objects from scratch, one picked up part way through the separate requests finishes with them
+    def isFused(self):
+        return self.fused and not self.hasCompleted("prompt")
+
+    # Record a completed stage in the job ledger
+    def recordStage(self, stage):
+        if self.ledger is not None:
+            self.ledger.recordStage(self.process.process_id, stage, self.media_object)
+
+    # Close the generated image buffer once the job is done with it, success or not, a buffer that spilled to a temp
+    # file would otherwise keep the file open until it is garbage collected
+    def close(self):
+        generated_image = getattr(self.image_object, "generated_image", None)
+        if hasattr(generated_image, "close"):
+            generated_image.close()
+
+# Creates the media and image objects for the job, restoring them when resuming
+def startMediaJob(job):
+    process = job.process
+    job.start_time = datetime.datetime.now()
+
+    # Print the current media count being generated
+    process.outputMessage(f"Creating media object: {str(job.index)} of {str(job.count)}","info")
+    media_object=job.media_object=media(process, job.prompt_file_path, job.templates_base, job.verbose)
+    job.image_object = image(media_object)
+    if job.ledger is not None:
+        job.ledger.startJob(process.process_id)
+    if job.resume is not None and job.resume.state is not None:
+        media_object.restoreState(job.resume.state)
+        process.outputMessage(f"Resuming media object '{media_object.title}' after its {job.resume.stage} stage","info")
+
+# Text stage, builds the prompt and generates the media object, critic review and image prompt
+# Each stage returns None to hand the job to the next stage or the name of the stage that failed
+# Steps completed in an earlier run are skipped when resuming and each completed step is recorded in the job ledger
+# Each step is timed in the metrics under its own name
+def textStage(job):
+    startMediaJob(job)
+    if job.isFused():
+        steps = [("image_prompt", "fused", fusedStep)]
+    else:
+        steps = [("prompt", "prompt", promptStep), ("completion", "object", objectStep), ("review", "critic", reviewStep), ("image_prompt", "image_prompt", imagePromptStep)]
+    for stage, metric, step in steps:
+        if job.hasCompleted(stage):
+            continue
+        with getMetrics().timeStage(metric):
+            result = step(job)
+        if result is not None:
+            return result
+        job.recordStage(stage)
+
+def promptStep(job):
+    process = job.process
+    media_object = job.media_object
+    # Build the prompt and print it when verbose mode is enabled and successful
+    process.outputMessage(f"Building object prompt","")
+    if not media_object.generateObjectPrompt():
+        return "prompt"
+    if job.verbose: 
+        process.outputMessage(lambda: f"Object prompt:\n {media_object.movie_prompt}","verbose")
+        process.outputMessage(lambda: f"Template list:\n {json.dumps(media_object.object_prompt_list, indent=4)}","verbose")
+    process.outputMessage(f"Finished building prompt, build time: {str(datetime.datetime.now() - job.start_time)}","")
+
+def objectStep(job):
+    process = job.process
+    media_object = job.media_object
+    # Submit the object prompt for completion and print the object completion when verbose mode is enabled and successful
+    process.outputMessage(f"Submitting object prompt for completion","")
+    if not media_object.generateObject():
+        return "completion"
+    if job.verbose:
+        process.outputMessage(lambda: f"Object completion:\n {json.dumps(media_object.to_json(), indent=4)}","verbose") # Print the completion
+    process.outputMessage(f"Finished generating media object '{media_object.title}', object generate time: {str(datetime.datetime.now() - job.start_time)}","")
+
+# Builds a critic review in a different tone for each of the reviews the job gets, None if a prompt couldn't be built
+def buildCriticReviews(job):
+    media_object = job.media_object
+    try:
+        tones = pickCriticTones(media_object, job.review_count)
+    except Exception as e:
+        job.process.outputMessage(f"An issue occurred picking the critic tones: {e}", "error")
+        return None
+    reviews = []
+    for tone in tones:
+        review = criticReview(media_object, job.verbose)
+        if not review.buildCriticPrompt(tone):
+            return None
+        reviews.append(review)
+    return reviews
+
+def reviewStep(job):
+    process = job.process
+    media_object = job.media_object
+    #Creating the critic reviews for the movie, all of them at the same time
+    process.outputMessage(f"Creating {job.review_count} critic review{'s' if job.review_count > 1 else ''} for '{media_object.title}'","")
+    reviews = buildCriticReviews(job)
+    if reviews is None:
+        return "prompt"
+    if job.verbose:
+        for review in reviews:
+            process.outputMessage(lambda: f"Critic prompt:\n {review.prompt}","verbose")
+    generated = criticReview.generateCriticReviews(reviews)
+    # The object is kept when a quorum of the reviews came back, the failed ones are left out
+    media_object.reviews.extend(review.to_json() for review, success in zip(reviews, generated) if success)
+    review_count = sum(generated)
+    if review_count < job.review_quorum:
+        process.outputMessage(f"Only {review_count} of {len(reviews)} critic reviews created for '{media_object.title}', needed {job.review_quorum}","error")
+        return "completion"
+    if review_count < len(reviews):
+        process.outputMessage(f"{len(reviews) - review_count} of {len(reviews)} critic reviews failed for '{media_object.title}', keeping the {review_count} that succeeded","warning")
+    if job.verbose:        
+        process.outputMessage(lambda: f"Critic review:\n {media_object.reviews}","verbose")
+    process.outputMessage(f"Critic review{'s' if review_count > 1 else ''} created for '{media_object.title}', critic review generate time: {str(datetime.datetime.now() - job.start_time)}","")
+
+def imagePromptStep(job):
+    process = job.process
+    media_object = job.media_object
+    ### Image creation ###
+    image_start_time = job.image_start_time = datetime.datetime.now()
+    process.outputMessage(f"Creating image for '{media_object.title}'","")
+    # Generate the image prompt and print it when verbose mode is enabled and successful
+    process.outputMessage(f"Generating image prompt for '{media_object.title}'","") 
+    
+    if not job.image_object.generateImagePrompt():
+        return "completion"
+    if job.verbose: 
+        process.outputMessage(lambda: f"Image prompt:\n{media_object.image_prompt['image_prompt']}","verbose")
+    process.outputMessage(f"Image prompt generated for '{media_object.title}', image prompt generate time: {str(datetime.datetime.now() - image_start_time)}","")
+
+# Fused mode text step, the object, critic reviews and image prompt from one request
+def fusedStep(job):
+    process = job.process
+    media_object = job.media_object
+    job.image_start_time = datetime.datetime.now()
+    process.outputMessage(f"Building fused prompt with {job.review_count} critic review{'s' if job.review_count > 1 else ''}","")
+    fused = fusedGeneration(media_object, job.image_object, job.review_count, job.review_quorum)
+    if not fused.buildFusedPrompt():
+        return "prompt"
+    if job.verbose:
+        process.outputMessage(lambda: f"Fused prompt:\n {media_object.movie_prompt}","verbose")
+        process.outputMessage(lambda: f"Template list:\n {json.dumps(media_object.object_prompt_list, indent=4)}","verbose")
+    process.outputMessage(f"Submitting fused prompt for completion","")
+    if not fused.generateFused():
+        return "completion"
+    process.outputMessage(f"Finished generating media object '{media_object.title}' with reviews and image prompt, fused generate time: {str(datetime.datetime.now() - job.start_time)}","")
+
+# Batch waves, each returns the requests for the job and how many of them have to succeed, or None when the prompts
+# couldn't be built. A request is the system prompt, user prompt, the schema of the completion, the most tokens it can
+# use and a function that takes the completion and returns True if it was used
+def objectWave(job):
+    media_object = job.media_object
+    return [(media_object.movie_prompt["movie_system"], media_object.movie_prompt["movie"], MOVIE_SCHEMA, TEXT_MAX_TOKENS, media_object.parseObjectCompletion)], 1
+
+# The completions are used in the order the reviews were asked for once the whole wave is back
+def reviewWave(job):
+    media_object = job.media_object
+    reviews = buildCriticReviews(job)
+    if reviews is None:
+        return None
+    def useReview(review):
+        def useCompletion(completion):
+            if not review.parseCriticCompletion(completion):
+                return False
+            media_object.reviews.append(review.to_json())
+            return True
+        return useCompletion
+    return [(review.system_prompt, review.prompt, CRITIC_REVIEW_SCHEMA, TEXT_MAX_TOKENS, useReview(review)) for review in reviews], job.review_quorum
+
+def imagePromptWave(job):
+    if not job.image_object.buildImagePrompt():
+        return None
+    image_prompt = job.media_object.image_prompt
+    return [(image_prompt["image_prompt_system"], image_prompt["image_prompt"], IMAGE_PROMPT_SCHEMA, TEXT_MAX_TOKENS, job.image_object.parseImagePromptCompletion)], 1
+
+def fusedWave(job):
+    fused = fusedGeneration(job.media_object, job.image_object, job.review_count, job.review_quorum)
+    if not fused.buildFusedPrompt():
+        return None
+    return [(fused.system_prompt, fused.prompt, FUSED_SCHEMA, fused.getMaxTokens(), fused.parseFusedCompletion)], 1
+
+# Batch mode text stage, the object, critic review and image prompt completions for all the jobs are sent as Azure OpenAI
+# batch jobs, one wave after the other since each wave needs the completions of the one before it. Fused jobs have all
+# three in the image prompt wave
+# Returns the failed jobs with the name of the stage that failed, the rest are ready for the image stage
+def runBatchWaves(jobs, process):
+    failed = {}
+    for job in jobs:
+        startMediaJob(job)
+        if not job.hasCompleted("prompt") and not job.isFused():
+            with getMetrics().timeStage("prompt"):
+                result = promptStep(job)
+            if result is not None:
+                failed[job] = result
+                continue
+            job.recordStage("prompt")
+
+    for stage, wave in [("completion", objectWave), ("review", reviewWave), ("image_prompt", imagePromptWave)]:
+        wave_jobs = {}
+        batch = None
+        try:
+            batch = aoaiBatch()
+        except Exception as e:
+            process.outputMessage(f"Error creating the batch client: {e}","error")
+        for job in jobs:
+            if job in failed or job.hasCompleted(stage) or (job.isFused() and stage != "image_prompt"):
+                continue
+            if batch is None:
+                failed[job] = "completion"
+                continue
+            wave_requests = (fusedWave if job.isFused() else wave)(job)
+            if wave_requests is None:
+                failed[job] = "prompt"
+                continue
+            requests, quorum = wave_requests
+            # Each request is found in the results by the process id of its job and its index
+            custom_ids = []
+            for index, (system_prompt, user_prompt, schema, max_tokens, useCompletion) in enumerate(requests):
+                custom_id = job.process.process_id if index == 0 else f"{job.process.process_id}-{index}"
+                batch.addRequest(custom_id, system_prompt, user_prompt, max_tokens=max_tokens, schema=schema)
+                custom_ids.append((custom_id, useCompletion))
+            wave_jobs[job] = (custom_ids, quorum)
+        if not wave_jobs:
+            continue
+
+        wave_start_time = datetime.datetime.now()
+        request_count = len(batch.requests)
+        process.outputMessage(f"Submitting {stage} batch of {request_count} prompt{'s' if request_count > 1 else ''}","info")
+        try:
+            with getMetrics().timeStage(f"batch_{stage}"):
+                results = batch.run()
+        except Exception as e:
+            process.outputMessage(f"Error running the {stage} batch: {e}","error")
+            results = {}
+        for job, (custom_ids, quorum) in wave_jobs.items():
+            used_count = 0
+            for custom_id, useCompletion in custom_ids:
+                completion = results.get(custom_id, Exception("Batch did not run"))
+                if isinstance(completion, Exception):
+                    job.process.outputMessage(f"Error generating {stage} in batch: {completion}","error")
+                elif useCompletion(completion):
+                    used_count += 1
+            if used_count < quorum:
+                failed[job] = "completion"
+            else:
+                job.recordStage(stage)
+        process.outputMessage(f"Finished {stage} batch, batch time: {str(datetime.datetime.now() - wave_start_time)}","info")
+    return failed
+
+# Picks up the image saved by an earlier run, True if there was one
+def resumeImage(job):
+    if not job.hasCompleted("image"):
+        return False
+    job.image_object.generated_image = fileToBuffer(job.resume.image_path)
+    job.process.outputMessage(f"Using image generated by an earlier run for '{job.media_object.title}'","")
+    return True
+
+# Saves the generated image to the job ledger so it isn't generated again if the run is resumed
+def recordImage(job):
+    if job.ledger is not None:
+        job.ledger.recordImage(job.process.process_id, job.image_object.generated_image, job.media_object)
+
+# Image stage, generates the poster image from the image prompt
+def imageStage(job):
+    if resumeImage(job):
+        return None
+    media_object = job.media_object
+    job.process.outputMessage(f"Generating image for '{media_object.title}' from prompt","")
+    with getMetrics().timeStage("image"):
+        generated = job.image_object.generateImage()
+    if not generated:
+        return "image"
+    recordImage(job)
+
+# Image stage when batching, generates the poster images for several jobs in one request
+def imageBatchStage(jobs):
+    generate_jobs = [job for job in jobs if not resumeImage(job)]
+    for job in generate_jobs:
+        job.process.outputMessage(f"Generating image for '{job.media_object.title}' from prompt, batch of {len(generate_jobs)}","")
+    batch_start_time = datetime.datetime.now()
+    generated = dict(zip(generate_jobs, image.generateImageBatch([job.image_object for job in generate_jobs])))
+    batch_seconds = (datetime.datetime.now() - batch_start_time).total_seconds()
+    for job in generate_jobs:
+        # Every image in the batch took as long as the batch
+        getMetrics().observeStage("image", batch_seconds)
+        if generated[job]:
+            recordImage(job)
+    return [None if generated.get(job, True) else "image" for job in jobs]
+
+# Vision stage, asks the vision model where and how the title should go on the poster
+def visionStage(job):
+    with getMetrics().timeStage("vision"):
+        analyzed = job.image_object.analyzeImage()
+    if not analyzed:
+        job.process.outputMessage(f"Error processing image for '{job.media_object.title}'","error")
+        return "image"
+
+# Render stage, adds the title to the poster and saves the media object and image
+def renderStage(job):
+    process = job.process
+    media_object = job.media_object
+    image_object = job.image_object
+
+    # Add text to image
+    with getMetrics().timeStage("render"):
+        rendered = image_object.addTitle()
+    if not rendered:
+        process.outputMessage(f"Error processing image for '{media_object.title}'","error")
+        return "image"
+
+    process.outputMessage(f"Image created for '{media_object.title}', image generate time: {str(datetime.datetime.now() - job.image_start_time)}","")
+    media_object.image_generation_time = datetime.datetime.now()
+    media_object.create_time=datetime.datetime.now()
+    
+    # Save the media object and image to the outputs directory
+    with getMetrics().timeStage("save"):
+        return saveMedia(job)
+
+# Saves the media object json and the poster, cleaning up the json if the poster can't be saved
+def saveMedia(job):
+    process = job.process
+    media_object = job.media_object
+    image_object = job.image_object
+    if not media_object.saveMediaObject(): # Json failed to save
+        process.outputMessage(f"Error saving media object '{media_object.title}', image not saved","error")
+        media_object.objectCleanup()
+        return "save"
+
+    # Save Poster Image
+    if not image_object.saveImage(): # Image failed to save, deleting media object
+        process.outputMessage(f"Error saving image for '{media_object.title}', cleaning up media json created","error")
+        media_object.objectCleanup()
+        return "save"
+
+    process.outputMessage(f"Media created: '{media_object.title}', generate time: {str(datetime.datetime.now() - job.start_time)}","success")
+    return "success"
+
+# Reads a worker count from the command line value, falling back to the default when not set or not a digit
+def getWorkerCount(value, default):
+    if value and str(value).isdigit() and int(value) > 0:
+        return int(value)
+    return default
+
 # Main function to run the generator
 def main():
 
@@ -61,121 +441,153 @@ def main():
     parser.add_argument("-d", "--dryrun", action='store_true', help="Dry run, generate a response without saving it to a file")
     # Argument for verbose mode, to display object outputs
     parser.add_argument("-v", "--verbose", action='store_true', help="Show details of steps and outputs like prompts and completions")
+    # Argument for the log format, json writes one json object per line to the log file and console for log shippers
+    parser.add_argument("--log-format", choices=["text", "json"], default=os.environ.get('LOG_FORMAT', 'text').lower(), help="Write the log as text or as json lines")
+    # Argument to reload template files when they change, handy when tuning templates during a long run
+    parser.add_argument("--reload-templates", action='store_true', help="Reload template files when they change during the run")
+    # Argument to pick up media objects that didn't finish in earlier runs from the job ledger
+    parser.add_argument("-r", "--resume", action='store_true', help="Resume unfinished media objects from earlier runs before starting new ones")
+    # Argument to answer repeated prompts from the completion cache on disk instead of the model backend
+    parser.add_argument("--cache", action='store_true', default=os.environ.get('COMPLETION_CACHE', '').lower() == "true", help="Cache model completions on disk and reuse them for identical prompts")
+    # Argument to send the text completions as Azure OpenAI batch jobs, cheaper for big overnight runs but they take a while
+    parser.add_argument("-b", "--batch", action='store_true', help="Generate the text completions with the Azure OpenAI Batch API, in waves for the objects, critic reviews and image prompts")
+    # Argument to generate the object, critic reviews and image prompt in one request instead of one request each
+    parser.add_argument("--fused", action='store_true', default=os.environ.get('GENERATE_FUSED', '').lower() == "true", help="Generate the object, critic reviews and image prompt with a single text request")
+    # Arguments for the number of critic reviews for each media object, in different tones, and how many of them have to succeed to keep the object
+    parser.add_argument("--reviews", default=os.environ.get('GENERATE_REVIEWS'), help="Number of critic reviews for each media object, generated at the same time")
+    parser.add_argument("--review-quorum", default=os.environ.get('GENERATE_REVIEW_QUORUM'), help="Number of critic reviews that have to succeed to keep the media object, defaults to 1")
+    # Argument to treat the count as the number of media objects that have to succeed, starting extra ones to make up for failures
+    parser.add_argument("-t", "--target", action='store_true', default=os.environ.get('GENERATE_TARGET', '').lower() == "true", help="Keep generating until count media objects have succeeded, with extra ones in flight to make up for failures")
+    parser.add_argument("--max-jobs", default=os.environ.get('GENERATE_MAX_JOBS'), help="Most media objects started to reach the target, defaults to 3 times the count")
+    # Arguments for the metrics, per stage latency and per backend requests, tokens and errors
+    parser.add_argument("--metrics-port", default=os.environ.get('METRICS_PORT'), help="Serve the metrics on this port, /metrics for Prometheus and /metrics.json")
+    parser.add_argument("--metrics-snapshot", default=os.environ.get('METRICS_SNAPSHOT'), help="Write the metrics to outputs/metrics.json every this many seconds and at the end of the run")
+    # Argument for the number of media objects to run through the generation flow at the same time
+    parser.add_argument("-n", "--concurrency", default=os.environ.get('GENERATE_CONCURRENCY'), help="Number of media objects to generate at the same time")
+    # Arguments for the worker count of each pipeline stage, each defaults to the concurrency value
+    parser.add_argument("--text-workers", default=os.environ.get('GENERATE_TEXT_WORKERS'), help="Number of workers for the text stage (object, critic review and image prompt)")
+    parser.add_argument("--image-workers", default=os.environ.get('GENERATE_IMAGE_WORKERS'), help="Number of workers for the image generation stage")
+    parser.add_argument("--image-batch", default=os.environ.get('GENERATE_IMAGE_BATCH'), help="Number of posters to send to the image backend in one batch")
+    parser.add_argument("--vision-workers", default=os.environ.get('GENERATE_VISION_WORKERS'), help="Number of workers for the vision stage")
+    parser.add_argument("--render-processes", default=os.environ.get('GENERATE_RENDER_PROCESSES'), help="Number of processes for adding titles to posters and encoding them, 0 renders in the render workers")
+    parser.add_argument("--render-workers", default=os.environ.get('GENERATE_RENDER_WORKERS'), help="Number of workers for the title rendering and save stage")
     args = parser.parse_args()
+    # Batch jobs go to the Azure OpenAI Batch API, a local setup has nothing to send them to
+    if args.batch and os.getenv("MODEL_TYPE").lower() != "azure_openai":
+        parser.error("--batch needs MODEL_TYPE=azure_openai, the Batch API is only on Azure OpenAI")
+
+    # Poster rendering is CPU bound so it can be spread across processes, the render workers hand posters to the pool
+    # The pool is started before logging and the other threads start
+    render_processes = getWorkerCount(args.render_processes, 0)
+    startRenderPool(render_processes)
+
+    process.configureLogging(args.log_format == "json", args.verbose)
 
     start_time=datetime.datetime.now()
 
+    # Load the templates once for the whole run, the media objects share this store
+    getTemplateStore(templates_base, args.reload_templates)
+
     process.createProcessId()
     
     # Check if a count command line value is provided and is a digit, if not default to 1
     if(args.count) and args.count.isdigit():
         process.generate_count=int(args.count)
+
+    # Check if a concurrency value is provided and is a digit, if not default to 1 for the original one at a time behavior
+    concurrency = getWorkerCount(args.concurrency, 1)
+    review_count = getWorkerCount(args.reviews, 1)
+    review_quorum = min(getWorkerCount(args.review_quorum, 1), review_count)
     
     process.outputMessage(f"Starting creation of {str(process.generate_count)} media object{'s' if process.generate_count > 1 else ''}","")
+    if concurrency > 1: process.outputMessage(f"Generating up to {concurrency} media objects at the same time","info")
 
     # Notify if dry run mode is enabled
     if(args.dryrun): process.outputMessage("Dry run mode enabled, generated media objects will not be saved","verbose")
+    if args.fused: process.outputMessage(f"Fused mode enabled, one text request per media object with {review_count} critic review{'s' if review_count > 1 else ''}","info")
+
+    # Completions are cached on disk when enabled, reruns of the same prompts are answered from the cache
+    completion_cache = enableCompletionCache() if args.cache else None
+    if completion_cache is not None: process.outputMessage(f"Completion cache enabled: {completion_cache.cache_path}","verbose")
+
+    metrics_port = getWorkerCount(args.metrics_port, 0)
+    if metrics_port:
+        startMetricsServer(metrics_port)
+        process.outputMessage(f"Serving metrics on port {metrics_port}, /metrics and /metrics.json","info")
+    metrics_snapshot = getWorkerCount(args.metrics_snapshot, 0)
+    if metrics_snapshot:
+        process.outputMessage(f"Writing metrics to {startMetricsSnapshots(metrics_snapshot)} every {metrics_snapshot} seconds","info")
+
+    # Posters sent to the image backend together, waits up to a second for a batch to fill
+    image_batch = getWorkerCount(args.image_batch, 1)
 
     # Main loop to generate the media objects, including json and images
-    while process.generated_count < process.generate_count:
-        
-        object_start_time = datetime.datetime.now()
-
-        process.createProcessId()
-
-        # Print the current media count being generated
-        process.outputMessage(f"Creating media object: {str(process.generated_count+1)} of {str(process.generate_count)}","info")
-        media_object=media(process, prompt_file_path, templates_base, args.verbose)
-        # Build the prompt and print it when verbose mode is enabled and successful
-        process.outputMessage(f"Building object prompt","")
-        if not media_object.generateObjectPrompt():
-            process.incrementGenerateCount()
-            continue
-        if args.verbose: 
-            process.outputMessage(f"Object prompt:\n {media_object.movie_prompt}","verbose")
-            process.outputMessage(f"Template list:\n {json.dumps(media_object.object_prompt_list, indent=4)}","verbose")
-        process.outputMessage(f"Finished building prompt, build time: {str(datetime.datetime.now() - object_start_time)}","")
-
-        # Submit the object prompt for completion and print the object completion when verbose mode is enabled and successful
-        process.outputMessage(f"Submitting object prompt for completion","")
-        if not media_object.generateObject():
-            process.incrementGenerateCount()
-            process.completion_fail_count += 1
-            continue
-        else:
-            if args.verbose:
-                process.outputMessage(f"Object completion:\n {json.dumps(media_object, indent=4)}","verbose") # Print the completion
-            process.outputMessage(f"Finished generating media object '{media_object.title}', object generate time: {str(datetime.datetime.now() - object_start_time)}","")
-
-        #Creating a critic review for the movie
-        process.outputMessage(f"Creating critic review for '{media_object.title}'","")
-        review = criticReview(media_object, args.verbose)
-        if not review.buildCriticPrompt():
-            process.incrementGenerateCount()
-            continue
-        if args.verbose:
-            process.outputMessage(f"Critic prompt:\n {review.prompt}","verbose")
-        if not review.generateCriticReview():
-            process.incrementGenerateCount()
-            process.completion_fail_count += 1
-            continue
-        if args.verbose:        
-            process.outputMessage(f"Critic review:\n {media_object.reviews}","verbose")
-        media_object.reviews.append(review.to_json())
-        process.outputMessage(f"Critic review created for '{media_object.title}', critic review generate time: {str(datetime.datetime.now() - object_start_time)}","")
-    
+    # Each stage has its own workers connected by bounded queues so the slow image stages don't hold up the text stages
+    # Each object gets its own child process helper so its process id isn't shared, the counters are only touched here
+    # In batch mode the text completions are done in batch waves before the pipeline starts
+    text_stages = [] if args.batch else [pipelineStage("text", textStage, getWorkerCount(args.text_workers, concurrency))]
+    pipeline = stagePipeline(text_stages + [
+        pipelineStage("image", imageBatchStage if image_batch > 1 else imageStage, getWorkerCount(args.image_workers, concurrency), batch_size=image_batch, batch_wait=1),
+        pipelineStage("vision", visionStage, getWorkerCount(args.vision_workers, concurrency)),
+        pipelineStage("render", renderStage, getWorkerCount(args.render_workers, max(concurrency, render_processes))),
+    ], process)
+    # Every media object is recorded in the job ledger as it goes, when resuming the unfinished ones go first
+    ledger = jobLedger()
+    resume_entries = ledger.getResumableJobs(process.generate_count) if args.resume else []
+    if args.resume: process.outputMessage(f"Resuming {len(resume_entries)} unfinished media object{'s' if len(resume_entries) != 1 else ''} from earlier runs","info")
 
-        ### Image creation ###
-        image_start_time = datetime.datetime.now()
-        process.outputMessage(f"Creating image for '{media_object.title}'","")
-        image_object = image(media_object)
-        # Generate the image prompt and print it when verbose mode is enabled and successful
-        process.outputMessage(f"Generating image prompt for '{media_object.title}'","") 
-        
-        if not image_object.generateImagePrompt():
-            process.incrementGenerateCount()
-            process.completion_fail_count += 1
-            continue
-        if args.verbose: 
-            process.outputMessage(f"Image prompt:\n{image_object.poster_prompt['image_prompt']}","verbose")
-        process.outputMessage(f"Image prompt generated for '{media_object.title}', image prompt generate time: {str(datetime.datetime.now() - image_start_time)}","")
-
-        # Generate the image and if successful, add text to the image and save it as well as media object
-        process.outputMessage(f"Generating image for '{media_object.title}' from prompt","")
-        if image_object.generateImage():
-            # Add text to image
-            if not image_object.processImage():
-                process.outputMessage(f"Error processing image for '{media_object.title}'","error")
-                process.incrementGenerateCount()
-                process.image_fail_count += 1
-                continue
-            else:
-                process.outputMessage(f"Image created for '{media_object.title}', image generate time: {str(datetime.datetime.now() - image_start_time)}","")
-                media_object.image_generation_time = datetime.datetime.now()
-                media_object.create_time=datetime.datetime.now()
-                
-                # Save the media object and image to the outputs directory
-                if media_object.saveMediaObject(): # Json saved successfully
-                    # Save Poster Image
-                    if image_object.saveImage(): # Image saved successfully
-                        process.outputMessage(f"Media created: '{media_object.title}', generate time: {str(datetime.datetime.now() - object_start_time)}","success")
-                        process.success_count += 1
-                    else: # Image failed to save, deleting media object
-                        process.outputMessage(f"Error saving image for '{media_object.title}', cleaning up media json created","error")
-                        media_object.objectCleanup()
-                        process.save_fail_count += 1
-                else: # Json failed to save
-                    process.outputMessage(f"Error saving media object '{media_object.title}', image not saved","error")
-                    media_object.objectCleanup()
-                    process.incrementGenerateCount()
-                    process.save_fail_count += 1
-                    continue
-        else:
-            process.image_fail_count += 1
-
-        process.incrementGenerateCount()
+    def createJob(index):
+        job_process = process.createChild()
+        resume = resume_entries[index-1] if index <= len(resume_entries) else None
+        if resume is not None:
+            job_process.process_id = resume.process_id
+        return mediaJob(job_process, prompt_file_path, templates_base, args.verbose, index, process.generate_count, ledger, resume, args.fused, review_count, review_quorum)
+
+    # In target mode jobs are started until the count have succeeded, batch mode sends all its text requests up front
+    # so it keeps to the count
+    target = None
+    if args.target and args.batch:
+        process.outputMessage("Target mode isn't used with batch mode, generating the count","warning")
+    elif args.target:
+        target = successTarget(pipeline, process.generate_count, getWorkerCount(args.max_jobs, None))
+        process.outputMessage(f"Generating until {target.target} media objects succeed, starting up to {target.max_jobs}","info")
+        jobs = target.jobs(createJob)
+    else:
+        jobs = (createJob(index+1) for index in range(process.generate_count))
+    if args.batch:
+        jobs = list(jobs)
+        failed_jobs = runBatchWaves(jobs, process)
+        for job, result in failed_jobs.items():
+            job.close()
+            ledger.finishJob(job.process.process_id, result)
+            process.recordResult(result)
+            getMetrics().recordResult(result)
+        jobs = [job for job in jobs if job not in failed_jobs]
+    for job, result in pipeline.run(jobs):
+        job.close()
+        ledger.finishJob(job.process.process_id, result)
+        process.recordResult(result)
+        getMetrics().recordResult(result)
+        if target is not None:
+            target.recordResult(result)
+    ledger.close()
+    stopComfyPool()
+    closeClients()
+    stopRenderPool()
+    # Show how the backends held up when any requests had to be retried
+    governor_stats = [stats for stats in getGovernorStats() if stats["retries"] > 0]
+    if governor_stats: process.outputMessage(f"Request retries: {json.dumps(governor_stats)}","info")
+    if completion_cache is not None:
+        process.outputMessage(f"Completion cache: {json.dumps(completion_cache.to_json())}","info")
+        closeCompletionCache()
+    if target is not None:
+        process.outputMessage(f"Target: {json.dumps(target.to_json())}","info")
+    stage_metrics = getMetrics().to_json()["stages"]
+    if stage_metrics: process.outputMessage("Stage latency p50/p95/p99: " + ", ".join(f"{stage} {stats['p50']}/{stats['p95']}/{stats['p99']}s" for stage, stats in stage_metrics.items()),"info")
+    stopMetrics()
+    if process.cancelled_count: process.outputMessage(f"Cancelled {process.cancelled_count} surplus media object{'s' if process.cancelled_count > 1 else ''} once the target was reached, they can be resumed with --resume","info")
     
-    message_level = "success" if process.success_count == process.generate_count else "warning"
+    message_level = "success" if process.success_count >= process.generate_count else "warning"
     process.outputMessage(f"Finished generating {str(process.success_count)} media object{'s' if process.success_count > 1 else ''} of {process.generate_count}, Total Time: {str(datetime.datetime.now() - start_time)}",message_level)
     if process.success_count < process.generate_count:
         process.outputMessage(f"Prompt Completion failures: {process.completion_fail_count}\nImage Generate Failures: {process.image_fail_count}\nSave Failures: {process.save_fail_count}","info")
@@ -0,0 +1,147 @@
+from types import SimpleNamespace
+from unittest import mock
+import threading
+import unittest
+import json
+
+import lib.aoai_batch as aoai_batch
+from lib.aoai_batch import aoaiBatch
+from lib.schemas import MOVIE_SCHEMA
+
+BATCH_ENV = {
+    "AZURE_OPENAI_BATCH_ENDPOINT": "https://batch.invalid/",
+    "AZURE_OPENAI_BATCH_ENDPOINT_KEY": "test",
+    "AZURE_OPENAI_BATCH_API_VERSION": "2024-10-21",
+    "AZURE_OPENAI_BATCH_DEPLOYMENT_NAME": "batch-deployment",
+    "AZURE_OPENAI_BATCH_POLL_INTERVAL": "0",
+    "STRUCTURED_OUTPUT": "true"
+}
+
+# Fake of the files and batches parts of the openai client. A batch job is in progress on its first check and then
+# ends in final_status. Requests with "bad" in their custom id fail in the output file, ones with "lost" only show up
+# in the error file, and an expired job only got through the first request before it expired
+class fakeBatchClient:
+    def __init__(self, final_status="completed"):
+        self.final_status = final_status
+        self.files_data = {}
+        self.jobs = {}
+        self.retrieves = 0
+        self._lock = threading.Lock()
+        self.files = SimpleNamespace(create=self.createFile, content=self.fileContent)
+        self.batches = SimpleNamespace(create=self.createBatch, retrieve=self.retrieveBatch)
+
+    def addFile(self, text):
+        with self._lock:
+            file_id = f"file-{len(self.files_data)}"
+            self.files_data[file_id] = text
+        return file_id
+
+    def createFile(self, file, purpose):
+        name, data, content_type = file
+        return SimpleNamespace(id=self.addFile(data.decode()), filename=name, purpose=purpose)
+
+    def fileContent(self, file_id):
+        return SimpleNamespace(text=self.files_data[file_id])
+
+    def createBatch(self, input_file_id, endpoint, completion_window):
+        batch_id = f"batch-{len(self.jobs)}"
+        requests = [json.loads(line) for line in self.files_data[input_file_id].splitlines() if line.strip()]
+        self.jobs[batch_id] = {"requests": requests, "checks": 0}
+        return SimpleNamespace(id=batch_id, status="validating")
+
+    def retrieveBatch(self, batch_id):
+        self.retrieves += 1
+        job = self.jobs[batch_id]
+        job["checks"] += 1
+        if job["checks"] == 1:
+            return SimpleNamespace(id=batch_id, status="in_progress", output_file_id=None, error_file_id=None)
+        if self.final_status == "failed":
+            return SimpleNamespace(id=batch_id, status="failed", output_file_id=None, error_file_id=None)
+
+        requests = job["requests"][:1] if self.final_status == "expired" else job["requests"]
+        output_lines = []
+        error_lines = []
+        for request in requests:
+            custom_id = request["custom_id"]
+            if "lost" in custom_id:
+                error_lines.append({"custom_id": custom_id, "error": {"code": "server_error", "message": "Lost"}})
+            elif "bad" in custom_id:
+                output_lines.append({"custom_id": custom_id, "response": {"status_code": 400, "body": {"error": {"message": "Bad request"}}}, "error": None})
+            else:
+                content = json.dumps({"title": f"Movie {custom_id}", "tagline": "A tagline", "description": "A description"})
+                output_lines.append({"custom_id": custom_id, "response": {"status_code": 200, "body": {"choices": [{"message": {"role": "assistant", "content": content}}]}}, "error": None})
+        return SimpleNamespace(
+            id=batch_id,
+            status=self.final_status,
+            output_file_id=self.addFile("\n".join(json.dumps(line) for line in output_lines) + "\n") if output_lines else None,
+            error_file_id=self.addFile("\n".join(json.dumps(line) for line in error_lines) + "\n") if error_lines else None
+        )
+
+class aoaiBatchTest(unittest.TestCase):
+    def setUp(self):
+        env = mock.patch.dict("os.environ", BATCH_ENV)
+        env.start()
+        self.addCleanup(env.stop)
+
+    def createBatch(self, custom_ids, final_status="completed"):
+        batch = aoaiBatch()
+        batch.client = fakeBatchClient(final_status)
+        for custom_id in custom_ids:
+            batch.addRequest(custom_id, "system prompt", f"user prompt {custom_id}", max_tokens=300, schema=MOVIE_SCHEMA)
+        return batch
+
+    def test_completed_batch(self):
+        batch = self.createBatch(["first", "second"])
+        results = batch.run()
+
+        # Uploaded as one jsonl job with a chat completion per request
+        self.assertEqual(len(batch.batches), 1)
+        uploaded = batch.client.jobs["batch-0"]["requests"]
+        self.assertEqual([request["custom_id"] for request in uploaded], ["first", "second"])
+        body = uploaded[0]["body"]
+        self.assertEqual(uploaded[0]["url"], "/chat/completions")
+        self.assertEqual(body["model"], "batch-deployment")
+        self.assertEqual(body["messages"][1]["content"], "user prompt first")
+        self.assertEqual(body["max_tokens"], 300)
+        self.assertEqual(body["response_format"]["json_schema"]["name"], "movie")
+        # Polled until the job finished
+        self.assertEqual(batch.client.retrieves, 2)
+
+        self.assertEqual(set(results), {"first", "second"})
+        for custom_id in ("first", "second"):
+            self.assertEqual(json.loads(results[custom_id])["title"], f"Movie {custom_id}")
+
+    def test_failed_lines_only_fail_their_requests(self):
+        results = self.createBatch(["good", "bad-request", "lost-request"]).run()
+
+        self.assertEqual(json.loads(results["good"])["title"], "Movie good")
+        self.assertIsInstance(results["bad-request"], Exception)
+        self.assertIn("Bad request", str(results["bad-request"]))
+        self.assertIsInstance(results["lost-request"], Exception)
+        self.assertIn("Lost", str(results["lost-request"]))
+
+    def test_expired_batch_keeps_finished_requests(self):
+        results = self.createBatch(["early", "late"], "expired").run()
+
+        self.assertEqual(json.loads(results["early"])["title"], "Movie early")
+        self.assertIsInstance(results["late"], Exception)
+        self.assertIn("expired", str(results["late"]))
+
+    def test_failed_batch_fails_every_request(self):
+        results = self.createBatch(["first", "second"], "failed").run()
+
+        for custom_id in ("first", "second"):
+            self.assertIsInstance(results[custom_id], Exception)
+            self.assertIn("failed", str(results[custom_id]))
+
+    def test_big_waves_are_split_over_jobs(self):
+        with mock.patch.object(aoai_batch, "BATCH_MAX_REQUESTS", 2):
+            batch = self.createBatch(["one", "two", "three"])
+            results = batch.run()
+
+        self.assertEqual([len(requests) for _, requests in batch.batches], [2, 1])
+        self.assertEqual(set(results), {"one", "two", "three"})
+        self.assertFalse(any(isinstance(result, Exception) for result in results.values()))
+
+if __name__ == "__main__":
+    unittest.main()
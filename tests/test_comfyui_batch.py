@@ -0,0 +1,238 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from types import SimpleNamespace
+import threading
+import unittest
+import time
+import asyncio
+import json
+
+import lib.ollama_model as ollama_model
+import lib.comfyui_pool as comfyui_pool
+from lib.ollama_model import ollamaImage
+from lib.image import image
+from lib.metrics import getMetrics
+from lib.model_clients import closeAsyncClients
+
+# Fake ComfyUI node, queues the workflows posted to /prompt and answers /history and /view like ComfyUI does. Each
+# workflow makes batch_size images, the image data is the prompt text and filename so a test can tell which prompt
+# an image came from. A prompt containing "fail" errors, one containing "short" makes one image less than its batch and
+# one containing "stuck" never finishes
+class fakeComfyUI:
+    def __init__(self):
+        self.workflows = []
+        self.history_requests = 0
+        # What /queue reports and how long it takes to answer
+        self.queue_depth = 0
+        self.queue_delay = 0
+        self.prompts = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handlerClass())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def queuePrompt(self, workflow):
+        with self._lock:
+            prompt_id = f"prompt-{len(self.workflows)}"
+            self.workflows.append(workflow)
+        text = workflow["prompt"]["16"]["inputs"]["text"]
+        batch_size = workflow["prompt"]["53"]["inputs"]["batch_size"]
+        image_count = batch_size - 1 if "short" in text else batch_size
+        self.prompts[prompt_id] = {
+            "text": text,
+            "filenames": [f"ComfyUI_{prompt_id}_{index}.png" for index in range(image_count)],
+            "status": "error" if "fail" in text else "success",
+            # The first history check finds the prompt still running
+            "checks": 0
+        }
+        return prompt_id
+
+    def history(self, prompt_id):
+        with self._lock:
+            self.history_requests += 1
+            prompt = self.prompts.get(prompt_id)
+            if prompt is None or prompt["checks"] == 0 or "stuck" in prompt["text"]:
+                if prompt is not None:
+                    prompt["checks"] += 1
+                return {}
+        outputs = {"9": {"images": [{"filename": filename, "subfolder": "", "type": "output"} for filename in prompt["filenames"]]}}
+        return {prompt_id: {"status": {"status_str": prompt["status"], "completed": True}, "outputs": outputs}}
+
+    def imageData(self, filename):
+        for prompt in self.prompts.values():
+            if filename in prompt["filenames"]:
+                return f"{prompt['text']}|{filename}".encode()
+        return None
+
+    def handlerClass(self):
+        comfy = self
+        class handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != "/prompt":
+                    return self.send_error(404)
+                workflow = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                self.sendJson({"prompt_id": comfy.queuePrompt(workflow), "number": len(comfy.workflows), "node_errors": {}})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/queue":
+                    time.sleep(comfy.queue_delay)
+                    self.sendJson({"queue_running": [], "queue_pending": [{}] * comfy.queue_depth})
+                elif url.path.startswith("/history/"):
+                    self.sendJson(comfy.history(url.path[len("/history/"):]))
+                elif url.path == "/view":
+                    data = comfy.imageData(parse_qs(url.query).get("filename", [""])[0])
+                    if data is None:
+                        return self.send_error(404)
+                    self.sendBody(data, "image/png")
+                else:
+                    # No websocket, so the client polls /history
+                    self.send_error(404)
+
+            def sendJson(self, data):
+                self.sendBody(json.dumps(data).encode(), "application/json")
+
+            def sendBody(self, body, content_type):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        return handler
+
+class comfyuiBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.comfy = fakeComfyUI()
+        self.previous_pool = comfyui_pool._comfy_pool
+        comfyui_pool._comfy_pool = comfyui_pool.comfyEndpointPool([self.comfy.url])
+        self.previous_poll_min = ollama_model.COMFYUI_POLL_MIN
+        self.previous_wait_max = ollama_model.COMFYUI_WAIT_MAX
+        ollama_model.COMFYUI_POLL_MIN = .01
+
+    def tearDown(self):
+        ollama_model.COMFYUI_POLL_MIN = self.previous_poll_min
+        ollama_model.COMFYUI_WAIT_MAX = self.previous_wait_max
+        comfyui_pool._comfy_pool = self.previous_pool
+        self.comfy.stop()
+
+    def imageText(self, result):
+        self.assertNotIsInstance(result, Exception)
+        return result.read().decode()
+
+    def batchSizes(self):
+        return [(workflow["prompt"]["16"]["inputs"]["text"], workflow["prompt"]["53"]["inputs"]["batch_size"]) for workflow in self.comfy.workflows]
+
+    def test_single_image(self):
+        image_model = ollamaImage()
+        image_model.user_prompt = "a cabbage in space"
+        result = image_model.generateImage()
+
+        self.assertEqual(self.batchSizes(), [("a cabbage in space", 1)])
+        self.assertEqual(self.imageText(result), "a cabbage in space|ComfyUI_prompt-0_0.png")
+        # Still running on the first check, so /history was polled until it finished
+        self.assertGreaterEqual(self.comfy.history_requests, 2)
+
+    def test_single_image_async(self):
+        image_model = ollamaImage()
+        image_model.user_prompt = "a cabbage in orbit"
+        async def generate():
+            try:
+                return await image_model.generateImageAsync()
+            finally:
+                await closeAsyncClients()
+        result = asyncio.run(generate())
+
+        self.assertEqual(self.batchSizes(), [("a cabbage in orbit", 1)])
+        self.assertEqual(self.imageText(result), "a cabbage in orbit|ComfyUI_prompt-0_0.png")
+
+    def test_prompts_that_never_finish_time_out(self):
+        ollama_model.COMFYUI_WAIT_MAX = .2
+        image_model = ollamaImage()
+        image_model.endpoint = self.comfy.url
+        stuck_id = image_model.queueWorkflow(image_model.buildWorkflow("stuck harbor"), "test")
+        done_id = image_model.queueWorkflow(image_model.buildWorkflow("harbor"), "test")
+
+        filenames = image_model.waitForImages([stuck_id, done_id])
+        self.assertIsInstance(filenames[stuck_id], TimeoutError)
+        self.assertEqual(filenames[done_id], [f"ComfyUI_{done_id}_0.png"])
+
+        async def wait():
+            try:
+                return await image_model.waitForImagesAsync([stuck_id])
+            finally:
+                await closeAsyncClients()
+        self.assertIsInstance(asyncio.run(wait())[stuck_id], TimeoutError)
+
+    def test_shared_prompts_use_one_batched_latent(self):
+        prompts = ["neon harbor", "velvet storm", "neon harbor", "neon harbor"]
+        results = ollamaImage().generateImages(prompts)
+
+        self.assertEqual(sorted(self.batchSizes()), [("neon harbor", 3), ("velvet storm", 1)])
+        self.assertEqual(len(results), len(prompts))
+        texts = [self.imageText(result) for result in results]
+        for prompt, text in zip(prompts, texts):
+            self.assertTrue(text.startswith(f"{prompt}|"))
+        # Each poster gets its own image out of the batch
+        self.assertEqual(len(set(texts)), len(texts))
+
+    def test_batches_split_at_max_batch(self):
+        prompts = ["orbit"] * (ollama_model.COMFYUI_MAX_BATCH + 2)
+        results = ollamaImage().generateImages(prompts)
+
+        self.assertEqual([batch_size for _, batch_size in self.batchSizes()], [ollama_model.COMFYUI_MAX_BATCH, 2])
+        texts = [self.imageText(result) for result in results]
+        self.assertEqual(len(set(texts)), len(prompts))
+
+    def test_failed_and_short_batches_only_fail_their_prompts(self):
+        prompts = ["meadow", "fail meadow", "short meadow", "short meadow"]
+        results = ollamaImage().generateImages(prompts)
+
+        self.assertTrue(self.imageText(results[0]).startswith("meadow|"))
+        self.assertIsInstance(results[1], Exception)
+        # The batch of two came back with one image, the first poster gets it and the second fails
+        self.assertTrue(self.imageText(results[2]).startswith("short meadow|"))
+        self.assertIsInstance(results[3], Exception)
+
+    def test_batches_go_through_the_governor(self):
+        image_model = ollamaImage()
+        governor = image_model.getGovernor()
+        previous = (governor.max_retries, governor.backoff_base)
+        governor.max_retries, governor.backoff_base = 1, .001
+        try:
+            requests = getMetrics().requests.get(governor.name, 0)
+            image_model.generateImages(["lantern", "archive"])
+            self.assertEqual(getMetrics().requests.get(governor.name, 0), requests + 1)
+
+            # A batch where every prompt failed is retried as a whole before the error is raised
+            retries = governor.retry_count
+            with self.assertRaises(Exception):
+                image_model.generateImages(["fail lantern"])
+            self.assertEqual(governor.retry_count, retries + 1)
+            self.assertEqual([text for text, _ in self.batchSizes()].count("fail lantern"), 2)
+        finally:
+            governor.max_retries, governor.backoff_base = previous
+
+    def test_images_map_back_to_their_media_objects(self):
+        def imageObject(title, prompt):
+            process = SimpleNamespace(outputMessage=lambda message, level="": None)
+            media_object = SimpleNamespace(title=title, model_type="local", image_prompt={"image_prompt_completion": prompt}, _process=process, _verbose=False)
+            return image(media_object)
+
+        image_objects = [imageObject("First", "glacier parade"), imageObject("Second", "signal echo"), imageObject("Third", "glacier parade")]
+        self.assertEqual(image.generateImageBatch(image_objects), [True, True, True])
+
+        self.assertEqual(sorted(self.batchSizes()), [("glacier parade", 2), ("signal echo", 1)])
+        for image_object in image_objects:
+            text = image_object.generated_image.read().decode()
+            self.assertTrue(text.startswith(image_object.media_object.image_prompt["image_prompt_completion"] + "|"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import time
+
+import lib.comfyui_pool as comfyui_pool
+from lib.comfyui_pool import comfyEndpointPool
+from tests.test_comfyui_batch import fakeComfyUI
+
+class comfyEndpointPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.previous_interval = comfyui_pool.QUEUE_CHECK_INTERVAL
+        comfyui_pool.QUEUE_CHECK_INTERVAL = .05
+        self.nodes = [fakeComfyUI(), fakeComfyUI()]
+        self.pool = comfyEndpointPool([node.url for node in self.nodes])
+
+    def tearDown(self):
+        self.pool.stopPolling()
+        for node in self.nodes:
+            node.stop()
+        comfyui_pool.QUEUE_CHECK_INTERVAL = self.previous_interval
+
+    def waitForDepths(self, depths):
+        deadline = time.monotonic() + 5
+        while [endpoint.queue_depth for endpoint in self.pool.endpoints] != depths:
+            self.assertLess(time.monotonic(), deadline, "queue depths weren't refreshed")
+            time.sleep(.01)
+
+    def test_picks_the_least_busy_node(self):
+        self.nodes[0].queue_depth = 3
+        self.pool.release(self.pool.acquire())
+        self.waitForDepths([3, 0])
+
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        self.assertEqual(first.url, self.nodes[1].url)
+        # Jobs in flight count too, the second node is still less busy with one
+        self.assertEqual(second.url, self.nodes[1].url)
+        self.pool.release(first)
+        self.pool.release(second)
+
+    def test_acquire_doesnt_wait_on_a_slow_node(self):
+        self.nodes[0].queue_delay = 1
+        start = time.monotonic()
+        for _ in range(5):
+            self.pool.release(self.pool.acquire())
+        self.assertLess(time.monotonic() - start, .5)
+
+    def test_single_node_isnt_polled(self):
+        pool = comfyEndpointPool([self.nodes[0].url])
+        pool.release(pool.acquire())
+        self.assertIsNone(pool._poller)
+
+if __name__ == "__main__":
+    unittest.main()
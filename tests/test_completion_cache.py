@@ -0,0 +1,59 @@
+import tempfile
+import unittest
+import asyncio
+import json
+import os
+
+import lib.completion_cache as completion_cache
+from lib.completion_cache import completionCache, cachedCompletion, cachedCompletionAsync
+from lib.schemas import completionMatches, MOVIE_SCHEMA
+
+MOVIE = json.dumps({"title": "Orbit", "tagline": "Up", "description": "Space"})
+KEY_PARTS = ("test", "model", "system", "user", None, None, "movie")
+
+class cachedCompletionTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.cache = completionCache(os.path.join(self.work_dir.name, "cache.db"))
+        self.previous_cache = completion_cache._completion_cache
+        completion_cache._completion_cache = self.cache
+
+    def tearDown(self):
+        completion_cache._completion_cache = self.previous_cache
+        self.cache.close()
+        self.work_dir.cleanup()
+
+    def validate(self, completion):
+        return completionMatches(completion, MOVIE_SCHEMA)
+
+    def test_only_valid_completions_are_cached(self):
+        completions = iter(["not a movie", MOVIE])
+        generate = lambda: next(completions)
+
+        # The malformed completion is returned for the caller to fail on, but the retry asks the backend again
+        self.assertEqual(cachedCompletion(KEY_PARTS, generate, self.validate), "not a movie")
+        self.assertEqual(cachedCompletion(KEY_PARTS, generate, self.validate), MOVIE)
+        # Now it is answered from the cache
+        self.assertEqual(cachedCompletion(KEY_PARTS, lambda: self.fail("not cached"), self.validate), MOVIE)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_cached_completions_that_dont_validate_are_dropped(self):
+        self.cache.put(completionCache.buildKey(*KEY_PARTS), "{\"title\": \"\"}")
+        self.assertEqual(cachedCompletion(KEY_PARTS, lambda: MOVIE, self.validate), MOVIE)
+        self.assertEqual(self.cache.get(completionCache.buildKey(*KEY_PARTS)), MOVIE)
+        self.assertEqual(self.cache.to_json()["entries"], 1)
+
+    def test_async_only_caches_valid_completions(self):
+        async def generateBad():
+            return "not a movie"
+        async def generateGood():
+            return MOVIE
+        async def run():
+            bad = await cachedCompletionAsync(KEY_PARTS, generateBad, self.validate)
+            good = await cachedCompletionAsync(KEY_PARTS, generateGood, self.validate)
+            cached = await cachedCompletionAsync(KEY_PARTS, generateBad, self.validate)
+            return bad, good, cached
+        self.assertEqual(asyncio.run(run()), ("not a movie", MOVIE, MOVIE))
+
+if __name__ == "__main__":
+    unittest.main()
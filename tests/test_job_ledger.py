@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+from io import BytesIO
+import tempfile
+import unittest
+import os
+
+from lib.job_ledger import jobLedger, MAX_ATTEMPTS
+
+class jobLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.ledger = jobLedger(os.path.join(self.work_dir.name, "job_ledger.db"))
+        self.media_object = SimpleNamespace(to_state=lambda: {"title": "Orbit"})
+
+    def tearDown(self):
+        self.ledger.close()
+        self.work_dir.cleanup()
+
+    def recordAttempt(self, process_id, result):
+        self.ledger.startJob(process_id)
+        self.ledger.recordImage(process_id, BytesIO(b"image"), self.media_object)
+        image_path = os.path.join(self.ledger.images_dir, f"{process_id}.png")
+        self.assertTrue(os.path.exists(image_path))
+        self.ledger.finishJob(process_id, result)
+        return image_path
+
+    def test_image_removed_when_done(self):
+        image_path = self.recordAttempt("done-job", "success")
+        self.assertFalse(os.path.exists(image_path))
+        self.assertEqual(self.ledger.getResumableJobs(10), [])
+
+    def test_image_kept_until_attempts_are_used_up(self):
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            image_path = self.recordAttempt("failing-job", "image")
+            if attempt < MAX_ATTEMPTS:
+                self.assertTrue(os.path.exists(image_path))
+                resumable = self.ledger.getResumableJobs(10)
+                self.assertEqual([entry.process_id for entry in resumable], ["failing-job"])
+                self.assertTrue(resumable[0].hasCompleted("image"))
+        self.assertFalse(os.path.exists(image_path))
+        self.assertEqual(self.ledger.getResumableJobs(10), [])
+
+if __name__ == "__main__":
+    unittest.main()
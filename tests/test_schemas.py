@@ -0,0 +1,35 @@
+import unittest
+import json
+
+from lib.schemas import parseCompletion, MOVIE_SCHEMA, CRITIC_REVIEW_SCHEMA, VISION_LAYOUT_SCHEMA, FUSED_SCHEMA
+
+class parseCompletionTest(unittest.TestCase):
+    def test_optional_fields_that_dont_fit_are_dropped(self):
+        movie = parseCompletion(json.dumps({"title": "Orbit", "tagline": "Up", "description": "Space", "rating_content": None, "mpaa_rating": 13}), MOVIE_SCHEMA)
+        self.assertEqual(movie, {"title": "Orbit", "tagline": "Up", "description": "Space"})
+
+        layout = parseCompletion('Here you go: {"location": "left", "location_padding": "40", "has_text": false}', VISION_LAYOUT_SCHEMA)
+        self.assertEqual(layout, {"location_padding": 40, "has_text": False})
+
+    def test_required_fields_are_strict(self):
+        with self.assertRaises(ValueError):
+            parseCompletion(json.dumps({"title": "", "tagline": "Up", "description": "Space"}), MOVIE_SCHEMA)
+        with self.assertRaises(ValueError):
+            parseCompletion(json.dumps({"critic_score": "great", "critic_review": "Loved it"}), CRITIC_REVIEW_SCHEMA)
+
+    def test_scores_are_taken_from_text(self):
+        self.assertEqual(parseCompletion(json.dumps({"critic_score": "8/10", "critic_review": "Loved it"}), CRITIC_REVIEW_SCHEMA)["critic_score"], 8)
+        self.assertEqual(parseCompletion(json.dumps({"critic_score": "7.5 out of 10", "critic_review": "Fine"}), CRITIC_REVIEW_SCHEMA)["critic_score"], 7.5)
+
+    def test_nested_optional_fields_are_dropped(self):
+        fused = parseCompletion(json.dumps({
+            "movie": {"title": "Orbit", "tagline": "Up", "description": "Space", "rating_content": None},
+            "reviews": [{"critic_score": 6, "critic_review": "Fine", "critic_tone": 3}],
+            "poster": {"image_prompt": "A rocket", "font": None}
+        }), FUSED_SCHEMA)
+        self.assertNotIn("rating_content", fused["movie"])
+        self.assertEqual(fused["reviews"], [{"critic_score": 6, "critic_review": "Fine"}])
+        self.assertEqual(fused["poster"], {"image_prompt": "A rocket"})
+
+if __name__ == "__main__":
+    unittest.main()